@@ -1,16 +1,26 @@
 import numpy as np
 import math
-
-import matplotlib.pyplot as plt
-            
-import imageio as iio
-from skimage.feature import match_template
-from skimage.feature import peak_local_max
-from skimage.io import imread, imsave
+import time
             
-from .database import Database, list_no_hidden
+from .database import Database, get_vial_ids, TIMEPOINTS_TO_ANALYZE
+from .matching import MatchingEngine, match_coarse_to_fine, PYRAMID_THRESHOLD_MARGIN
+from .templates import FOAM_TEMPLATE_FILENAME
+from .frames import get_video_signature, get_frame_index, VIAL_REGION_ROWS, BACKGROUND_SAMPLE_FRAMES
+
+from typing import List, Dict, Tuple, Optional
 
-from typing import List, Dict, Tuple
+
+CROPPING_BUFFER_ZONE = 50
+MIN_DISTANCE = 25
+THRESHOLD = 0.25
+MIN_CLIMBING_HEIGHT = 600 
+MAX_VIAL_DRIFT = 20
+VIAL_MARGIN = 100
+# offset between the peaks in the response map and the center of the fly in the cropped vial
+FLY_COORDS_OFFSET = np.array([15, 20], dtype=np.int32)
+# 'templates': fly response minus the response of the background templates, 'median': fly response minus the fly
+# response of the temporal median background of the video
+BACKGROUND_MODELS = ['templates', 'median']
             
     
 
@@ -23,24 +33,168 @@ class FlyDetector:
                  threshold: float,
                  min_distance: int,
                  overwrite: bool,
-                 quick_view: bool):
+                 quick_view: bool,
+                 color_mode: str='rgb',
+                 drift_check: bool=False,
+                 max_drift: int=MAX_VIAL_DRIFT,
+                 persist_response_maps: bool=False,
+                 vial_margin: int=VIAL_MARGIN,
+                 max_climbing_height: Optional[int]=None,
+                 roi_polygon: Optional[List[Tuple[int, int]]]=None,
+                 use_frame_cache: bool=False,
+                 pyramid_factor: int=1,
+                 pyramid_threshold_margin: float=PYRAMID_THRESHOLD_MARGIN,
+                 background_model: str='templates'):
         self.file_id = file_id
         self.database = database
         self.cropping_buffer_zone = cropping_buffer_zone
         self.min_climbing_height = min_climbing_height
         self.threshold = threshold
         self.min_distance = min_distance
+        self.color_mode = color_mode
+        self.drift_check = drift_check
+        self.max_drift = max_drift
+        self.persist_response_maps = persist_response_maps
+        self.use_frame_cache = use_frame_cache
+        # pyramid_factor > 1: coarse-to-fine matching, the full resolution response is only computed around the peaks
+        # of the response of the downscaled vial that exceed threshold - pyramid_threshold_margin
+        if pyramid_factor < 1:
+            raise ValueError(f'"pyramid_factor" has to be an integer >= 1, not: {pyramid_factor}')
+        self.pyramid_factor = pyramid_factor
+        self.pyramid_threshold_margin = pyramid_threshold_margin
+        if background_model not in BACKGROUND_MODELS:
+            raise ValueError(f'"background_model" has to be one of {BACKGROUND_MODELS}, not: {background_model}')
+        if (background_model == 'median') and (pyramid_factor > 1):
+            raise ValueError('The coarse-to-fine matching ("pyramid_factor" > 1) requires the "templates" background model.')
+        self.background_model = background_model
+        # temporal median background of the video and its fly responses by vial_cropping_coords
+        self.median_background = None
+        self.background_responses = dict()
+        # (row, col) position of the loaded images in the full frame - frames from the frame cache only contain the vial region
+        self.image_offset = (0, 0)
+        # criteria for the corrected fly coords: all flies between the vial margins, above min_climbing_height and 
+        # (optionally) below max_climbing_height and inside a polygon with (row, col) vertices in vial coordinates
+        self.filter_criteria = {'vial_margin': vial_margin,
+                                'max_climbing_height': max_climbing_height,
+                                'roi_polygon': [[int(row), int(col)] for row, col in roi_polygon] if roi_polygon != None else None}
         self.detection_configs = {'cropping_buffer_zone': cropping_buffer_zone, 
                                   'min_climbing_height' : min_climbing_height, 
                                   'threshold': threshold,
-                                  'min_distance': min_distance}
+                                  'min_distance': min_distance,
+                                  'color_mode': color_mode,
+                                  'drift_check': drift_check,
+                                  'pyramid_factor': pyramid_factor,
+                                  'background_model': background_model,
+                                  **self.filter_criteria}
         self.file_info = self.database.get_file_info_df(file_id = self.file_id)
+        if len(self.file_info['file_id']) == 0:
+            raise ValueError(f'There is no recording with file_id: {self.file_id} in the database.')
+        # position of the vial from left to right in recordings of several vials
+        self.vial_position = self.file_info['vial_position'][0]
+        self.vials_in_recording = len(get_vial_ids(self.file_info['video_filepath'][0]))
         self.overwrite = overwrite
         self.quick_view = quick_view
         
 
 
     def run(self) -> Database:
+        for detection_results in self.analyze():
+            self.database.add_detected_flies(file_id = self.file_id, **detection_results)
+        return self.database
+    
+    
+    def analyze(self) -> List[Dict]:
+        all_detection_results = list()
+        for time_passed, image in self.load_images().items():
+            all_fly_coords, vial_cropping_coords, corrected_fly_coords = self.detect_flies(time_passed = time_passed, image = image)
+            all_detection_results.append({'time_passed': time_passed, 
+                                          'all_fly_coords': all_fly_coords,
+                                          'vial_cropping_coords': vial_cropping_coords, 
+                                          'corrected_fly_coords': corrected_fly_coords, 
+                                          'detection_configs': self.detection_configs})
+        return all_detection_results
+    
+    
+    def load_images(self) -> Dict[int, np.ndarray]:
+        times_to_load = self.get_times_to_load()
+        if len(times_to_load) == 0:
+            return dict()
+        return self.get_images(times_to_load)
+
+
+    def get_times_to_load(self) -> List[int]:
+        times_to_analyze = self.get_times_to_analyze()
+        if self.file_info['video_available'][0] == False:
+            print(f'The video of file_id: {self.file_id} is no longer available - continue with next file.')
+            return list()
+        if len(times_to_analyze) == 0:
+            print(f'Flies were already annotated for file_id: {self.file_id} - continue with next file.')
+            return list()
+        if self.quick_view:
+            times_to_analyze = [times_to_analyze[0]]
+        return times_to_analyze
+
+
+    def get_images(self, times_passed: List[int]) -> Dict[int, np.ndarray]:
+        images = self.get_cached_images(times_passed)
+        if images == None:
+            images = self.decode_images(times_passed)
+            self.add_to_frame_cache(images)
+        return images
+
+
+    def decode_images(self, times_passed: List[int]) -> Dict[int, np.ndarray]:
+        self.image_offset = (0, 0)
+        if self.background_model == 'median':
+            # decodes the analyzed frames in the same pass as the frames of the median background
+            self.get_median_background()
+        return self.database.frame_loader.get_frames(video_filepath = self.file_info['video_filepath'][0], 
+                                                     times_passed = times_passed,
+                                                     color_mode = self.color_mode)
+
+
+    def uses_frame_cache(self) -> bool:
+        # The frame cache only contains the vial region and can therefore not be used to check for drift of the vial
+        return self.use_frame_cache and (self.drift_check == False)
+
+
+    def get_cached_images(self, times_passed: List[int]) -> Optional[Dict[int, np.ndarray]]:
+        # Cached vial regions are only used if the vial was localized before and the regions cover all requested 
+        # timepoints as well as the columns of the cropped vial
+        if self.uses_frame_cache() == False:
+            return None
+        video_filepath = self.file_info['video_filepath'][0]
+        vial_localization = self.database.get_vial_localization(file_id = self.file_id, video_filepath = video_filepath, color_mode = self.color_mode)
+        if vial_localization == None:
+            return None
+        cached_frames = self.database.frame_cache.get(self.file_id, self.color_mode, get_video_signature(video_filepath))
+        if cached_frames == None:
+            return None
+        regions, offset = cached_frames
+        if any(time_passed not in regions for time_passed in times_passed):
+            return None
+        region_width = regions[times_passed[0]].shape[1]
+        if ((vial_localization['min_col_idx'] - self.cropping_buffer_zone - 100 < offset[1]) or 
+            (vial_localization['max_col_idx'] + self.cropping_buffer_zone + 100 > offset[1] + region_width)):
+            return None
+        self.image_offset = offset
+        return {time_passed: regions[time_passed] for time_passed in times_passed}
+
+
+    def add_to_frame_cache(self, images: Dict[int, np.ndarray]):
+        # images: full frames - localizes the vial (if not done before) to determine the cached region
+        if (self.uses_frame_cache() == False) or (len(images) == 0):
+            return
+        foam_template = self.database.template_bank.get_template('foam', FOAM_TEMPLATE_FILENAME, color_mode = self.color_mode)
+        vial_col_range = self.get_cached_vial_cropping_info(next(iter(images.values())), foam_template)
+        self.database.frame_cache.put(file_id = self.file_id,
+                                      color_mode = self.color_mode,
+                                      video_signature = get_video_signature(self.file_info['video_filepath'][0]),
+                                      frames = images,
+                                      vial_col_range = vial_col_range)
+    
+    
+    def get_times_to_analyze(self) -> List[int]:
         times_to_analyze = list()
         for i in range(len(self.file_info['time_passed'])):
             if self.overwrite:
@@ -48,112 +202,304 @@ class FlyDetector:
             else:
                 if (self.file_info['all_detected_flies'][i] == None) or (math.isnan(self.file_info['all_detected_flies'][i])):
                     times_to_analyze.append(self.file_info['time_passed'][i])
-            
-        if len(times_to_analyze) > 0:
-            if self.quick_view:
-                times_to_analyze = [times_to_analyze[0]]
-            for time_passed in times_to_analyze:
-                all_fly_coords, vial_cropping_coords, corrected_fly_coords = self.detect_flies(time_passed = time_passed)
-                self.database.add_detected_flies(file_id = self.file_id, 
-                                                 time_passed = time_passed, 
-                                                 all_fly_coords = all_fly_coords,
-                                                 vial_cropping_coords = vial_cropping_coords, 
-                                                 corrected_fly_coords = corrected_fly_coords, 
-                                                 detection_configs = self.detection_configs)
-
-        else:
-            print(f'Flies were already annotated for file_id: {self.file_id} - continue with next file.')
-            
-        return self.database    
+        return times_to_analyze
         
             
-    def detect_flies(self, time_passed: int) -> Tuple[List, Tuple, List]:
-        frame_index = time_passed*30
-
-        reader = iio.get_reader(self.file_info['video_filepath'][0])
-        image = reader.get_data(frame_index)
-        reader.close()
-
-        min_col_idx, max_col_idx = self.get_vial_cropping_info_from_foam_matching(image, self.database.foam_template)
+    def detect_flies(self, time_passed: int, image: np.ndarray) -> Tuple[np.ndarray, Tuple, np.ndarray]:
+        vial_cropping_coords, bkgr_corrected_results, vial_width = self.get_response_map(time_passed = time_passed, image = image)
+        all_fly_coords, corrected_fly_coords = self.find_flies(bkgr_corrected_results, vial_width)
+        return all_fly_coords, vial_cropping_coords, corrected_fly_coords
+    
+    
+    def get_response_map(self, time_passed: int, image: np.ndarray) -> Tuple[Tuple, np.ndarray, int]:
+        vial_cropping_coords, vial = self.crop_vial(image = image)
+        bkgr_corrected_results = self.match_vial(time_passed = time_passed, vial = vial, vial_cropping_coords = vial_cropping_coords)
+        return vial_cropping_coords, bkgr_corrected_results, vial.shape[1]
+    
+    
+    def crop_vial(self, image: np.ndarray) -> Tuple[Tuple, np.ndarray]:
+        foam_template = self.database.template_bank.get_template('foam', FOAM_TEMPLATE_FILENAME, color_mode = self.color_mode)
+        min_col_idx, max_col_idx = self.get_cached_vial_cropping_info(image, foam_template)
         vial_cropping_coords = (min_col_idx-self.cropping_buffer_zone, max_col_idx+self.cropping_buffer_zone)
-        vial = image[200:1000, vial_cropping_coords[0] - 100 : vial_cropping_coords[1] + 100]
+        row_offset, col_offset = self.image_offset
+        vial = image[VIAL_REGION_ROWS[0] - row_offset : VIAL_REGION_ROWS[1] - row_offset, 
+                     vial_cropping_coords[0] - 100 - col_offset : vial_cropping_coords[1] + 100 - col_offset]
         # make cropping adjustable while displayed item is always 100 pixels more on both sides?
+        return vial_cropping_coords, vial
+    
+    
+    def match_vial(self, time_passed: int, vial: np.ndarray, vial_cropping_coords: Tuple) -> np.ndarray:
+        # The response map doesn't depend on threshold, min_distance or min_climbing_height and is therefore reused
+        # whenever only these parameters change
+        signature = self.get_response_map_signature(vial_cropping_coords)
+        cached_response_map = self.database.response_map_cache.get(self.file_id, time_passed, signature)
+        if cached_response_map != None:
+            return cached_response_map[0]
 
-        template_flies = list()
-        for filename in list_no_hidden(f'{self.database.templates_dir}flies/'):
-            template_flies.append(imread(f'{self.database.templates_dir}flies/{filename}'))
-        template_bkgrs = list()
-        for filename in list_no_hidden(f'{self.database.templates_dir}backgrounds/'):
-            template_bkgrs.append(imread(f'{self.database.templates_dir}backgrounds/{filename}'))
-
-        template_matching_results = {'flies': list(),
-                                     'bkgrs': list()}
-        for fly in template_flies:
-            template_matching_results['flies'].append(match_template(vial, fly)) 
-        for bkgr in template_bkgrs:
-            template_matching_results['bkgrs'].append(match_template(vial, bkgr)) 
-        fly_mean_results = sum(template_matching_results['flies']) / len(template_matching_results['flies'])
-        bkgr_mean_results = sum(template_matching_results['bkgrs']) / len(template_matching_results['bkgrs'])
-        bkgr_corrected_results = fly_mean_results - bkgr_mean_results
-
-        flies_xy = peak_local_max(bkgr_corrected_results[..., 0], min_distance=self.min_distance, threshold_abs=self.threshold)
-        all_fly_coords = flies_xy.copy()
-        all_fly_coords[:,0] += 15
-        all_fly_coords[:, 1] += 20
-
-        all_fly_coords_as_list = list(all_fly_coords)
-
-        corrected_fly_coords_as_list = all_fly_coords_as_list.copy()
-        idx_to_pop = list()
-        for fly_index in range(len(corrected_fly_coords_as_list)):
-            if 100 < corrected_fly_coords_as_list[fly_index][1] < vial.shape[1] - 100:
-                if self.min_climbing_height > corrected_fly_coords_as_list[fly_index][0]:
-                    pass
-                else: idx_to_pop.append(fly_index)
-            else:
-                idx_to_pop.append(fly_index)
-        idx_to_pop.sort(reverse = True)
-        for idx in idx_to_pop:
-            corrected_fly_coords_as_list.pop(idx)
-
-        return all_fly_coords_as_list, vial_cropping_coords, corrected_fly_coords_as_list
+        bkgr_corrected_results = self.compute_response_map(vial, vial_cropping_coords)
+        self.database.response_map_cache.put(self.file_id, time_passed, signature, bkgr_corrected_results, vial.shape[1], 
+                                             persist = self.persist_response_maps)
+        return bkgr_corrected_results
+    
+    
+    def compute_response_map(self, vial: np.ndarray, vial_cropping_coords: Tuple[int, int]) -> np.ndarray:
+        template_flies = self.database.template_bank.get_templates('flies', color_mode = self.color_mode)
+        if self.background_model == 'median':
+            return MatchingEngine(vial).match_template_bank(template_flies) - self.get_background_response(vial_cropping_coords)
+        template_bkgrs = self.database.template_bank.get_templates('backgrounds', color_mode = self.color_mode)
+        if self.pyramid_factor > 1:
+            return match_coarse_to_fine(vial, template_flies, template_bkgrs, 
+                                        factor = self.pyramid_factor,
+                                        coarse_threshold = self.threshold - self.pyramid_threshold_margin,
+                                        min_distance = self.min_distance)
+        matching_engine = MatchingEngine(vial)
+        return matching_engine.match_fly_and_background_banks(template_flies, template_bkgrs)
+    
+    
+    def get_background_response(self, vial_cropping_coords: Tuple[int, int]) -> np.ndarray:
+        # Fly response of the same crop of the temporal median background: everything that doesn't move during the
+        # recording (vial walls, foam, dirt, the lighting of this recording) cancels out. Computed once per vial crop.
+        if vial_cropping_coords not in self.background_responses:
+            template_flies = self.database.template_bank.get_templates('flies', color_mode = self.color_mode)
+            background_vial = self.get_median_background()[:, vial_cropping_coords[0] - 100 : vial_cropping_coords[1] + 100]
+            self.background_responses[vial_cropping_coords] = MatchingEngine(background_vial).match_template_bank(template_flies)
+        return self.background_responses[vial_cropping_coords]
+    
+    
+    def get_median_background(self) -> np.ndarray:
+        # kept by the detector, so that matching doesn't access the FrameLoader once the frames were loaded
+        if self.median_background is None:
+            self.median_background = self.database.frame_loader.get_median_background(video_filepath = self.file_info['video_filepath'][0],
+                                                                                      last_frame_index = get_frame_index(max(TIMEPOINTS_TO_ANALYZE)),
+                                                                                      color_mode = self.color_mode)
+        return self.median_background
+    
+    
+    def get_response_map_signature(self, vial_cropping_coords: Tuple[int, int]) -> Tuple:
+        signature = (get_video_signature(self.file_info['video_filepath'][0]),
+                     vial_cropping_coords,
+                     self.color_mode,
+                     self.database.template_bank.get_signature('flies'),
+                     self.database.template_bank.get_signature('backgrounds'))
+        if self.pyramid_factor > 1:
+            # coarse-to-fine response maps are only complete around the candidates found with these settings
+            signature += (('pyramid', self.pyramid_factor, self.threshold - self.pyramid_threshold_margin, self.min_distance),)
+        if self.background_model == 'median':
+            signature += (('median_background', BACKGROUND_SAMPLE_FRAMES),)
+        return signature
+    
+    
+    def collect_response_maps(self) -> Dict[int, Tuple[np.ndarray, int]]:
+        # Response maps of all timepoints: from the cache where possible, videos are only decoded for the missing ones
+        response_maps = dict()
+        vial_localization = self.database.get_vial_localization(file_id = self.file_id, 
+                                                                video_filepath = self.file_info['video_filepath'][0], 
+                                                                color_mode = self.color_mode)
+        if (vial_localization != None) and (self.drift_check == False):
+            vial_cropping_coords = (vial_localization['min_col_idx']-self.cropping_buffer_zone, vial_localization['max_col_idx']+self.cropping_buffer_zone)
+            signature = self.get_response_map_signature(vial_cropping_coords)
+            for time_passed in self.file_info['time_passed']:
+                cached_response_map = self.database.response_map_cache.get(self.file_id, time_passed, signature)
+                if cached_response_map != None:
+                    response_maps[time_passed] = cached_response_map
+        missing_times = [time_passed for time_passed in self.file_info['time_passed'] if time_passed not in response_maps]
+        if len(missing_times) > 0:
+            images = self.get_images(missing_times)
+            for time_passed in missing_times:
+                vial_cropping_coords, response_map, vial_width = self.get_response_map(time_passed = time_passed, image = images[time_passed])
+                response_maps[time_passed] = (response_map, vial_width)
+        return response_maps
+    
+    
+    def find_flies(self, bkgr_corrected_results: np.ndarray, vial_width: int) -> Tuple[np.ndarray, np.ndarray]:
+        from skimage.feature import peak_local_max
+        flies_xy = peak_local_max(bkgr_corrected_results, min_distance=self.min_distance, threshold_abs=self.threshold)
+        all_fly_coords = (flies_xy + FLY_COORDS_OFFSET).astype(np.int32)
+        corrected_fly_coords = all_fly_coords[get_corrected_flies_mask(all_fly_coords, vial_width, self.min_climbing_height, **self.filter_criteria)]
+        return all_fly_coords, corrected_fly_coords
             
         
-
+    def get_cached_vial_cropping_info(self, image: np.ndarray, foam_template: np.ndarray) -> Tuple[int, int]:
+        # Camera and vial don't move within a recording, so the foam matching runs only for the first analyzed frame
+        video_filepath = self.file_info['video_filepath'][0]
+        vial_localization = self.database.get_vial_localization(file_id = self.file_id, video_filepath = video_filepath, color_mode = self.color_mode)
+        if vial_localization == None:
+            # all vials of the recording are localized by the same foam matching
+            vial_localizations = self.localize_vials(image, foam_template)
+            for vial_position, file_id in self.database.get_file_ids_by_vial_position(video_filepath).items():
+                self.database.set_vial_localization(file_id = file_id, 
+                                                    video_filepath = video_filepath, 
+                                                    color_mode = self.color_mode, 
+                                                    vial_localization = vial_localizations[vial_position - 1])
+            vial_localization = vial_localizations[self.vial_position - 1]
+        elif self.drift_check:
+            drift = self.get_vial_drift(image, foam_template, vial_localization)
+            return vial_localization['min_col_idx'] + drift, vial_localization['max_col_idx'] + drift
+        return vial_localization['min_col_idx'], vial_localization['max_col_idx']
+    
         
     def get_vial_cropping_info_from_foam_matching(self, image: np.ndarray, foam_template: np.ndarray) -> Tuple[int, int]:
-        foam_results = match_template(image[0:500], foam_template)
-        row_idx, col_idx = np.unravel_index(foam_results[...,0].argmax(), foam_results[...,0].shape)
-        row = foam_results[...,0][row_idx]
-        column = foam_results[...,0][:, col_idx]
-        min_col_idx, max_col_idx = self.get_boundaries(row, col_idx)
-        # Transform back to original image coordinates
-        min_col_idx += int(foam_template.shape[1]/2)
-        max_col_idx += int(foam_template.shape[1]/2)
-        return min_col_idx, max_col_idx
+        vial_localization = self.localize_vial(image, foam_template)
+        return vial_localization['min_col_idx'], vial_localization['max_col_idx']
+    
+    
+    def localize_vial(self, image: np.ndarray, foam_template: np.ndarray) -> Dict:
+        return self.localize_vials(image, foam_template)[self.vial_position - 1]
+    
+    
+    def localize_vials(self, image: np.ndarray, foam_template: np.ndarray) -> List[Dict]:
+        # Localizations of all vials in the recording, from left to right
+        foam_results = MatchingEngine(image[0:500]).match_template_bank([foam_template])
+        foam_peaks = find_foam_peaks(foam_results, n_peaks = self.vials_in_recording, min_col_distance = foam_template.shape[1])
+        if len(foam_peaks) < self.vials_in_recording:
+            raise ValueError(f'Only {len(foam_peaks)} of {self.vials_in_recording} vials could be localized in {self.file_info["video_filepath"][0]}.')
+        # the boundaries of each vial are only searched within its segment of the row, i.e. between the midpoints to
+        # the foam peaks of the neighbouring vials
+        peak_col_indices = [col_idx for row_idx, col_idx in foam_peaks]
+        segment_limits = [0] + [(left + right) // 2 for left, right in zip(peak_col_indices[:-1], peak_col_indices[1:])] + [foam_results.shape[1]]
+        vial_localizations = list()
+        for (row_idx, col_idx), segment_start, segment_stop in zip(foam_peaks, segment_limits[:-1], segment_limits[1:]):
+            min_col_idx, max_col_idx = self.get_boundaries(foam_results[row_idx, segment_start:segment_stop], col_idx - segment_start)
+            min_col_idx += segment_start
+            max_col_idx += segment_start
+            # Transform back to original image coordinates
+            min_col_idx += int(foam_template.shape[1]/2)
+            max_col_idx += int(foam_template.shape[1]/2)
+            vial_localizations.append({'min_col_idx': int(min_col_idx),
+                                       'max_col_idx': int(max_col_idx),
+                                       'foam_row_idx': int(row_idx),
+                                       'foam_col_idx': int(col_idx)})
+        return vial_localizations
+    
+    
+    def get_vial_drift(self, image: np.ndarray, foam_template: np.ndarray, vial_localization: Dict) -> int:
+        # Cheap drift check: the foam template is only matched in a narrow window around its cached position
+        row_start = max(vial_localization['foam_row_idx'] - self.max_drift, 0)
+        row_stop = min(vial_localization['foam_row_idx'] + foam_template.shape[0] + self.max_drift, 500)
+        col_start = max(vial_localization['foam_col_idx'] - self.max_drift, 0)
+        col_stop = vial_localization['foam_col_idx'] + foam_template.shape[1] + self.max_drift
+        foam_results = MatchingEngine(image[row_start:row_stop, col_start:col_stop]).match_template_bank([foam_template])
+        row_idx, col_idx = np.unravel_index(foam_results.argmax(), foam_results.shape)
+        return int(col_start + col_idx - vial_localization['foam_col_idx'])
     
     
     def get_boundaries(self, array: np.ndarray, start_index: int, half_window_size=5, tolerance_factor=10) -> Tuple[int, int]:
-        start_mean = array[start_index-half_window_size:start_index+half_window_size].mean()
-        tolerance = array[start_index-half_window_size:start_index+half_window_size].std()*tolerance_factor
-        if tolerance < 0.05:
-            tolerance = 0.05
+        return get_boundaries(array, start_index, half_window_size, tolerance_factor)
+    
+    
+def find_foam_peaks(foam_results: np.ndarray, n_peaks: int, min_col_distance: int) -> List[Tuple[int, int]]:
+    # Non-maximum suppression across the row: the best foam match is picked first and all columns closer than 
+    # min_col_distance to it are excluded before the next one is picked. Returns (row_idx, col_idx) from left to right.
+    foam_results = foam_results.astype(np.float64)
+    foam_peaks = list()
+    for _ in range(n_peaks):
+        row_idx, col_idx = np.unravel_index(foam_results.argmax(), foam_results.shape)
+        if foam_results[row_idx, col_idx] == -np.inf:
+            break
+        foam_peaks.append((int(row_idx), int(col_idx)))
+        foam_results[:, max(col_idx - min_col_distance + 1, 0) : col_idx + min_col_distance] = -np.inf
+    return sorted(foam_peaks, key = lambda foam_peak: foam_peak[1])
+
+
+def get_boundaries(array: np.ndarray, start_index: int, half_window_size=5, tolerance_factor=10) -> Tuple[int, int]:
+    start_window = array[max(start_index-half_window_size, 0):start_index+half_window_size]
+    start_mean = start_window.mean()
+    tolerance = start_window.std()*tolerance_factor
+    if tolerance < 0.05:
+        tolerance = 0.05
 
-        # get upper boundary:
-        for pixel_idx in range(start_index, array.shape[0]-half_window_size):
-            window_mean = array[pixel_idx-half_window_size:pixel_idx+half_window_size].mean()
-            if start_mean - window_mean > tolerance:
-                    break
-        max_idx = pixel_idx + half_window_size
+    # Means of all complete windows array[center-half_window_size:center+half_window_size] at once,
+    # window_means[i] belongs to center = i + half_window_size
+    cumulative_sum = np.concatenate([[0], np.cumsum(array, dtype=np.float64)])
+    window_means = (cumulative_sum[2*half_window_size:] - cumulative_sum[:-2*half_window_size]) / (2*half_window_size)
+    centers = np.arange(half_window_size, half_window_size + window_means.shape[0])
+    drops_below_tolerance = start_mean - window_means > tolerance
 
-        # get lower boundary:
-        for pixel_idx in range(start_index):
-            window_mean = array[start_index-pixel_idx-half_window_size:start_index-pixel_idx+half_window_size].mean()
-            if start_mean - window_mean > tolerance:
-                    break
-        min_idx = start_index - pixel_idx - half_window_size
+    # get upper boundary (first drop at or after the start, the end of the array if there is none):
+    upper_candidates = (centers >= start_index) & (centers < array.shape[0] - half_window_size) & drops_below_tolerance
+    if upper_candidates.any():
+        max_idx = int(centers[upper_candidates][0]) + half_window_size
+    else:
+        max_idx = array.shape[0] - 1
 
-        return min_idx, max_idx
+    # get lower boundary (first drop at or before the start, the beginning of the array if there is none):
+    lower_candidates = (centers <= start_index) & (centers > 0) & drops_below_tolerance
+    if lower_candidates.any():
+        min_idx = int(centers[lower_candidates][-1]) - half_window_size
+    else:
+        min_idx = 0
+
+    return min_idx, max_idx
+
+
+def get_corrected_flies_mask(fly_coords: np.ndarray, vial_width: int, min_climbing_height: int, vial_margin: int=VIAL_MARGIN, 
+                             max_climbing_height: Optional[int]=None, roi_polygon: Optional[List[List[int]]]=None) -> np.ndarray:
+    corrected_flies_mask = (vial_margin < fly_coords[:, 1]) & (fly_coords[:, 1] < vial_width - vial_margin)
+    corrected_flies_mask &= fly_coords[:, 0] < min_climbing_height
+    if max_climbing_height != None:
+        corrected_flies_mask &= fly_coords[:, 0] > max_climbing_height
+    if roi_polygon != None:
+        corrected_flies_mask &= get_points_in_polygon_mask(points = fly_coords, polygon = np.asarray(roi_polygon))
+    return corrected_flies_mask
+
+
+def get_points_in_polygon_mask(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    # Even-odd rule: a point lies inside the polygon if a ray from the point towards increasing columns crosses its edges 
+    # an odd number of times. Evaluated for all points and all edges at once.
+    point_rows, point_cols = points[:, 0:1].astype(np.float64), points[:, 1:2].astype(np.float64)
+    edge_starts, edge_ends = polygon.astype(np.float64), np.roll(polygon, -1, axis=0).astype(np.float64)
+    edge_spans_point_row = (edge_starts[:, 0] > point_rows) != (edge_ends[:, 0] > point_rows)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        edge_cols_at_point_row = edge_starts[:, 1] + (point_rows - edge_starts[:, 0]) * (edge_ends[:, 1] - edge_starts[:, 1]) / (edge_ends[:, 0] - edge_starts[:, 0])
+    edge_crossings = edge_spans_point_row & (point_cols < edge_cols_at_point_row)
+    return edge_crossings.sum(axis=1) % 2 == 1
+
+
+def sweep_response_map(bkgr_corrected_results: np.ndarray, vial_width: int, 
+                       thresholds: List[float], min_distances: List[int], min_climbing_heights: List[int], **filter_criteria) -> List[Dict]:
+    # With a fixed min_distance, the peaks found for a higher threshold are exactly the peaks found for the lowest 
+    # threshold whose response exceeds the higher one. peak_local_max therefore only runs once per min_distance.
+    from skimage.feature import peak_local_max
+    sweep_results = list()
+    for min_distance in min_distances:
+        flies_xy = peak_local_max(bkgr_corrected_results, min_distance=min_distance, threshold_abs=min(thresholds))
+        peak_responses = bkgr_corrected_results[flies_xy[:, 0], flies_xy[:, 1]]
+        all_fly_coords = (flies_xy + FLY_COORDS_OFFSET).astype(np.int32)
+        corrected_flies_masks = {min_climbing_height: get_corrected_flies_mask(all_fly_coords, vial_width, min_climbing_height, **filter_criteria)
+                                 for min_climbing_height in min_climbing_heights}
+        for threshold in thresholds:
+            above_threshold = peak_responses > threshold
+            for min_climbing_height in min_climbing_heights:
+                sweep_results.append({'threshold': threshold,
+                                      'min_distance': min_distance,
+                                      'min_climbing_height': min_climbing_height,
+                                      'all_detected_flies': int(above_threshold.sum()),
+                                      'corrected_detected_flies': int((above_threshold & corrected_flies_masks[min_climbing_height]).sum())})
+    return sweep_results
+
+
+# Each worker process of a parallel detection run creates its own Database once, 
+# so that the template bank and the frame loader are set up only once per process.
+_worker_database = None
+
+
+def init_detection_worker(root_dir: str):
+    global _worker_database
+    _worker_database = Database(root_dir)
+
+
+def detect_flies_in_worker(file_id: str, file_info: Dict, detector_kwargs: Dict, vial_localization: Optional[Dict]) -> Dict:
+    if len(file_info['file_id']) == 0:
+        raise ValueError(f'There is no recording with file_id: {file_id} in the database.')
+    _worker_database.set_file_infos(file_infos = file_info)
+    if vial_localization != None:
+        _worker_database.vial_localizations[file_id] = vial_localization
+    start_time = time.time()
+    fly_detector = FlyDetector(file_id = file_id, database = _worker_database, **detector_kwargs)
+    all_detection_results = fly_detector.analyze()
+    return {'all_detection_results': all_detection_results,
+            'vial_localization': _worker_database.vial_localizations.get(file_id),
+            'duration': time.time() - start_time}
     
     
 class InspectDetectedFlies:
@@ -162,31 +508,44 @@ class InspectDetectedFlies:
         self.index = index
         self.database = database        
         self.file_info = self.database.get_file_info_df(index = self.index)
+        self.file_id = self.file_info['file_id'][0]
         
     def plot_results(self):
-        fly_coords = np.asarray(self.file_info['corrected_fly_coords'][0])
+        import matplotlib.pyplot as plt
+        fly_coords = np.asarray(self.file_info['corrected_fly_coords'][0]).reshape(-1, 2)
         vial_cropping_coords = self.file_info['vial_cropping_coords'][0]
-        frame_index = self.file_info['time_passed'][0]*30
+        time_passed = self.file_info['time_passed'][0]
         detection_configs = self.file_info['detection_configs'][0]
         
-
-        reader = iio.get_reader(self.file_info['video_filepath'][0])
-        image = reader.get_data(frame_index)
-        reader.close()
-        
-        vial = image[200:1000, vial_cropping_coords[0] - 100 : vial_cropping_coords[1] + 100]
+        vial = self.get_vial(time_passed, vial_cropping_coords)
         
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15,15))
         ax1.imshow(vial)
         ax2.imshow(vial)
         ax2.scatter(fly_coords[:, 1], fly_coords[:, 0])
-        ax2.vlines(x=[100, vial.shape[1] - 100], 
+        vial_margin = detection_configs.get('vial_margin', VIAL_MARGIN)
+        ax2.vlines(x=[vial_margin, vial.shape[1] - vial_margin], 
                    ymin=detection_configs['min_climbing_height'], 
                    ymax=5)
         ax2.hlines(y=[5, detection_configs['min_climbing_height']],
-                   xmin=100, 
-                   xmax=vial.shape[1] - 100)
+                   xmin=vial_margin, 
+                   xmax=vial.shape[1] - vial_margin)
+        if detection_configs.get('roi_polygon') != None:
+            roi_polygon = np.asarray(detection_configs['roi_polygon'] + detection_configs['roi_polygon'][:1])
+            ax2.plot(roi_polygon[:, 1], roi_polygon[:, 0])
         plt.show()
-        
-        
-        
\ No newline at end of file
+
+
+    def get_vial(self, time_passed: int, vial_cropping_coords: Tuple) -> np.ndarray:
+        # Served from the frame cache of the detection if possible. Otherwise, all analyzed timepoints of the video 
+        # are decoded at once, so inspecting the other timepoints afterwards is served from memory
+        video_filepath = self.file_info['video_filepath'][0]
+        col_range = (vial_cropping_coords[0] - 100, vial_cropping_coords[1] + 100)
+        cached_frames = self.database.frame_cache.get(self.file_id, 'rgb', get_video_signature(video_filepath))
+        if cached_frames != None:
+            regions, (row_offset, col_offset) = cached_frames
+            if ((time_passed in regions) and (col_range[0] >= col_offset) and (col_range[1] <= col_offset + regions[time_passed].shape[1])):
+                return regions[time_passed][VIAL_REGION_ROWS[0] - row_offset : VIAL_REGION_ROWS[1] - row_offset, 
+                                            col_range[0] - col_offset : col_range[1] - col_offset]
+        images = self.database.frame_loader.get_frames(video_filepath = video_filepath, times_passed = TIMEPOINTS_TO_ANALYZE)
+        return images[time_passed][VIAL_REGION_ROWS[0] : VIAL_REGION_ROWS[1], col_range[0] : col_range[1]]
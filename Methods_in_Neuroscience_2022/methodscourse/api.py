@@ -1,26 +1,36 @@
-from .database import Database, list_no_hidden
-from .analysis import FlyDetector, InspectDetectedFlies
+from .database import Database
+from .analysis import FlyDetector, InspectDetectedFlies, init_detection_worker, detect_flies_in_worker, sweep_response_map, VIAL_MARGIN
+from .analysis import CROPPING_BUFFER_ZONE, MIN_DISTANCE, THRESHOLD, MIN_CLIMBING_HEIGHT
+from .matching import PYRAMID_THRESHOLD_MARGIN
+from .tracking import FlyTracker, MAX_LINKING_DISTANCE, MAX_GAP_FRAMES, MIN_TRAJECTORY_LENGTH
+from .pipeline import DetectionPipeline, FLUSH_EVERY, QUEUE_DEPTH
+from .conversion import RemuxWorker, list_recordings_to_remux
 
-import os
-from typing import List, Optional
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 
-CROPPING_BUFFER_ZONE = 50
-MIN_DISTANCE = 25
-THRESHOLD = 0.25
-MIN_CLIMBING_HEIGHT = 600 
+COLOR_MODE = 'rgb'
 
 
 class API:
     
     def __init__(self, root_dir: str):
         self.database = Database(root_dir)
+        self.remux_worker = RemuxWorker()
         
 
-    def record_experiment(self, group_id: str, vial_id: int, stimulus_indicator: str):
-        from .recording import Recorder
-        recorder = Recorder(database=self.database)
-        self.database = recorder.start_recording(group_id=group_id, vial_id=vial_id, stimulus_indicator=stimulus_indicator)
+    def record_experiment(self, group_id: str, vial_id: Union[int, List[int]], stimulus_indicator: str, live_count: bool=False, 
+                          camera_factory: Optional[Callable]=None, remux: bool=True):
+        # vial_id: a list of vial_ids (from left to right) records several vials at once, each vial gets its own file_id
+        # live_count=True stores preliminary fly counts of the analyzed timepoints in database.live_counts during the recording,
+        # remux=True converts the recording to mp4 in the background, so that it is ready for the analysis
+        from .recording import Recorder, create_pi_camera
+        recorder = Recorder(database=self.database, 
+                            camera_factory=camera_factory if camera_factory != None else create_pi_camera,
+                            remux_worker=self.remux_worker if remux else None)
+        self.database = recorder.start_recording(group_id=group_id, vial_id=vial_id, stimulus_indicator=stimulus_indicator, live_count=live_count)
         
         
     def detect_flies(self, 
@@ -30,23 +40,323 @@ class API:
                      threshold: float=THRESHOLD, 
                      min_distance: int=MIN_DISTANCE,
                      overwrite: bool=False,
-                     quick_view: bool=False):
+                     quick_view: bool=False,
+                     workers: int=1,
+                     color_mode: str=COLOR_MODE,
+                     drift_check: bool=False,
+                     persist_response_maps: bool=False,
+                     vial_margin: int=VIAL_MARGIN,
+                     max_climbing_height: Optional[int]=None,
+                     roi_polygon: Optional[List[Tuple[int, int]]]=None,
+                     use_frame_cache: bool=False,
+                     pyramid_factor: int=1,
+                     background_model: str='templates',
+                     streaming: bool=False,
+                     flush_every: int=FLUSH_EVERY,
+                     queue_depth: int=QUEUE_DEPTH,
+                     prefix: str='',
+                     progress_callback: Optional[Callable]=None):
+        # pyramid_factor > 1 enables the faster coarse-to-fine matching (2 is recommended), compare_pyramid_detection reports 
+        # its deviations from the exhaustive matching.
+        # background_model='median' subtracts the fly response of the temporal median background of each video instead of
+        # the response of the background templates, so it adapts to the lighting of every recording. Flies that don't
+        # move at all during the recording become part of the background and are not detected.
+        # use_frame_cache: the vial regions of the decoded frames are kept in results/frame_cache/ (memory-mapped when read, 
+        # about 8 MB per recording and color mode, see clear_frame_cache) and repeated detections of a recording don't 
+        # decode its video again.
+        # progress_callback(file_id, duration, error) is called whenever a file is completed. Files that fail are listed with
+        # their error in self.failed_file_ids and the detection continues with the next file.
+        # streaming=True runs the memory-bounded DetectionPipeline instead, which saves the results (with the given prefix) 
+        # every "flush_every" files and resumes from its checkpoint when it is started again with the same settings
+        if streaming and (workers > 1):
+            raise ValueError('"streaming" runs all stages in a single process and can not be combined with "workers" > 1.')
         
-        if hasattr(self.database, 'file_infos') == False:
-            self.database.prepare_database_for_analysis()
+        # recordings that are still being converted to mp4 would be missing otherwise
+        self.remux_worker.wait()
+        self.database.prepare_database_for_analysis()
         
+        detector_kwargs = {'cropping_buffer_zone': cropping_buffer_zone, 
+                           'min_climbing_height': min_climbing_height, 
+                           'threshold': threshold, 
+                           'min_distance': min_distance,
+                           'overwrite': overwrite,
+                           'quick_view': quick_view,
+                           'color_mode': color_mode,
+                           'drift_check': drift_check,
+                           'persist_response_maps': persist_response_maps,
+                           'vial_margin': vial_margin,
+                           'max_climbing_height': max_climbing_height,
+                           'roi_polygon': roi_polygon,
+                           'use_frame_cache': use_frame_cache,
+                           'pyramid_factor': pyramid_factor,
+                           'background_model': background_model}
+        if streaming:
+            detection_pipeline = DetectionPipeline(database = self.database, detector_kwargs = detector_kwargs, 
+                                                   flush_every = flush_every, queue_depth = queue_depth, prefix = prefix,
+                                                   progress_callback = progress_callback)
+            self.database = detection_pipeline.run(file_ids = file_ids)
+            self.failed_file_ids = detection_pipeline.failed_file_ids
+        elif workers > 1:
+            self.detect_flies_in_parallel(file_ids = file_ids, detector_kwargs = detector_kwargs, workers = workers, progress_callback = progress_callback)
+        else:
+            self.failed_file_ids = dict()
+            for file_id in file_ids:
+                start_time = time.time()
+                try:
+                    fly_detector = FlyDetector(file_id = file_id, database = self.database, **detector_kwargs)
+                    self.database = fly_detector.run()
+                except Exception as error:
+                    self.register_failed_file(file_id = file_id, error = error, progress_callback = progress_callback)
+                    continue
+                if progress_callback != None:
+                    progress_callback(file_id, time.time() - start_time, None)
+
+    
+    def track_flies(self, 
+                    file_ids: List,
+                    frame_step: int=1,
+                    workers: Optional[int]=None,
+                    cropping_buffer_zone: int=CROPPING_BUFFER_ZONE, 
+                    min_climbing_height: int=MIN_CLIMBING_HEIGHT, 
+                    threshold: float=THRESHOLD, 
+                    min_distance: int=MIN_DISTANCE,
+                    color_mode: str=COLOR_MODE,
+                    pyramid_factor: int=1,
+                    background_model: str='templates',
+                    max_linking_distance: float=MAX_LINKING_DISTANCE,
+                    max_gap_frames: int=MAX_GAP_FRAMES,
+                    min_trajectory_length: int=MIN_TRAJECTORY_LENGTH):
+        # Tracks the flies through all frames (or every frame_step-th) of the recordings. Trajectories are stored in
+        # database.trajectories, the climbing speed (pixels per second) and the time to min_climbing_height (seconds) 
+        # of every tracked fly in the "climbing_speeds" and "times_to_threshold" columns. workers: threads per video
+        # (default: number of CPUs). max_linking_distance is in pixels between two tracked frames.
+        self.remux_worker.wait()
+        self.database.prepare_database_for_analysis()
+        for file_id in file_ids:
+            fly_tracker = FlyTracker(file_id = file_id, database = self.database,
+                                     frame_step = frame_step,
+                                     max_linking_distance = max_linking_distance,
+                                     max_gap_frames = max_gap_frames,
+                                     min_trajectory_length = min_trajectory_length,
+                                     workers = workers,
+                                     cropping_buffer_zone = cropping_buffer_zone,
+                                     min_climbing_height = min_climbing_height,
+                                     threshold = threshold,
+                                     min_distance = min_distance,
+                                     color_mode = color_mode,
+                                     pyramid_factor = pyramid_factor,
+                                     background_model = background_model)
+            self.database = fly_tracker.run()
+
+    
+    def convert_recordings(self, wait: bool=True):
+        # Converts all .h264 recordings without a corresponding mp4 (e.g. from earlier sessions) 
+        h264_filepaths = list_recordings_to_remux(recordings_dir = self.database.recordings_dir)
+        for h264_filepath in h264_filepaths:
+            self.remux_worker.submit(h264_filepath)
+        if wait:
+            self.remux_worker.wait()
+            print(f'Converted {len(h264_filepaths) - len(set(h264_filepaths) & set(self.remux_worker.failed_filepaths))} '
+                  f'of {len(h264_filepaths)} recordings to mp4.')
+
+    
+    def detect_flies_in_parallel(self, file_ids: List, detector_kwargs: Dict, workers: int, progress_callback: Optional[Callable]=None):
+        self.failed_file_ids = dict()
+        with ProcessPoolExecutor(max_workers = workers, 
+                                 initializer = init_detection_worker, 
+                                 initargs = (self.database.root_dir, )) as executor:
+            futures = dict()
+            for file_id in file_ids:
+                file_info = self.database.get_file_info_df(file_id = file_id)
+                vial_localization = self.database.vial_localizations.get(file_id)
+                futures[file_id] = executor.submit(detect_flies_in_worker, file_id, file_info, detector_kwargs, vial_localization)
+            # Results are merged in the order of file_ids (not in order of completion) to keep the database deterministic
+            for file_id in file_ids:
+                try:
+                    worker_results = futures[file_id].result()
+                except Exception as error:
+                    self.register_failed_file(file_id = file_id, error = error, progress_callback = progress_callback)
+                    continue
+                for detection_results in worker_results['all_detection_results']:
+                    self.database.add_detected_flies(file_id = file_id, **detection_results)
+                if worker_results['vial_localization'] != None:
+                    self.database.vial_localizations[file_id] = worker_results['vial_localization']
+                if progress_callback != None:
+                    progress_callback(file_id, worker_results['duration'], None)
+
+
+    def register_failed_file(self, file_id: str, error: Exception, progress_callback: Optional[Callable]=None):
+        # a failed file doesn't stop the detection of the others, it is listed in self.failed_file_ids instead
+        self.failed_file_ids[file_id] = repr(error)
+        print(f'Fly detection failed for file_id: {file_id} ({repr(error)}) - continue with next file.')
+        if progress_callback != None:
+            progress_callback(file_id, None, repr(error))
+
+            
+    def sweep_detection(self, 
+                        param_grid: Dict[str, List],
+                        file_ids: Optional[List]=None,
+                        cropping_buffer_zone: int=CROPPING_BUFFER_ZONE,
+                        color_mode: str=COLOR_MODE,
+                        persist_response_maps: bool=False,
+                        vial_margin: int=VIAL_MARGIN,
+                        max_climbing_height: Optional[int]=None,
+                        roi_polygon: Optional[List[Tuple[int, int]]]=None,
+                        use_frame_cache: bool=False) -> Dict:
+        # Re-runs only the peak finding and filtering for all combinations of "threshold", "min_distance" and 
+        # "min_climbing_height" in param_grid, based on the cached template matching results. Nothing is stored in the database.
+        unknown_params = set(param_grid.keys()) - {'threshold', 'min_distance', 'min_climbing_height'}
+        if len(unknown_params) > 0:
+            raise ValueError(f'Only "threshold", "min_distance" and "min_climbing_height" can be swept, not: {sorted(unknown_params)}')
+        thresholds = list(param_grid.get('threshold', [THRESHOLD]))
+        min_distances = list(param_grid.get('min_distance', [MIN_DISTANCE]))
+        min_climbing_heights = list(param_grid.get('min_climbing_height', [MIN_CLIMBING_HEIGHT]))
+        
+        self.database.prepare_database_for_analysis()
+        if file_ids == None:
+            file_ids = sorted(self.database.row_positions_by_file_id.keys())
+        # response maps of videos that are no longer available can not be computed (and are only cached for a while)
+        unavailable_file_ids = [file_id for file_id in file_ids
+                                if any(self.database.file_infos['video_available'][row_position] == False
+                                       for row_position in self.database.row_positions_by_file_id.get(file_id, list()))]
+        for file_id in unavailable_file_ids:
+            print(f'The video of file_id: {file_id} is no longer available - continue with next file.')
+        file_ids = [file_id for file_id in file_ids if file_id not in unavailable_file_ids]
+        start_time = time.time()
+        sweep_results = {'file_id': list(),
+                         'time_passed': list(),
+                         'threshold': list(),
+                         'min_distance': list(),
+                         'min_climbing_height': list(),
+                         'all_detected_flies': list(),
+                         'corrected_detected_flies': list()}
         for file_id in file_ids:
             fly_detector = FlyDetector(file_id = file_id, 
                                        database = self.database,
                                        cropping_buffer_zone = cropping_buffer_zone, 
-                                       min_climbing_height = min_climbing_height, 
-                                       threshold = threshold, 
-                                       min_distance = min_distance,
-                                       overwrite = overwrite,
-                                       quick_view = quick_view)
-            self.database = fly_detector.run()
-
+                                       min_climbing_height = MIN_CLIMBING_HEIGHT, 
+                                       threshold = THRESHOLD, 
+                                       min_distance = MIN_DISTANCE,
+                                       overwrite = True,
+                                       quick_view = False,
+                                       color_mode = color_mode,
+                                       persist_response_maps = persist_response_maps,
+                                       vial_margin = vial_margin,
+                                       max_climbing_height = max_climbing_height,
+                                       roi_polygon = roi_polygon,
+                                       use_frame_cache = use_frame_cache)
+            for time_passed, (bkgr_corrected_results, vial_width) in sorted(fly_detector.collect_response_maps().items()):
+                for setting_results in sweep_response_map(bkgr_corrected_results, vial_width, thresholds, min_distances, min_climbing_heights,
+                                                          **fly_detector.filter_criteria):
+                    sweep_results['file_id'].append(file_id)
+                    sweep_results['time_passed'].append(time_passed)
+                    for key, value in setting_results.items():
+                        sweep_results[key].append(value)
+        print(f'Swept {len(thresholds) * len(min_distances) * len(min_climbing_heights)} settings for {len(file_ids)} file IDs '
+              f'in {round(time.time() - start_time, 2)} seconds.')
+        return sweep_results
+    
+    
+    def compare_color_modes(self, 
+                            file_ids: List,
+                            color_mode: str='luminance',
+                            cropping_buffer_zone: int=CROPPING_BUFFER_ZONE, 
+                            min_climbing_height: int=MIN_CLIMBING_HEIGHT, 
+                            threshold: float=THRESHOLD, 
+                            min_distance: int=MIN_DISTANCE) -> Dict:
+        # Validation run: detects flies with the full RGB frames and with the single-channel representation,
+        # without touching the results stored in the database, and reports the differences in fly counts.
+        self.database.prepare_database_for_analysis()
+            
+        comparison = {'file_id': list(),
+                      'time_passed': list(),
+                      'rgb_detected_flies': list(),
+                      'single_channel_detected_flies': list(),
+                      'difference': list()}
+        for file_id in file_ids:
+            detection_results_per_mode = dict()
+            for mode in ['rgb', color_mode]:
+                fly_detector = FlyDetector(file_id = file_id, 
+                                           database = self.database,
+                                           cropping_buffer_zone = cropping_buffer_zone, 
+                                           min_climbing_height = min_climbing_height, 
+                                           threshold = threshold, 
+                                           min_distance = min_distance,
+                                           overwrite = True,
+                                           quick_view = False,
+                                           color_mode = mode)
+                detection_results_per_mode[mode] = fly_detector.analyze()
+            for rgb_results, single_channel_results in zip(detection_results_per_mode['rgb'], detection_results_per_mode[color_mode]):
+                comparison['file_id'].append(file_id)
+                comparison['time_passed'].append(rgb_results['time_passed'])
+                comparison['rgb_detected_flies'].append(len(rgb_results['corrected_fly_coords']))
+                comparison['single_channel_detected_flies'].append(len(single_channel_results['corrected_fly_coords']))
+                comparison['difference'].append(comparison['single_channel_detected_flies'][-1] - comparison['rgb_detected_flies'][-1])
+        
+        differing_entries = [difference for difference in comparison['difference'] if difference != 0]
+        print(f'Compared "{color_mode}" to "rgb" for {len(comparison["difference"])} timepoints: '
+              f'{len(differing_entries)} with different fly counts '
+              f'(max. absolute difference: {max([abs(difference) for difference in comparison["difference"]], default=0)}).')
+        return comparison
+        
+        
+    def compare_pyramid_detection(self, 
+                                  file_ids: List,
+                                  pyramid_factor: int=2,
+                                  pyramid_threshold_margin: float=PYRAMID_THRESHOLD_MARGIN,
+                                  cropping_buffer_zone: int=CROPPING_BUFFER_ZONE, 
+                                  min_climbing_height: int=MIN_CLIMBING_HEIGHT, 
+                                  threshold: float=THRESHOLD, 
+                                  min_distance: int=MIN_DISTANCE,
+                                  color_mode: str=COLOR_MODE) -> Dict:
+        # Validation run: matches every vial exhaustively and coarse-to-fine (bypassing the response map cache, so 
+        # that both are timed), without touching the results stored in the database. Reports the flies that are 
+        # missed or additionally found by the coarse-to-fine matching and the durations of both.
+        self.database.prepare_database_for_analysis()
             
+        comparison = {'file_id': list(),
+                      'time_passed': list(),
+                      'exhaustive_detected_flies': list(),
+                      'pyramid_detected_flies': list(),
+                      'missed_flies': list(),
+                      'additional_flies': list(),
+                      'exhaustive_duration': list(),
+                      'pyramid_duration': list()}
+        for file_id in file_ids:
+            fly_detectors = dict()
+            for mode, factor in [('exhaustive', 1), ('pyramid', pyramid_factor)]:
+                fly_detectors[mode] = FlyDetector(file_id = file_id, 
+                                                  database = self.database,
+                                                  cropping_buffer_zone = cropping_buffer_zone, 
+                                                  min_climbing_height = min_climbing_height, 
+                                                  threshold = threshold, 
+                                                  min_distance = min_distance,
+                                                  overwrite = True,
+                                                  quick_view = False,
+                                                  color_mode = color_mode,
+                                                  pyramid_factor = factor,
+                                                  pyramid_threshold_margin = pyramid_threshold_margin)
+            for time_passed, image in fly_detectors['exhaustive'].load_images().items():
+                vial_cropping_coords, vial = fly_detectors['exhaustive'].crop_vial(image = image)
+                corrected_fly_coords = dict()
+                for mode, fly_detector in fly_detectors.items():
+                    start_time = time.perf_counter()
+                    bkgr_corrected_results = fly_detector.compute_response_map(vial, vial_cropping_coords)
+                    comparison[f'{mode}_duration'].append(time.perf_counter() - start_time)
+                    corrected_fly_coords[mode] = set(map(tuple, fly_detector.find_flies(bkgr_corrected_results, vial.shape[1])[1]))
+                    comparison[f'{mode}_detected_flies'].append(len(corrected_fly_coords[mode]))
+                comparison['file_id'].append(file_id)
+                comparison['time_passed'].append(time_passed)
+                comparison['missed_flies'].append(len(corrected_fly_coords['exhaustive'] - corrected_fly_coords['pyramid']))
+                comparison['additional_flies'].append(len(corrected_fly_coords['pyramid'] - corrected_fly_coords['exhaustive']))
+        
+        print(f'Compared coarse-to-fine (factor {pyramid_factor}) to exhaustive matching for {len(comparison["file_id"])} timepoints: '
+              f'{sum(comparison["missed_flies"])} of {sum(comparison["exhaustive_detected_flies"])} flies missed, '
+              f'{sum(comparison["additional_flies"])} additional flies, '
+              f'{round(sum(comparison["exhaustive_duration"]) / max(sum(comparison["pyramid_duration"]), 1e-9), 1)}x faster matching.')
+        return comparison
+        
+        
     def inspect_detection_quality(self, index: Optional[str]=None, file_id: Optional[str]=None, time_passed: Optional[int]=None):
         if type(index) == str:
             self.index = index
@@ -66,6 +376,11 @@ class API:
         stats_plotter.show_results(save=save, show=show)
     
     
+    def clear_frame_cache(self):
+        # removes all vial regions in results/frame_cache/ (use_frame_cache=True of detect_flies and sweep_detection)
+        self.database.frame_cache.clear()
+        
+        
     def save_results(self, prefix: str=''):
         self.database.save_file_infos(prefix = prefix)
         
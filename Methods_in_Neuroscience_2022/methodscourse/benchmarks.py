@@ -0,0 +1,350 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+from .database import Database, TIMEPOINTS_TO_ANALYZE, FILE_INFO_KEYS, RESULT_KEYS, TRACKING_KEYS
+from .frames import FRAMES_PER_SECOND, VIAL_REGION_ROWS, get_frame_index
+from .templates import FOAM_TEMPLATE_FILENAME
+
+from typing import Dict, List, Tuple
+
+
+# Modules that must not be loaded by "import methodscourse.api" - they are only imported once detection, plotting or stats are used
+LAZY_MODULES = ['skimage', 'imageio', 'pandas', 'matplotlib', 'seaborn', 'pingouin', 'scipy', 'ipywidgets']
+
+# Synthetic recordings: frame size of the Pi camera (height padded to the macro block size of the encoder), 
+# gray background with a brighter vial of SYNTHETIC_VIAL_WIDTH pixels and the foam band on top of it
+SYNTHETIC_FRAME_SHAPE = (1088, 1920, 3)
+SYNTHETIC_VIAL_WIDTH = 300
+SYNTHETIC_FOAM_ROWS = (100, 160)
+# detected flies count as found if they are at most this many pixels away from a planted fly
+RECALL_TOLERANCE = 5
+
+
+def create_synthetic_file_infos(n_rows: int) -> Dict:
+    file_infos = {key: list() for key in FILE_INFO_KEYS}
+    for row in range(n_rows):
+        file_number = row // len(TIMEPOINTS_TO_ANALYZE)
+        file_infos['index'].append(str(row).zfill(4))
+        file_infos['file_id'].append(str(file_number).zfill(6))
+        file_infos['group_id'].append('wt')
+        file_infos['stimulus_indicator'].append('pre')
+        file_infos['vial_id'].append('_001')
+        file_infos['vial_position'].append(1)
+        file_infos['time_passed'].append(TIMEPOINTS_TO_ANALYZE[row % len(TIMEPOINTS_TO_ANALYZE)])
+        file_infos['video_filepath'].append(f'{str(file_number).zfill(6)}_wt_pre_light_001.mp4')
+        file_infos['video_available'].append(True)
+        for key in RESULT_KEYS + TRACKING_KEYS:
+            file_infos[key].append(None)
+    return file_infos
+
+
+def benchmark_database_lookups(row_counts: List[int]=[100, 1000, 10000, 100000], calls_per_row_count: int=1000) -> Dict:
+    # Per-call cost of the indexed Database lookups; it should stay flat with a growing number of rows
+    benchmark_results = {'n_rows': list(),
+                         'add_detected_flies_us': list(),
+                         'get_file_info_df_by_file_id_us': list(),
+                         'get_file_info_df_by_index_us': list()}
+    fly_coords = np.zeros((10, 2), dtype=np.int32)
+    with tempfile.TemporaryDirectory() as root_dir:
+        database = Database(root_dir + '/')
+        for n_rows in row_counts:
+            database.set_file_infos(file_infos = create_synthetic_file_infos(n_rows = n_rows))
+            rng = np.random.default_rng(42)
+            row_positions = rng.integers(0, n_rows, calls_per_row_count)
+            file_ids = [database.file_infos['file_id'][row_position] for row_position in row_positions]
+            times_passed = [database.file_infos['time_passed'][row_position] for row_position in row_positions]
+            indices = [database.file_infos['index'][row_position] for row_position in row_positions]
+
+            start_time = time.perf_counter()
+            for file_id, time_passed in zip(file_ids, times_passed):
+                database.add_detected_flies(file_id = file_id, time_passed = time_passed, all_fly_coords = fly_coords, 
+                                            vial_cropping_coords = (800, 1100), corrected_fly_coords = fly_coords, detection_configs = dict())
+            add_detected_flies_duration = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            for file_id in file_ids:
+                database.get_file_info_df(file_id = file_id)
+            get_by_file_id_duration = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            for index in indices:
+                database.get_file_info_df(index = index)
+            get_by_index_duration = time.perf_counter() - start_time
+
+            benchmark_results['n_rows'].append(n_rows)
+            benchmark_results['add_detected_flies_us'].append(add_detected_flies_duration / calls_per_row_count * 1e6)
+            benchmark_results['get_file_info_df_by_file_id_us'].append(get_by_file_id_duration / calls_per_row_count * 1e6)
+            benchmark_results['get_file_info_df_by_index_us'].append(get_by_index_duration / calls_per_row_count * 1e6)
+            print(f'{n_rows:>7} rows: add_detected_flies {benchmark_results["add_detected_flies_us"][-1]:.1f} us/call, '
+                  f'get_file_info_df(file_id) {benchmark_results["get_file_info_df_by_file_id_us"][-1]:.1f} us/call, '
+                  f'get_file_info_df(index) {benchmark_results["get_file_info_df_by_index_us"][-1]:.1f} us/call')
+    return benchmark_results
+
+
+def create_synthetic_stats_file_infos(n_rows: int, vials_per_group: int=20) -> Dict:
+    rng = np.random.default_rng(42)
+    file_infos = {'group_id': list(), 'stimulus_indicator': list(), 'vial_id': list(), 'time_passed': list(), 'corrected_detected_flies': list()}
+    for row in range(n_rows):
+        file_number = row // len(TIMEPOINTS_TO_ANALYZE)
+        file_infos['group_id'].append(['wt', 'tg'][file_number % 2])
+        file_infos['stimulus_indicator'].append(['pre', 'post'][(file_number // 2) % 2])
+        file_infos['vial_id'].append(f'_{str((file_number // 4) % vials_per_group + 1).zfill(3)}')
+        file_infos['time_passed'].append(TIMEPOINTS_TO_ANALYZE[row % len(TIMEPOINTS_TO_ANALYZE)])
+        file_infos['corrected_detected_flies'].append(int(rng.integers(0, 30)) if rng.random() > 0.05 else None)
+    return file_infos
+
+
+def benchmark_stats_preprocessing(row_counts: List[int]=[1000, 10000, 100000, 1000000]) -> Dict:
+    # Runtime of the groupby based preprocessing (see tests/test_stats_and_plots.py for its comparison with the former per-vial version)
+    from .stats_and_plots import preprocess_file_infos
+    benchmark_results = {'n_rows': list(), 'duration_s': list()}
+    for n_rows in row_counts:
+        file_infos = create_synthetic_stats_file_infos(n_rows = n_rows)
+        start_time = time.perf_counter()
+        preprocess_file_infos(file_infos = file_infos)
+        benchmark_results['n_rows'].append(n_rows)
+        benchmark_results['duration_s'].append(time.perf_counter() - start_time)
+        print(f'{n_rows:>7} rows: {benchmark_results["duration_s"][-1]:.3f} s')
+    return benchmark_results
+
+
+def draw_fly(image: np.ndarray, center_row: int, center_col: int):
+    # dark body with slightly brighter wings, 14 x 30 pixels
+    image[center_row - 7 : center_row + 7, center_col - 10 : center_col + 10] = 40
+    image[center_row - 3 : center_row + 3, center_col - 15 : center_col - 10] = 70
+    image[center_row - 3 : center_row + 3, center_col + 10 : center_col + 15] = 70
+
+
+def create_synthetic_templates(templates_dir: str, rng: np.random.Generator):
+    import imageio.v2 as iio
+    for category in ['flies', 'backgrounds', 'foam']:
+        os.makedirs(f'{templates_dir}{category}/', exist_ok = True)
+    for i in range(3):
+        fly = np.full((30, 40, 3), 180, dtype=np.int32)
+        draw_fly(fly, 15, 20)
+        iio.imwrite(f'{templates_dir}flies/{str(i).zfill(3)}_fly.png', np.clip(fly + rng.integers(-10, 10, fly.shape), 0, 255).astype(np.uint8))
+    for i in range(2):
+        iio.imwrite(f'{templates_dir}backgrounds/{str(i).zfill(3)}_bkgr.png', np.clip(180 + rng.integers(-20, 20, (30, 40, 3)), 0, 255).astype(np.uint8))
+    iio.imwrite(f'{templates_dir}foam/{FOAM_TEMPLATE_FILENAME}', create_synthetic_foam())
+
+
+def create_synthetic_foam() -> np.ndarray:
+    foam = np.full((SYNTHETIC_FOAM_ROWS[1] - SYNTHETIC_FOAM_ROWS[0], SYNTHETIC_VIAL_WIDTH, 3), 230, dtype=np.uint8)
+    foam[:, :20] = 60
+    foam[:, -20:] = 60
+    foam[20:40, 20:-20] = 250
+    return foam
+
+
+def create_synthetic_recordings(root_dir: str, n_recordings: int=4, n_flies: int=10, seed: int=42) -> Dict[Tuple[str, int], np.ndarray]:
+    # Writes templates and recordings with n_flies fly-shaped blobs at random positions in the vial (re-drawn every
+    # second) to root_dir. Returns the planted (row, col) fly centers in frame coordinates by (file_id, time_passed).
+    import imageio.v2 as iio
+    rng = np.random.default_rng(seed)
+    create_synthetic_templates(f'{root_dir}templates/', rng)
+    os.makedirs(f'{root_dir}recorded_videos/', exist_ok = True)
+    noise = rng.integers(0, 8, SYNTHETIC_FRAME_SHAPE, dtype=np.uint8)
+    planted_flies = dict()
+    for recording in range(n_recordings):
+        file_id = str(recording).zfill(4)
+        vial_col = int(rng.integers(400, SYNTHETIC_FRAME_SHAPE[1] - 400 - SYNTHETIC_VIAL_WIDTH))
+        frames = list()
+        for second in range(max(TIMEPOINTS_TO_ANALYZE) + 1):
+            frame = np.full(SYNTHETIC_FRAME_SHAPE, 120, dtype=np.uint8)
+            frame[:, vial_col : vial_col + SYNTHETIC_VIAL_WIDTH] = 180
+            frame[SYNTHETIC_FOAM_ROWS[0] : SYNTHETIC_FOAM_ROWS[1], vial_col : vial_col + SYNTHETIC_VIAL_WIDTH] = create_synthetic_foam()
+            frame += noise
+            fly_centers = list()
+            while len(fly_centers) < n_flies:
+                center = (int(rng.integers(240, 960)), int(rng.integers(vial_col + 30, vial_col + SYNTHETIC_VIAL_WIDTH - 30)))
+                # flies closer than the default min_distance can not be told apart by the detection
+                if all(np.hypot(center[0] - row, center[1] - col) > 50 for row, col in fly_centers):
+                    fly_centers.append(center)
+                    draw_fly(frame, *center)
+            planted_flies[(file_id, second)] = np.array(fly_centers, dtype=np.int32)
+            frames.append(frame)
+        writer = iio.get_writer(f'{root_dir}recorded_videos/{file_id}_wt_pre_light_{str(recording + 1).zfill(3)}.mp4', 
+                                fps = FRAMES_PER_SECOND, macro_block_size = 16, quality = 8)
+        # up to the end of the last second, so that the recordings can also be replayed in real time (see live.ReplayCamera)
+        for frame_index in range(get_frame_index(max(TIMEPOINTS_TO_ANALYZE) + 1)):
+            writer.append_data(frames[frame_index // FRAMES_PER_SECOND])
+        writer.close()
+    return {key: fly_centers for key, fly_centers in planted_flies.items() if key[1] in TIMEPOINTS_TO_ANALYZE}
+
+
+def match_detected_flies(detected_fly_coords: np.ndarray, planted_fly_coords: np.ndarray, tolerance: int=RECALL_TOLERANCE) -> int:
+    # Number of planted flies with a detected fly within tolerance - every detected fly is matched only once
+    distances = np.hypot(*(planted_fly_coords[:, None, :] - detected_fly_coords[None, :, :]).transpose(2, 0, 1))
+    matched_planted_flies, matched_detected_flies = set(), set()
+    for planted_idx, detected_idx in zip(*np.unravel_index(np.argsort(distances, axis = None), distances.shape)):
+        if distances[planted_idx, detected_idx] > tolerance:
+            break
+        if (planted_idx not in matched_planted_flies) and (detected_idx not in matched_detected_flies):
+            matched_planted_flies.add(planted_idx)
+            matched_detected_flies.add(detected_idx)
+    return len(matched_planted_flies)
+
+
+def benchmark_detection(root_dir: str, planted_flies: Dict[Tuple[str, int], np.ndarray], pyramid_factor: int=1, 
+                        background_model: str='templates') -> Dict:
+    # Times every stage of the detection separately on the synthetic recordings in root_dir (see 
+    # create_synthetic_recordings) and measures recall and precision of the detected flies against the planted ones.
+    # Durations are reported as median per call in ms.
+    from skimage.feature import peak_local_max
+    from .analysis import FlyDetector, get_boundaries, get_corrected_flies_mask, FLY_COORDS_OFFSET
+    from .analysis import CROPPING_BUFFER_ZONE, MIN_DISTANCE, THRESHOLD, MIN_CLIMBING_HEIGHT
+    from .matching import MatchingEngine
+    database = Database(root_dir)
+    database.prepare_database_for_analysis()
+    foam_template = database.template_bank.get_template('foam', FOAM_TEMPLATE_FILENAME)
+    durations = {stage: list() for stage in ['frame_decode', 'foam_matching', 'get_boundaries', 'template_matching', 
+                                             'peak_local_max', 'filtering', 'add_detected_flies', 'save_file_infos']}
+    counts = {'planted_flies': 0, 'detected_flies': 0, 'matched_flies': 0}
+    for file_id in sorted(database.row_positions_by_file_id.keys()):
+        fly_detector = FlyDetector(file_id = file_id, database = database, cropping_buffer_zone = CROPPING_BUFFER_ZONE, 
+                                   min_climbing_height = MIN_CLIMBING_HEIGHT, threshold = THRESHOLD, min_distance = MIN_DISTANCE,
+                                   overwrite = True, quick_view = False, use_frame_cache = False, pyramid_factor = pyramid_factor,
+                                   background_model = background_model)
+        frame_indices = [get_frame_index(time_passed) for time_passed in TIMEPOINTS_TO_ANALYZE]
+        start_time = time.perf_counter()
+        frames = database.frame_loader.read_frames(fly_detector.file_info['video_filepath'][0], frame_indices)
+        durations['frame_decode'].append(time.perf_counter() - start_time)
+        if background_model == 'median':
+            start_time = time.perf_counter()
+            database.frame_loader.get_median_background(fly_detector.file_info['video_filepath'][0], max(frame_indices))
+            durations.setdefault('median_background', list()).append(time.perf_counter() - start_time)
+        for time_passed in TIMEPOINTS_TO_ANALYZE:
+            image = frames[get_frame_index(time_passed)]
+            start_time = time.perf_counter()
+            min_col_idx, max_col_idx = fly_detector.get_vial_cropping_info_from_foam_matching(image, foam_template)
+            durations['foam_matching'].append(time.perf_counter() - start_time)
+            # get_boundaries is part of the foam matching, but timed on its own as well
+            foam_results = MatchingEngine(image[0:500]).match_template_bank([foam_template])
+            row_idx, col_idx = np.unravel_index(foam_results.argmax(), foam_results.shape)
+            start_time = time.perf_counter()
+            get_boundaries(foam_results[row_idx], col_idx)
+            durations['get_boundaries'].append(time.perf_counter() - start_time)
+
+            vial_cropping_coords = (min_col_idx - CROPPING_BUFFER_ZONE, max_col_idx + CROPPING_BUFFER_ZONE)
+            vial = image[VIAL_REGION_ROWS[0] : VIAL_REGION_ROWS[1], vial_cropping_coords[0] - 100 : vial_cropping_coords[1] + 100]
+            start_time = time.perf_counter()
+            bkgr_corrected_results = fly_detector.compute_response_map(vial, vial_cropping_coords)
+            durations['template_matching'].append(time.perf_counter() - start_time)
+            start_time = time.perf_counter()
+            flies_xy = peak_local_max(bkgr_corrected_results, min_distance = MIN_DISTANCE, threshold_abs = THRESHOLD)
+            durations['peak_local_max'].append(time.perf_counter() - start_time)
+            all_fly_coords = (flies_xy + FLY_COORDS_OFFSET).astype(np.int32)
+            start_time = time.perf_counter()
+            corrected_fly_coords = all_fly_coords[get_corrected_flies_mask(all_fly_coords, vial.shape[1], MIN_CLIMBING_HEIGHT, 
+                                                                           **fly_detector.filter_criteria)]
+            durations['filtering'].append(time.perf_counter() - start_time)
+            start_time = time.perf_counter()
+            database.add_detected_flies(file_id = file_id, time_passed = time_passed, all_fly_coords = all_fly_coords, 
+                                        vial_cropping_coords = vial_cropping_coords, corrected_fly_coords = corrected_fly_coords, 
+                                        detection_configs = fly_detector.detection_configs)
+            durations['add_detected_flies'].append(time.perf_counter() - start_time)
+
+            # planted flies in the coordinates of the cropped vial
+            planted_fly_coords = planted_flies[(file_id, time_passed)] - np.array([VIAL_REGION_ROWS[0], vial_cropping_coords[0] - 100])
+            counts['planted_flies'] += len(planted_fly_coords)
+            counts['detected_flies'] += len(all_fly_coords)
+            counts['matched_flies'] += match_detected_flies(all_fly_coords, planted_fly_coords)
+    start_time = time.perf_counter()
+    database.save_file_infos(prefix = '')
+    durations['save_file_infos'].append(time.perf_counter() - start_time)
+
+    benchmark_results = {'n_recordings': len(set(file_id for file_id, time_passed in planted_flies.keys())),
+                         'n_flies': len(next(iter(planted_flies.values()))),
+                         'pyramid_factor': pyramid_factor,
+                         'background_model': background_model,
+                         'stage_durations_ms': {stage: float(np.median(stage_durations)) * 1000 for stage, stage_durations in durations.items()},
+                         'recall': counts['matched_flies'] / max(counts['planted_flies'], 1),
+                         'precision': counts['matched_flies'] / max(counts['detected_flies'], 1),
+                         **counts}
+    for stage, duration in benchmark_results['stage_durations_ms'].items():
+        print(f'{stage:>20}: {duration:8.2f} ms')
+    print(f'recall: {benchmark_results["recall"]:.3f}, precision: {benchmark_results["precision"]:.3f} '
+          f'({counts["matched_flies"]} of {counts["planted_flies"]} planted flies found, {counts["detected_flies"]} detected)')
+    return benchmark_results
+
+
+def save_benchmark_results(benchmark_results: Dict, filepath: str):
+    # Stored together with the versions they were measured with, to compare them with compare_benchmark_results later on
+    import scipy
+    import skimage
+    with open(filepath, 'w') as io:
+        json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'versions': {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__, 
+                                'skimage': skimage.__version__, 'pandas': pd.__version__},
+                   'machine': platform.platform(),
+                   'results': benchmark_results}, io, indent = 1, default = str)
+
+
+def compare_benchmark_results(reference_filepath: str, benchmark_results: Dict, max_slowdown: float=1.5, max_recall_drop: float=0.01,
+                              min_duration_ms: float=1.0) -> List[str]:
+    # Regressions compared to the results saved before: an import time or detection stages that got slower by more
+    # than max_slowdown, a recall that dropped by more than max_recall_drop and any of the LAZY_MODULES that got
+    # imported at startup (the latter is a regression regardless of the reference). Stages that took less than 
+    # min_duration_ms in the reference are only flagged once they exceed min_duration_ms * max_slowdown (timer noise).
+    with open(reference_filepath, 'r') as io:
+        reference_results = json.load(io)['results']
+    regressions = list()
+    if 'import_time' in benchmark_results:
+        current_results = benchmark_results['import_time']
+        for module_name in current_results['lazy_modules_imported']:
+            regressions.append(f'{module_name} is imported by "import {current_results["module"]}"')
+        if 'import_time' in reference_results:
+            reference_duration, current_duration = reference_results['import_time']['median_import_time_ms'], current_results['median_import_time_ms']
+            if current_duration > reference_duration * max_slowdown:
+                regressions.append(f'import {current_results["module"]}: {current_duration:.1f} ms instead of {reference_duration:.1f} ms')
+    if ('detection' in benchmark_results) and ('detection' in reference_results):
+        current_results, detection_reference_results = benchmark_results['detection'], reference_results['detection']
+        for stage, reference_duration in detection_reference_results['stage_durations_ms'].items():
+            current_duration = current_results['stage_durations_ms'].get(stage)
+            if (current_duration != None) and (current_duration > max(reference_duration, min_duration_ms) * max_slowdown):
+                regressions.append(f'{stage}: {current_duration:.2f} ms instead of {reference_duration:.2f} ms')
+        if current_results['recall'] < detection_reference_results['recall'] - max_recall_drop:
+            regressions.append(f'recall: {current_results["recall"]:.3f} instead of {detection_reference_results["recall"]:.3f}')
+    print(f'{len(regressions)} regression(s) compared to {reference_filepath}' + ''.join(f'\n  {regression}' for regression in regressions))
+    return regressions
+
+
+def get_imported_lazy_modules(module: str='methodscourse') -> List[str]:
+    # The LAZY_MODULES that are found in sys.modules of a fresh interpreter after "import {module}"
+    package_parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    completed_process = subprocess.run([sys.executable, '-c', f'import sys, {module}; print("\\n".join(sys.modules))'],
+                                        cwd = package_parent_dir, capture_output = True, text = True, check = True)
+    imported_modules = completed_process.stdout.splitlines()
+    return sorted(set(module_name.split('.')[0] for module_name in imported_modules) & set(LAZY_MODULES))
+
+
+def benchmark_import_time(module: str='methodscourse.api', repetitions: int=5) -> Dict:
+    # Import cost of a fresh interpreter measured with "python -X importtime", which reports the cumulative
+    # time in microseconds of every imported module on stderr. Flags any of the LAZY_MODULES that got imported.
+    package_parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    import_times_us = list()
+    for repetition in range(repetitions):
+        completed_process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], 
+                                            cwd = package_parent_dir, capture_output = True, text = True, check = True)
+        imported_modules = dict()
+        for line in completed_process.stderr.splitlines():
+            if line.startswith('import time:'):
+                self_us, cumulative_us, module_name = line[len('import time:'):].split('|')
+                if cumulative_us.strip().isdigit():
+                    imported_modules[module_name.strip()] = int(cumulative_us)
+        import_times_us.append(imported_modules[module])
+    lazy_modules_imported = sorted(set(module_name.split('.')[0] for module_name in imported_modules) & set(LAZY_MODULES))
+    benchmark_results = {'module': module,
+                         'median_import_time_ms': float(np.median(import_times_us)) / 1000,
+                         'lazy_modules_imported': lazy_modules_imported}
+    print(f'import {module}: {benchmark_results["median_import_time_ms"]:.1f} ms (median of {repetitions}), '
+          f'heavy modules imported at startup: {lazy_modules_imported if len(lazy_modules_imported) > 0 else "none"}')
+    return benchmark_results
+
@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import argparse
+from fnmatch import fnmatch
+
+from .api import API, CROPPING_BUFFER_ZONE, MIN_DISTANCE, THRESHOLD, MIN_CLIMBING_HEIGHT, COLOR_MODE
+from .analysis import BACKGROUND_MODELS
+from .frames import COLOR_MODES
+from .database import TIMEPOINTS_TO_ANALYZE, has_results
+from .results_store import parquet_engine_available
+
+from typing import List, Optional
+
+
+# Exit codes of "python -m methodscourse"
+EXIT_SUCCESS = 0
+EXIT_FAILED_FILES = 1            # the command ran, but the analysis of at least one file failed
+EXIT_USAGE_ERROR = 2             # invalid arguments (same code as used by argparse)
+EXIT_NO_FILES = 3                # the root directory or the requested file IDs / results could not be found
+EXIT_MISSING_DEPENDENCY = 4      # an optional dependency of the subcommand is not installed
+
+EXPORT_COLUMNS = ['index', 'file_id', 'group_id', 'stimulus_indicator', 'vial_id', 'vial_position', 'time_passed',
+                  'all_detected_flies', 'corrected_detected_flies', 'vial_cropping_coords', 'detection_configs', 'video_filepath']
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog = 'python -m methodscourse',
+                                     description = 'Headless fly detection, statistics and export for climbing assay recordings.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    scan_parser = subparsers.add_parser('scan', help = 'list all recordings in ROOT_DIR and how many timepoints were analyzed')
+    scan_parser.add_argument('root_dir')
+
+    detect_parser = subparsers.add_parser('detect', help = 'detect flies in the recordings and save the results')
+    detect_parser.add_argument('root_dir')
+    detect_parser.add_argument('--file-ids', nargs = '+', default = ['*'], metavar = 'GLOB',
+                               help = 'file IDs or glob patterns like "0*" (default: all file IDs)')
+    detect_parser.add_argument('--workers', type = int, default = 1)
+    detect_parser.add_argument('--cropping-buffer-zone', type = int, default = CROPPING_BUFFER_ZONE)
+    detect_parser.add_argument('--min-climbing-height', type = int, default = MIN_CLIMBING_HEIGHT)
+    detect_parser.add_argument('--threshold', type = float, default = THRESHOLD)
+    detect_parser.add_argument('--min-distance', type = int, default = MIN_DISTANCE)
+    detect_parser.add_argument('--color-mode', choices = COLOR_MODES, default = COLOR_MODE)
+    detect_parser.add_argument('--overwrite', action = 'store_true')
+    detect_parser.add_argument('--quick-view', action = 'store_true')
+    detect_parser.add_argument('--drift-check', action = 'store_true')
+    detect_parser.add_argument('--pyramid-factor', type = int, default = 1, help = 'coarse-to-fine matching with this downscaling factor (1: exhaustive)')
+    detect_parser.add_argument('--background-model', choices = BACKGROUND_MODELS, default = 'templates',
+                               help = 'subtract the background templates or the temporal median background of each video')
+    detect_parser.add_argument('--frame-cache', action = 'store_true', 
+                               help = 'keep the vial regions of the decoded frames in results/frame_cache/ for repeated detections')
+    detect_parser.add_argument('--streaming', action = 'store_true', help = 'memory-bounded pipeline with checkpoints (single process)')
+    detect_parser.add_argument('--prefix', default = '')
+
+    track_parser = subparsers.add_parser('track', help = 'track the flies through all frames and save climbing speeds and times to threshold')
+    track_parser.add_argument('root_dir')
+    track_parser.add_argument('--file-ids', nargs = '+', default = ['*'], metavar = 'GLOB',
+                              help = 'file IDs or glob patterns like "0*" (default: all file IDs)')
+    track_parser.add_argument('--frame-step', type = int, default = 1, help = 'track only every n-th frame')
+    track_parser.add_argument('--workers', type = int, default = None, help = 'threads per video (default: number of CPUs)')
+    track_parser.add_argument('--cropping-buffer-zone', type = int, default = CROPPING_BUFFER_ZONE)
+    track_parser.add_argument('--min-climbing-height', type = int, default = MIN_CLIMBING_HEIGHT)
+    track_parser.add_argument('--threshold', type = float, default = THRESHOLD)
+    track_parser.add_argument('--min-distance', type = int, default = MIN_DISTANCE)
+    track_parser.add_argument('--color-mode', choices = COLOR_MODES, default = COLOR_MODE)
+    track_parser.add_argument('--pyramid-factor', type = int, default = 1)
+    track_parser.add_argument('--background-model', choices = BACKGROUND_MODELS, default = 'templates')
+    track_parser.add_argument('--prefix', default = '')
+
+    stats_parser = subparsers.add_parser('stats', help = 'compute the statistics of the saved results')
+    stats_parser.add_argument('root_dir')
+    stats_parser.add_argument('--save-plot', action = 'store_true', help = 'save the plots to ROOT_DIR/results/')
+
+    export_parser = subparsers.add_parser('export', help = 'export the saved results as one table')
+    export_parser.add_argument('root_dir')
+    export_parser.add_argument('output_filepath')
+    export_parser.add_argument('--format', choices = ['csv', 'parquet', 'json'], default = None,
+                               help = 'default: derived from the extension of OUTPUT_FILEPATH')
+    export_parser.add_argument('--all-rows', action = 'store_true', help = 'also export the rows without results')
+    return parser
+
+
+def main(argv: Optional[List[str]]=None) -> int:
+    args = create_parser().parse_args(argv)
+    if os.path.isdir(args.root_dir) == False:
+        print(f'The root directory {args.root_dir} does not exist.', file = sys.stderr)
+        return EXIT_NO_FILES
+    if args.root_dir.endswith('/') == False:
+        args.root_dir += '/'
+    commands = {'scan': scan, 'detect': detect, 'track': track, 'stats': stats, 'export': export}
+    return commands[args.command](args)
+
+
+def load_api(root_dir: str) -> API:
+    api = API(root_dir)
+    api.database.prepare_database_for_analysis()
+    api.load_results()
+    return api
+
+
+def scan(args: argparse.Namespace) -> int:
+    api = load_api(args.root_dir)
+    file_infos = api.database.file_infos
+    file_ids = sorted(api.database.row_positions_by_file_id.keys())
+    for file_id in file_ids:
+        row_positions = api.database.row_positions_by_file_id[file_id]
+        first_row = row_positions[0]
+        analyzed_timepoints = len([row for row in row_positions if has_results(file_infos['all_detected_flies'][row])])
+        print(f'{file_id}  group: {file_infos["group_id"][first_row]}  stimulus: {file_infos["stimulus_indicator"][first_row]}  '
+              f'vial: {file_infos["vial_id"][first_row]}  analyzed: {analyzed_timepoints}/{len(TIMEPOINTS_TO_ANALYZE)}'
+              f'{"" if file_infos["video_available"][first_row] else "  (video missing)"}')
+    print(f'{len(file_ids)} file IDs found in {api.database.recordings_dir}')
+    return EXIT_SUCCESS
+
+
+def detect(args: argparse.Namespace) -> int:
+    api = load_api(args.root_dir)
+    available_file_ids = sorted(api.database.row_positions_by_file_id.keys())
+    file_ids = [file_id for file_id in available_file_ids if any(fnmatch(file_id, pattern) for pattern in args.file_ids)]
+    if len(file_ids) == 0:
+        print(f'No file IDs match {args.file_ids}.', file = sys.stderr)
+        return EXIT_NO_FILES
+
+    detection_params = {'cropping_buffer_zone': args.cropping_buffer_zone,
+                        'min_climbing_height': args.min_climbing_height,
+                        'threshold': args.threshold,
+                        'min_distance': args.min_distance,
+                        'overwrite': args.overwrite,
+                        'quick_view': args.quick_view,
+                        'color_mode': args.color_mode,
+                        'drift_check': args.drift_check,
+                        'use_frame_cache': args.frame_cache,
+                        'pyramid_factor': args.pyramid_factor,
+                        'background_model': args.background_model}
+    progress = {'completed': 0, 'failed_file_ids': dict()}
+    def report_progress(file_id: str, duration: Optional[float], error: Optional[str]):
+        progress['completed'] += 1
+        status = f'failed: {error}' if error != None else 'done'
+        timing = f' in {duration:.1f} s' if duration != None else ''
+        if error != None:
+            progress['failed_file_ids'][file_id] = error
+        print(f'[{progress["completed"]}/{len(file_ids)}] {file_id} {status}{timing}', flush = True)
+
+    start_time = time.time()
+    api.detect_flies(file_ids = file_ids, workers = 1 if args.streaming else args.workers, streaming = args.streaming,
+                     prefix = args.prefix, progress_callback = report_progress, **detection_params)
+    if args.streaming == False:
+        api.save_results(prefix = args.prefix)
+    print(f'Analyzed {len(file_ids) - len(progress["failed_file_ids"])} of {len(file_ids)} file IDs in {time.time() - start_time:.1f} s.')
+    return EXIT_FAILED_FILES if len(progress['failed_file_ids']) > 0 else EXIT_SUCCESS
+
+
+def track(args: argparse.Namespace) -> int:
+    api = load_api(args.root_dir)
+    available_file_ids = sorted(api.database.row_positions_by_file_id.keys())
+    file_ids = [file_id for file_id in available_file_ids if any(fnmatch(file_id, pattern) for pattern in args.file_ids)]
+    if len(file_ids) == 0:
+        print(f'No file IDs match {args.file_ids}.', file = sys.stderr)
+        return EXIT_NO_FILES
+    failed_file_ids = dict()
+    start_time = time.time()
+    for file_id in file_ids:
+        try:
+            api.track_flies(file_ids = [file_id], frame_step = args.frame_step, workers = args.workers,
+                            cropping_buffer_zone = args.cropping_buffer_zone, min_climbing_height = args.min_climbing_height,
+                            threshold = args.threshold, min_distance = args.min_distance, color_mode = args.color_mode,
+                            pyramid_factor = args.pyramid_factor, background_model = args.background_model)
+        except Exception as error:
+            failed_file_ids[file_id] = repr(error)
+            print(f'{file_id} failed: {repr(error)}', flush = True)
+    api.save_results(prefix = args.prefix)
+    print(f'Tracked {len(file_ids) - len(failed_file_ids)} of {len(file_ids)} file IDs in {time.time() - start_time:.1f} s.')
+    return EXIT_FAILED_FILES if len(failed_file_ids) > 0 else EXIT_SUCCESS
+
+
+def stats(args: argparse.Namespace) -> int:
+    try:
+        import pingouin
+        if args.save_plot:
+            import seaborn
+            import matplotlib
+    except ImportError as error:
+        print(f'The "stats" command requires pingouin, seaborn and matplotlib ({error}).', file = sys.stderr)
+        return EXIT_MISSING_DEPENDENCY
+    from .stats_and_plots import StatsPlotter
+    api = load_api(args.root_dir)
+    if any(has_results(detected_flies) for detected_flies in api.database.file_infos['corrected_detected_flies']) == False:
+        print(f'No results found in {api.database.results_dir}', file = sys.stderr)
+        return EXIT_NO_FILES
+    stats_plotter = StatsPlotter(database = api.database)
+    df = stats_plotter.preprocess_dataframe()
+    stats_results = stats_plotter.compute_stats(df = df)
+    for test, result in stats_results.items():
+        print(f'{test}: {result}')
+    if args.save_plot:
+        stats_plotter.plot_results(df = df, stats = stats_results, save = True, show = False)
+    return EXIT_SUCCESS
+
+
+def export(args: argparse.Namespace) -> int:
+    export_format = args.format if args.format != None else os.path.splitext(args.output_filepath)[1][1:]
+    if (export_format == 'parquet') and (parquet_engine_available() == False):
+        print('The parquet export requires pyarrow - install it or use --format csv or json.', file = sys.stderr)
+        return EXIT_MISSING_DEPENDENCY
+    import pandas as pd
+    api = load_api(args.root_dir)
+    rows = api.database.get_rows(list(range(len(api.database.file_infos['index']))))
+    if args.all_rows == False:
+        rows_with_results = [i for i in range(len(rows['index'])) if has_results(rows['all_detected_flies'][i])]
+        rows = {key: [values[i] for i in rows_with_results] for key, values in rows.items()}
+    if len(rows['index']) == 0:
+        print(f'No results found in {api.database.results_dir}', file = sys.stderr)
+        return EXIT_NO_FILES
+    df = pd.DataFrame(data = {column: rows[column] for column in EXPORT_COLUMNS})
+    df['vial_cropping_coords'] = [json.dumps(list(coords)) if coords != None else None for coords in df['vial_cropping_coords']]
+    df['detection_configs'] = [json.dumps(configs) if configs != None else None for configs in df['detection_configs']]
+    if export_format == 'csv':
+        df.to_csv(args.output_filepath, index = False)
+    elif export_format == 'parquet':
+        df.to_parquet(args.output_filepath, index = False)
+    elif export_format == 'json':
+        df.to_json(args.output_filepath, orient = 'records', indent = 1)
+    else:
+        print(f'Unknown export format "{export_format}" - use --format csv, parquet or json.', file = sys.stderr)
+        return EXIT_USAGE_ERROR
+    print(f'Exported {df.shape[0]} rows to {args.output_filepath}')
+    return EXIT_SUCCESS
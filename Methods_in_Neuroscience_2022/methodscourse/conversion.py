@@ -0,0 +1,73 @@
+import os
+import queue
+import threading
+import subprocess
+
+from .frames import FRAMES_PER_SECOND
+
+from typing import List
+
+
+def remux_to_mp4(h264_filepath: str, framerate: int=FRAMES_PER_SECOND, delete_source: bool=False) -> str:
+    # Copies the H.264 stream into an mp4 container without re-encoding. Raw H.264 carries neither timestamps nor an
+    # index, so the framerate has to be provided. The mp4 is written to a temporary file first and renamed afterwards,
+    # so Database.prepare_database_for_analysis never picks up a video that is still being written.
+    import imageio_ffmpeg
+    mp4_filepath = h264_filepath[:-len('.h264')] + '.mp4'
+    temporary_filepath = mp4_filepath + '.part'
+    subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+                    '-framerate', str(framerate), '-i', h264_filepath,
+                    '-c', 'copy', '-f', 'mp4', temporary_filepath],
+                   check = True, capture_output = True)
+    os.replace(temporary_filepath, mp4_filepath)
+    if delete_source:
+        os.remove(h264_filepath)
+    return mp4_filepath
+
+
+def list_recordings_to_remux(recordings_dir: str) -> List[str]:
+    filenames = set(filename for filename in os.listdir(recordings_dir) if filename.startswith('.') == False)
+    return [f'{recordings_dir}{filename}' for filename in sorted(filenames)
+            if filename.endswith('.h264') and (filename[:-len('.h264')] + '.mp4') not in filenames]
+
+
+class RemuxWorker:
+
+    # Remuxes recordings in a background thread, so that the next vial can be recorded right away.
+    # Failed conversions are collected in failed_filepaths, the .h264 files are kept in that case.
+
+    def __init__(self, framerate: int=FRAMES_PER_SECOND, delete_source: bool=False):
+        self.framerate = framerate
+        self.delete_source = delete_source
+        self.remux_queue = queue.Queue()
+        self.thread = None
+        self.remuxed_filepaths = list()
+        self.failed_filepaths = dict()
+
+
+    def submit(self, h264_filepath: str):
+        if (self.thread == None) or (self.thread.is_alive() == False):
+            self.thread = threading.Thread(target = self.remux_queued_recordings, daemon = True)
+            self.thread.start()
+        self.remux_queue.put(h264_filepath)
+
+
+    def wait(self):
+        # blocks until all submitted recordings are converted
+        self.remux_queue.join()
+
+
+    def remux_queued_recordings(self):
+        while True:
+            h264_filepath = self.remux_queue.get()
+            try:
+                self.remuxed_filepaths.append(remux_to_mp4(h264_filepath = h264_filepath,
+                                                           framerate = self.framerate,
+                                                           delete_source = self.delete_source))
+            except Exception as error:
+                if isinstance(error, subprocess.CalledProcessError):
+                    error = error.stderr.decode(errors = 'replace').strip() or repr(error)
+                self.failed_filepaths[h264_filepath] = str(error)
+                print(f'Conversion of {h264_filepath} to mp4 failed ({error}).')
+            finally:
+                self.remux_queue.task_done()
@@ -1,29 +1,73 @@
 import os
-import pandas as pd
+import time
+import numpy as np
 import pickle
 from math import isnan
 
 
-from skimage.io import imread, imsave
+
+from .templates import TemplateBank
+from .frames import FrameLoader, FrameCache, get_video_signature, get_video_fingerprint
+from .results_store import ResultsStore, parquet_engine_available, VIDEO_SIGNATURE_COLUMNS
+from .matching import ResponseMapCache
 
 from typing import Dict, List, Tuple, Optional
 
 
 TIMEPOINTS_TO_ANALYZE = [1, 2, 3, 4, 5]
+FILE_INFO_KEYS = ['index', 'file_id', 'group_id', 'stimulus_indicator', 'vial_id', 'vial_position', 'time_passed',
+                  'all_detected_flies', 'all_fly_coords', 'vial_cropping_coords', 'corrected_detected_flies',
+                  'corrected_fly_coords', 'video_filepath', 'detection_configs', 'video_available',
+                  'climbing_speeds', 'times_to_threshold']
+RESULT_KEYS = ['all_detected_flies', 'all_fly_coords', 'vial_cropping_coords', 
+               'corrected_detected_flies', 'corrected_fly_coords', 'detection_configs']
+# per-fly results of the tracking mode (see FlyTracker), the same for all rows of a file_id
+TRACKING_KEYS = ['climbing_speeds', 'times_to_threshold']
 
 
 def list_no_hidden(filepath: str) -> List[str]:
     return [elem for elem in os.listdir(filepath) if elem.startswith('.') == False]
 
 
+def get_vial_ids(filename: str) -> List[str]:
+    # Recordings of several vials next to each other list all their vial_ids from left to right, separated by "-":
+    # "0003_wt_pre_light_001-002-003.mp4" contains the vials "_001", "_002" and "_003"
+    filename = os.path.basename(filename)
+    return [f'_{vial_id}' for vial_id in filename[filename.rfind('_') + 1:filename.find('.mp4')].split('-')]
+
+
+def get_results_mask(detected_flies: List) -> np.ndarray:
+    # has_results for a whole column at once (None is converted to NaN)
+    return np.isnan(np.array(detected_flies, dtype=np.float64)) == False
+
+
+def has_results(detected_flies) -> bool:
+    if detected_flies == None:
+        return False
+    return isnan(detected_flies) == False
+
+
 class Database:
     
     def __init__(self, root_dir: str):
         self.root_dir = root_dir
         self.create_subdirs()        
         self.templates_dir = f'{root_dir}templates/'
-        self.foam_template = imread(f'{self.templates_dir}foam/001_foam.png')
+        self.template_bank = TemplateBank(self.templates_dir)
+        self.frame_loader = FrameLoader()
+        self.vial_localizations = dict()
+        self.response_map_cache = ResponseMapCache(cache_dir = f'{self.results_dir}response_maps/')
+        self.frame_cache = FrameCache(cache_dir = f'{self.results_dir}frame_cache/')
         self.file_id_tracker_for_recordings = 0
+        # preliminary fly counts of the live mode during recording: {file_id: {time_passed: {...}}}
+        self.live_counts = dict()
+        # trajectories of the tracking mode: {file_id: {'trajectories': [...], 'climbing_speeds': [...], ...}}
+        self.trajectories = dict()
+        
+    
+    @property
+    def foam_template(self) -> np.ndarray:
+        return self.template_bank.foam
         
     
     def create_subdirs(self):
@@ -37,97 +81,369 @@ class Database:
         
 
     def prepare_database_for_analysis(self):
-        self.files = list_no_hidden(self.recordings_dir)
-        self.files = [filename for filename in self.files if filename.endswith('mp4')]
-        self.files.sort()
-        self.file_infos = self.create_file_infos()
+        # Incremental: only videos that are new since the last call get rows appended, rows of removed videos are
+        # kept (including their detections) but marked as not available. Videos that were replaced under the same 
+        # name (re-recorded or re-converted, detected by their size and mtime) get their rows reset.
+        if hasattr(self, 'file_infos') == False:
+            self.files = list()
+            self.known_files = dict()
+            # (size, mtime_ns) of every video that was listed so far, including removed ones
+            self.file_signatures = dict()
+            # ((size, mtime_ns), fingerprint) of the videos whose fingerprint was computed (see get_video_fingerprint)
+            self.video_fingerprints = dict()
+            self.set_file_infos(file_infos = self.create_file_infos())
+        current_files = self.scan_recordings_dir()
+        changed_files = list()
+        for filename in sorted(current_files.keys()):
+            if self.recordings_dir + filename not in self.row_positions_by_video_filepath:
+                self.files.append(filename)
+                for row_position in self.append_file_rows(file_infos = self.file_infos, filename = filename):
+                    self.add_row_to_indexes(row_position = row_position)
+            elif self.file_signatures.get(filename, current_files[filename]) != current_files[filename]:
+                changed_files.append(filename)
+        for filename in set(current_files.keys()) - set(self.known_files.keys()):
+            self.set_video_availability(filename = filename, video_available = True)
+        for filename in set(self.known_files.keys()) - set(current_files.keys()):
+            self.set_video_availability(filename = filename, video_available = False)
+        self.known_files = current_files
+        for filename in changed_files:
+            # a video that was only touched or copied keeps its size and fingerprint
+            previous_fingerprint = self.video_fingerprints.get(filename, (None, None))[1]
+            if ((self.file_signatures[filename][0] != current_files[filename][0]) or 
+                ((previous_fingerprint != None) and (self.get_video_fingerprint(filename) != previous_fingerprint))):
+                self.reset_video_rows(filename = filename)
+        self.file_signatures.update(current_files)
+        
+        
+    def reset_video_rows(self, filename: str):
+        # The detections, tracking results, live counts and the vial localization belonged to the replaced video
+        for row_position in self.row_positions_by_video_filepath[self.recordings_dir + filename]:
+            file_id = self.file_infos['file_id'][row_position]
+            for key in RESULT_KEYS + TRACKING_KEYS:
+                self.file_infos[key][row_position] = None
+            self.vial_localizations.pop(file_id, None)
+            self.live_counts.pop(file_id, None)
+            self.trajectories.pop(file_id, None)
+            self.session_changed_rows.discard(row_position)
+            for changed_rows in self.changed_rows.values():
+                changed_rows.discard(row_position)
+        print(f'{filename} was replaced since it was listed - its results were reset.')
+        
+        
+    def get_video_fingerprint(self, filename: str) -> Optional[str]:
+        # Cached as long as size and mtime of the video don't change, None if the video is not available
+        if filename not in self.known_files:
+            return None
+        if self.video_fingerprints.get(filename, (None, None))[0] != self.known_files[filename]:
+            self.video_fingerprints[filename] = (self.known_files[filename], get_video_fingerprint(self.recordings_dir + filename))
+        return self.video_fingerprints[filename][1]
+        
+        
+    def get_video_signature_columns(self, row_positions: List[int]) -> Dict[str, List]:
+        # Signature of the videos of these rows, saved with their results (see matches_saved_video)
+        signature_columns = {'video_size': list(), 'video_mtime_ns': list(), 'video_fingerprint': list()}
+        for row_position in row_positions:
+            filename = os.path.basename(self.file_infos['video_filepath'][row_position])
+            size, mtime_ns = self.known_files.get(filename, (None, None))
+            signature_columns['video_size'].append(size)
+            signature_columns['video_mtime_ns'].append(mtime_ns)
+            signature_columns['video_fingerprint'].append(self.get_video_fingerprint(filename))
+        return signature_columns
+        
+        
+    def matches_saved_video(self, filename: str, size: Optional[int], mtime_ns: Optional[int], fingerprint: Optional[str]) -> bool:
+        # Whether results saved with this video signature belong to the current video. Results without signature 
+        # (saved by older versions) and of videos that are not available are kept.
+        if (size == None) or (size != size) or (size < 0) or (filename not in self.known_files):
+            return True
+        size, mtime_ns = int(size), int(mtime_ns)
+        if (size, mtime_ns) == self.known_files[filename]:
+            if isinstance(fingerprint, str) and (len(fingerprint) > 0):
+                self.video_fingerprints[filename] = (self.known_files[filename], fingerprint)
+            return True
+        if size != self.known_files[filename][0]:
+            return False
+        # same size but a different mtime: touched or copied, unless the content changed
+        if (isinstance(fingerprint, str) == False) or (len(fingerprint) == 0):
+            return True
+        return fingerprint == self.get_video_fingerprint(filename)
+        
+        
+    def scan_recordings_dir(self) -> Dict[str, Tuple[int, int]]:
+        current_files = dict()
+        with os.scandir(self.recordings_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') == False and entry.name.endswith('mp4'):
+                    stat = entry.stat()
+                    current_files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return current_files
+    
+    
+    def set_video_availability(self, filename: str, video_available: bool):
+        for row_position in self.row_positions_by_video_filepath.get(self.recordings_dir + filename, list()):
+            self.file_infos['video_available'][row_position] = video_available
+        
+        
+    def set_file_infos(self, file_infos: Dict):
+        self.file_infos = file_infos
+        # rows with new detections since the file_infos were set, and per results prefix since the last save to it
+        self.session_changed_rows = set()
+        self.changed_rows = dict()
+        self.row_positions_by_index = dict()
+        self.row_positions_by_file_id = dict()
+        self.row_positions_by_file_id_and_time = dict()
+        self.row_positions_by_video_filepath = dict()
+        for row_position in range(len(self.file_infos['index'])):
+            self.add_row_to_indexes(row_position = row_position)
+    
+    
+    def add_row_to_indexes(self, row_position: int):
+        file_id = self.file_infos['file_id'][row_position]
+        self.row_positions_by_index[self.file_infos['index'][row_position]] = row_position
+        self.row_positions_by_file_id.setdefault(file_id, list()).append(row_position)
+        self.row_positions_by_file_id_and_time[(file_id, self.file_infos['time_passed'][row_position])] = row_position
+        self.row_positions_by_video_filepath.setdefault(self.file_infos['video_filepath'][row_position], list()).append(row_position)
     
     
     def create_file_infos(self) -> Dict:
-        file_infos = {'index': list(),
-                      'file_id': list(),
-                      'group_id': list(),
-                      'stimulus_indicator': list(),
-                      'vial_id': list(),
-                      'time_passed': list(),
-                      'all_detected_flies': list(),
-                      'all_fly_coords': list(),
-                      'vial_cropping_coords': list(),
-                      'corrected_detected_flies': list(),
-                      'corrected_fly_coords': list(),
-                      'video_filepath': list(),
-                      'detection_configs': list()}
-        index_count = 0
+        file_infos = {key: list() for key in FILE_INFO_KEYS}
         for filename in self.files:
+            self.append_file_rows(file_infos = file_infos, filename = filename)
+        return file_infos
+    
+    
+    def append_file_rows(self, file_infos: Dict, filename: str) -> List[int]:
+        # One row per vial and timepoint. The vials of a multi-vial recording get the file_ids "0003-1", "0003-2", ...
+        # (numbered by their position from left to right), so that all results stay keyed on (file_id, time_passed).
+        row_positions = list()
+        vial_ids = get_vial_ids(filename)
+        for vial_position, vial_id in enumerate(vial_ids, start = 1):
             for time_passed in TIMEPOINTS_TO_ANALYZE:
-                file_infos['index'].append(str(index_count).zfill(4))
-                file_infos['file_id'].append(filename[:4])
+                row_positions.append(len(file_infos['index']))
+                file_infos['index'].append(str(len(file_infos['index'])).zfill(4))
+                file_infos['file_id'].append(filename[:4] if len(vial_ids) == 1 else f'{filename[:4]}-{vial_position}')
                 file_infos['group_id'].append(filename[5:7])
                 file_infos['stimulus_indicator'].append(filename[8:filename.find('_light')])
-                file_infos['vial_id'].append(filename[filename.rfind('_'):filename.find('.mp4')])
+                file_infos['vial_id'].append(vial_id)
+                file_infos['vial_position'].append(vial_position)
                 file_infos['video_filepath'].append(self.recordings_dir + filename)
+                file_infos['video_available'].append(True)
                 file_infos['time_passed'].append(time_passed)
-                for key in ['all_detected_flies', 'all_fly_coords', 
-                            'vial_cropping_coords', 'corrected_detected_flies', 'corrected_fly_coords',
-                            'detection_configs']:
+                for key in RESULT_KEYS + TRACKING_KEYS:
                     file_infos[key].append(None)
-                index_count += 1
-        return file_infos
+        return row_positions
     
     
     def get_file_info_df(self, index: Optional[str]=None, file_id: Optional[str]=None) -> Dict:
-        file_info_df = pd.DataFrame(data=self.file_infos)
         if index != None:
-            file_info_df = file_info_df.loc[file_info_df['index'] == index]
+            row_positions = [self.row_positions_by_index[index]] if index in self.row_positions_by_index else list()
         elif file_id != None:
-            file_info_df = file_info_df.loc[file_info_df['file_id'] == file_id]
-        return file_info_df.to_dict('list')
+            row_positions = self.row_positions_by_file_id.get(file_id, list())
+        else:
+            row_positions = range(len(self.file_infos['index']))
+        return self.get_rows(row_positions = row_positions)
     
     
-    def add_detected_flies(self, file_id: str, time_passed: int, all_fly_coords: List, vial_cropping_coords: Tuple, corrected_fly_coords: List, detection_configs: Dict):
-        
-        for i in range(len(self.file_infos['file_id'])):
-            if (self.file_infos['file_id'][i] == file_id) & (self.file_infos['time_passed'][i] == time_passed):
-                entry_index = i
-        
+    def get_file_ids_by_vial_position(self, video_filepath: str) -> Dict[int, str]:
+        return {self.file_infos['vial_position'][row_position]: self.file_infos['file_id'][row_position]
+                for row_position in self.row_positions_by_video_filepath.get(video_filepath, list())}
+    
+    
+    def get_row_position(self, file_id: str, time_passed: int) -> int:
+        return self.row_positions_by_file_id_and_time[(file_id, time_passed)]
+    
+    
+    def add_detected_flies(self, file_id: str, time_passed: int, all_fly_coords: np.ndarray, vial_cropping_coords: Tuple, corrected_fly_coords: np.ndarray, detection_configs: Dict):
+        entry_index = self.get_row_position(file_id = file_id, time_passed = time_passed)
         self.file_infos['all_detected_flies'][entry_index] = len(all_fly_coords)
         self.file_infos['all_fly_coords'][entry_index] = all_fly_coords
         self.file_infos['vial_cropping_coords'][entry_index] = vial_cropping_coords
         self.file_infos['corrected_detected_flies'][entry_index] = len(corrected_fly_coords)
         self.file_infos['corrected_fly_coords'][entry_index] = corrected_fly_coords
         self.file_infos['detection_configs'][entry_index] = detection_configs
+        self.mark_row_as_changed(row_position = entry_index)
+
+
+    def mark_row_as_changed(self, row_position: int):
+        self.session_changed_rows.add(row_position)
+        for changed_rows in self.changed_rows.values():
+            changed_rows.add(row_position)
         
 
+    def get_vial_localization(self, file_id: str, video_filepath: str, color_mode: str) -> Optional[Dict]:
+        vial_localization = self.vial_localizations.get(file_id)
+        if vial_localization == None:
+            return None
+        if ((vial_localization['video_signature'] != get_video_signature(video_filepath))
+            or (vial_localization['foam_template_signature'] != self.template_bank.get_signature('foam'))
+            or (vial_localization['color_mode'] != color_mode)):
+            self.vial_localizations.pop(file_id)
+            return None
+        return vial_localization
+    
+    
+    def set_vial_localization(self, file_id: str, video_filepath: str, color_mode: str, vial_localization: Dict):
+        vial_localization['video_signature'] = get_video_signature(video_filepath)
+        vial_localization['foam_template_signature'] = self.template_bank.get_signature('foam')
+        vial_localization['color_mode'] = color_mode
+        self.vial_localizations[file_id] = vial_localization
+        
+
+    def add_live_count(self, file_id: str, time_passed: int, all_fly_coords: np.ndarray, vial_cropping_coords: Tuple, corrected_fly_coords: np.ndarray):
+        self.live_counts.setdefault(file_id, dict())[time_passed] = {'all_detected_flies': len(all_fly_coords),
+                                                                      'all_fly_coords': all_fly_coords,
+                                                                      'vial_cropping_coords': vial_cropping_coords,
+                                                                      'corrected_detected_flies': len(corrected_fly_coords),
+                                                                      'corrected_fly_coords': corrected_fly_coords}
+        
+
+    def add_trajectories(self, file_id: str, trajectories: List[np.ndarray], climbing_speeds: List[float], times_to_threshold: List[float], 
+                         tracking_configs: Dict):
+        self.trajectories[file_id] = {'trajectories': trajectories,
+                                      'climbing_speeds': climbing_speeds,
+                                      'times_to_threshold': times_to_threshold,
+                                      'tracking_configs': tracking_configs}
+        self.set_tracking_results(file_id = file_id)
+
+
+    def set_tracking_results(self, file_id: str):
+        for row_position in self.row_positions_by_file_id.get(file_id, list()):
+            for key in TRACKING_KEYS:
+                self.file_infos[key][row_position] = self.trajectories[file_id][key]
+
+
+    def get_rows(self, row_positions: List[int]) -> Dict[str, List]:
+        return {key: [values[row_position] for row_position in row_positions] for key, values in self.file_infos.items()}
+    
+    
     def save_file_infos(self, prefix: str):
-        with open(f'{self.results_dir}{prefix}file_info_results.p', 'wb') as io:
-            pickle.dump(self.file_infos, io)
+        if parquet_engine_available():
+            results_store = ResultsStore(f'{self.results_dir}{prefix}file_info_results/')
+            row_positions = self.get_rows_to_save(results_store = results_store, prefix = prefix)
+            results_store.append(rows = {**self.get_rows(row_positions), **self.get_video_signature_columns(row_positions)})
+        else:
+            print('pyarrow is not installed - saving all results as pickle instead.')
+            with open(f'{self.results_dir}{prefix}file_info_results.p', 'wb') as io:
+                pickle.dump({**self.file_infos, **self.get_video_signature_columns(range(len(self.file_infos['index'])))}, io)
+        self.changed_rows[prefix] = set()
+        with open(f'{self.results_dir}{prefix}vial_localizations.p', 'wb') as io:
+            pickle.dump(self.vial_localizations, io)
+        if len(self.live_counts) > 0:
+            with open(f'{self.results_dir}{prefix}live_counts.p', 'wb') as io:
+                pickle.dump(self.live_counts, io)
+        if len(self.trajectories) > 0:
+            with open(f'{self.results_dir}{prefix}trajectories.p', 'wb') as io:
+                pickle.dump(self.trajectories, io)
 
         
+    def get_rows_to_save(self, results_store: ResultsStore, prefix: str) -> List[int]:
+        # Only the rows that changed since the last save to this store are appended. For a store that was not saved 
+        # to before in this session, these are all rows that changed in this session plus all rows with results that
+        # the store doesn't contain yet (i.e. all rows with results for a new store).
+        if prefix in self.changed_rows:
+            return sorted(self.changed_rows[prefix])
+        stored_keys = set(zip(*results_store.load(columns = ['file_id', 'time_passed']).values()))
+        rows_with_results = np.flatnonzero(get_results_mask(self.file_infos['all_detected_flies'])).tolist()
+        missing_rows = [row_position for row_position in rows_with_results 
+                        if (self.file_infos['file_id'][row_position], self.file_infos['time_passed'][row_position]) not in stored_keys]
+        return sorted(self.session_changed_rows.union(missing_rows))
+
+
     def load_file_infos(self):
-        result_files = [filename for filename in list_no_hidden(self.results_dir) if filename.endswith('file_info_results.p')]
-        
-        for file in result_files:
+        for file in [filename for filename in list_no_hidden(self.results_dir) if filename.endswith('vial_localizations.p')]:
             with open(self.results_dir + file, 'rb') as io:
-                results = pickle.load(io)
-            
-            ids_of_entries_with_results = list()
-            for i in range(len(results['index'])):
-                if results['all_detected_flies'][i] != None:
-                    if isnan(results['all_detected_flies'][i]) == False:
-                        ids_of_entries_with_results.append(i)
-
-            for index in ids_of_entries_with_results:
-                if self.file_infos['all_detected_flies'][index] == None:
-                    no_results_present = True
-                elif isnan(self.file_infos['all_detected_flies'][index]):
-                    no_results_present = True
-
-                if no_results_present:
-                    for key in ['all_detected_flies', 'all_fly_coords', 
-                                'vial_cropping_coords', 'corrected_detected_flies', 'corrected_fly_coords',
-                                'detection_configs']:
-
-                        self.file_infos[key][index] = results[key][index]
+                vial_localizations = pickle.load(io)
+            for file_id, vial_localization in vial_localizations.items():
+                if file_id not in self.vial_localizations:
+                    self.vial_localizations[file_id] = vial_localization
+        for file in [filename for filename in list_no_hidden(self.results_dir) if filename.endswith('live_counts.p')]:
+            with open(self.results_dir + file, 'rb') as io:
+                live_counts = pickle.load(io)
+            for file_id, live_counts_per_time in live_counts.items():
+                if file_id not in self.live_counts:
+                    self.live_counts[file_id] = live_counts_per_time
+        for file in [filename for filename in list_no_hidden(self.results_dir) if filename.endswith('trajectories.p')]:
+            with open(self.results_dir + file, 'rb') as io:
+                trajectories = pickle.load(io)
+            for file_id, tracking_results in trajectories.items():
+                if file_id not in self.trajectories:
+                    self.trajectories[file_id] = tracking_results
+                    self.set_tracking_results(file_id = file_id)
+                    
+        self.merge_result_files()
+
+
+    def merge_result_files(self):
+        # All results saved in results/ (ResultsStores and pickled file_infos, e.g. from different machines) are
+        # merged keyed on (file_id, time_passed): if a row has results in several of them, the most recent save wins
+        # (the modification time for pickled file_infos). Rows that already have results in memory are kept, results
+        # that were saved for a different version of the video (see matches_saved_video) are dropped.
+        # Only file_id, time_passed and the save time are read to pick the results - the result columns are then
+        # loaded for the picked rows only.
+        import pandas as pd
+        start_time = time.perf_counter()
+        pickled_results = dict()
+        candidates = list()
+        for filename in [filename for filename in list_no_hidden(self.results_dir) if filename.endswith('file_info_results.p')]:
+            with open(self.results_dir + filename, 'rb') as io:
+                pickled_results[filename] = pickle.load(io)
+            source_rows = np.flatnonzero(get_results_mask(pickled_results[filename]['all_detected_flies']))
+            source_df = pd.DataFrame({'file_id': np.asarray(pickled_results[filename]['file_id'], dtype=object)[source_rows], 
+                                      'time_passed': np.asarray(pickled_results[filename]['time_passed'])[source_rows],
+                                      'source_row': source_rows})
+            for column in VIDEO_SIGNATURE_COLUMNS:
+                if column in pickled_results[filename]:
+                    source_df[column] = np.asarray(pickled_results[filename][column], dtype=object)[source_rows]
+            source_df['saved_at'] = os.stat(self.results_dir + filename).st_mtime
+            source_df['source'] = filename
+            candidates.append(source_df)
+        for dirname in [filename for filename in list_no_hidden(self.results_dir) 
+                        if filename.endswith('file_info_results') and os.path.isdir(self.results_dir + filename)]:
+            source_df = pd.DataFrame(ResultsStore(f'{self.results_dir}{dirname}/').load(columns = ['file_id', 'time_passed', 'saved_at'] + VIDEO_SIGNATURE_COLUMNS))
+            source_df['source_row'] = -1
+            source_df['source'] = dirname
+            candidates.append(source_df)
+        if len(candidates) == 0:
+            return
+        candidates_df = pd.concat(candidates, ignore_index = True)
+        for column in VIDEO_SIGNATURE_COLUMNS:
+            if column not in candidates_df.columns:
+                candidates_df[column] = None
+        n_candidates = candidates_df.shape[0]
+        candidates_df = candidates_df.sort_values('saved_at', kind = 'stable').drop_duplicates(subset = ['file_id', 'time_passed'], keep = 'last')
+        row_positions = np.flatnonzero(get_results_mask(self.file_infos['all_detected_flies']) == False)
+        rows_df = pd.DataFrame({'file_id': np.asarray(self.file_infos['file_id'], dtype=object)[row_positions], 
+                                'time_passed': np.asarray(self.file_infos['time_passed'])[row_positions],
+                                'row_position': row_positions})
+        merged_df = candidates_df.merge(rows_df, on = ['file_id', 'time_passed'], how = 'inner')
+        matches_by_signature = dict()
+        matches_video = list()
+        for row_position, size, mtime_ns, fingerprint in zip(merged_df['row_position'].tolist(), merged_df['video_size'].tolist(),
+                                                             merged_df['video_mtime_ns'].tolist(), merged_df['video_fingerprint'].tolist()):
+            signature = (os.path.basename(self.file_infos['video_filepath'][row_position]), size, mtime_ns, fingerprint)
+            if signature not in matches_by_signature:
+                matches_by_signature[signature] = self.matches_saved_video(*signature)
+            matches_video.append(matches_by_signature[signature])
+        n_dropped_rows = len(matches_video) - sum(matches_video)
+        if n_dropped_rows > 0:
+            print(f'Warning: dropped the saved results of {n_dropped_rows} rows, as their videos were replaced since.')
+        merged_df = merged_df[np.array(matches_video, dtype=bool)]
+
+        for source, source_df in merged_df.groupby('source', sort = False):
+            if source in pickled_results:
+                results, source_rows = pickled_results[source], source_df['source_row'].tolist()
+            else:
+                keys = list(zip(source_df['file_id'], source_df['time_passed']))
+                results = ResultsStore(f'{self.results_dir}{source}/').load(columns = ['file_id', 'time_passed'] + RESULT_KEYS, keys = keys)
+                source_row_by_key = {key: i for i, key in enumerate(zip(results['file_id'], results['time_passed']))}
+                source_rows = [source_row_by_key[key] for key in keys]
+            row_positions = source_df['row_position'].tolist()
+            for key in RESULT_KEYS:
+                for row_position, source_row in zip(row_positions, source_rows):
+                    self.file_infos[key][row_position] = results[key][source_row]
+        print(f'Merged results for {merged_df.shape[0]} rows from {len(candidates)} result file(s) in {time.perf_counter() - start_time:.2f} s '
+              f'({n_candidates} saved rows, {n_candidates - candidates_df.shape[0]} superseded by more recent saves, '
+              f'{candidates_df.shape[0] - merged_df.shape[0]} without matching recording, with results in memory or of a replaced video).')
                 
                 
             
@@ -135,4 +451,3 @@ class Database:
             
             
             
-        
\ No newline at end of file
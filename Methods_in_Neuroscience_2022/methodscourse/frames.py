@@ -0,0 +1,264 @@
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+
+from typing import Dict, Iterator, List, Tuple, Optional
+
+
+FRAMES_PER_SECOND = 30
+COLOR_MODES = ['rgb', 'luminance', 'red', 'green', 'blue']
+LUMINANCE_WEIGHTS = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32)
+# rows of the frames that contain the vial (see FlyDetector.crop_vial)
+VIAL_REGION_ROWS = (200, 1000)
+# columns kept in the frame cache on both sides of the vial: covers a cropping_buffer_zone of up to 200 pixels
+# plus the 100 pixels that are always added around the cropped vial
+FRAME_CACHE_COLUMN_MARGIN = 300
+# total size of the frame cache on disk, the least recently used recordings are removed first once it is exceeded
+FRAME_CACHE_MAX_BYTES = 1024**3
+# bytes read from the start and the end of a video for its fingerprint (see get_video_fingerprint)
+VIDEO_FINGERPRINT_BYTES = 65536
+# number of frames the temporal median background of a video is computed from (see FrameLoader.get_median_background)
+BACKGROUND_SAMPLE_FRAMES = 11
+
+
+def get_frame_index(time_passed: int) -> int:
+    return time_passed*FRAMES_PER_SECOND
+
+
+def get_video_signature(video_filepath: str) -> Tuple[int, int]:
+    stat = os.stat(video_filepath)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def get_video_fingerprint(video_filepath: str, n_bytes: int=VIDEO_FINGERPRINT_BYTES) -> str:
+    # Hash of the size and of the first and last n_bytes of the video. Unlike the mtime, it doesn't change when the 
+    # video is only touched or copied, but it does when the video is re-recorded or re-converted.
+    import hashlib
+    size = os.stat(video_filepath).st_size
+    digest = hashlib.sha1(str(size).encode())
+    with open(video_filepath, 'rb') as io:
+        digest.update(io.read(n_bytes))
+        if size > n_bytes:
+            io.seek(max(size - n_bytes, n_bytes))
+            digest.update(io.read(n_bytes))
+    return digest.hexdigest()
+
+
+def convert_color_mode(image: np.ndarray, color_mode: str) -> np.ndarray:
+    # 'rgb' keeps the image untouched, all other modes return a single-channel float32 image
+    if color_mode not in COLOR_MODES:
+        raise ValueError(f'"color_mode" has to be one of {COLOR_MODES}, not: {color_mode}')
+    if (color_mode == 'rgb') or (image.ndim == 2):
+        return image
+    if color_mode == 'luminance':
+        return np.dot(image[..., :3].astype(np.float32), LUMINANCE_WEIGHTS)
+    return image[..., COLOR_MODES.index(color_mode) - 2].astype(np.float32)
+
+
+def downscale_image(image: np.ndarray, factor: int) -> np.ndarray:
+    # Mean of every factor x factor block of pixels (incomplete blocks at the borders are dropped)
+    if factor == 1:
+        return image
+    rows, cols = image.shape[0] // factor * factor, image.shape[1] // factor * factor
+    # summing up the factor x factor strided views is considerably faster than a mean over a reshaped image
+    downscaled_image = np.zeros((rows // factor, cols // factor, *image.shape[2:]), dtype=np.float32)
+    for row_shift in range(factor):
+        for col_shift in range(factor):
+            downscaled_image += image[row_shift : rows : factor, col_shift : cols : factor]
+    downscaled_image /= factor**2
+    return downscaled_image
+
+
+class FrameLoader:
+
+    def __init__(self, max_cached_videos: int=3):
+        self.max_cached_videos = max_cached_videos
+        self.cached_frames = OrderedDict()
+        self.cached_backgrounds = OrderedDict()
+        self.decode_count = 0
+
+
+    def get_frames(self, video_filepath: str, times_passed: List[int], color_mode: str='rgb') -> Dict[int, np.ndarray]:
+        signature = get_video_signature(video_filepath)
+        cache_key = (video_filepath, color_mode)
+        if cache_key in self.cached_frames and self.cached_frames[cache_key][0] == signature:
+            frames = self.cached_frames[cache_key][1]
+            self.cached_frames.move_to_end(cache_key)
+        else:
+            frames = dict()
+        missing_frame_indices = [get_frame_index(time_passed) for time_passed in times_passed if get_frame_index(time_passed) not in frames]
+        if len(missing_frame_indices) > 0:
+            for frame_index, frame in self.read_frames(video_filepath, missing_frame_indices).items():
+                frames[frame_index] = convert_color_mode(frame, color_mode)
+            self.add_to_cache(cache_key, signature, frames)
+        return {time_passed: frames[get_frame_index(time_passed)] for time_passed in times_passed}
+
+
+    def get_frame(self, video_filepath: str, time_passed: int, color_mode: str='rgb') -> np.ndarray:
+        return self.get_frames(video_filepath, [time_passed], color_mode)[time_passed]
+
+
+    def get_median_background(self, video_filepath: str, last_frame_index: int, color_mode: str='rgb', 
+                              n_sample_frames: int=BACKGROUND_SAMPLE_FRAMES) -> np.ndarray:
+        # Temporal median of n_sample_frames frames spread evenly over the frames 0 to last_frame_index, all taken from 
+        # a single decoding pass. Only the VIAL_REGION_ROWS of the frames are used. The sampled frames are added to the
+        # cached frames - with the defaults they are 0.5 s apart and include all analyzed timepoints, which are then
+        # not decoded a second time. The background is cached per video like the frames.
+        signature = get_video_signature(video_filepath)
+        cache_key = (video_filepath, color_mode, last_frame_index, n_sample_frames)
+        if cache_key in self.cached_backgrounds and self.cached_backgrounds[cache_key][0] == signature:
+            self.cached_backgrounds.move_to_end(cache_key)
+            return self.cached_backgrounds[cache_key][1]
+        frame_indices = np.unique(np.linspace(0, last_frame_index, n_sample_frames).round().astype(int)).tolist()
+        frames = {frame_index: convert_color_mode(frame, color_mode) for frame_index, frame in self.read_frames(video_filepath, frame_indices).items()}
+        background = np.median(np.stack([frames[frame_index][VIAL_REGION_ROWS[0] : VIAL_REGION_ROWS[1]] for frame_index in frame_indices]), 
+                               axis = 0).astype(np.float32)
+        frames_cache_key = (video_filepath, color_mode)
+        if frames_cache_key in self.cached_frames and self.cached_frames[frames_cache_key][0] == signature:
+            frames = {**frames, **self.cached_frames[frames_cache_key][1]}
+        self.add_to_cache(frames_cache_key, signature, frames)
+        self.cached_backgrounds[cache_key] = (signature, background)
+        while len(self.cached_backgrounds) > self.max_cached_videos:
+            self.cached_backgrounds.popitem(last = False)
+        return background
+
+
+    def iter_frames(self, video_filepath: str, frame_step: int=1) -> Iterator[Tuple[int, np.ndarray]]:
+        # Streams every frame_step-th frame of the whole video front to back, without caching any of them
+        import imageio as iio
+        reader = iio.get_reader(video_filepath)
+        self.decode_count += 1
+        try:
+            for frame_index, frame in enumerate(reader):
+                if frame_index % frame_step == 0:
+                    yield frame_index, np.asarray(frame)
+        finally:
+            reader.close()
+
+
+    def read_frames(self, video_filepath: str, frame_indices: List[int]) -> Dict[int, np.ndarray]:
+        # Decode the video once, front to back, and keep only the requested frames. Seeking with
+        # get_data() for every frame would re-open the container and decode from the previous keyframe.
+        import imageio as iio
+        frame_indices_to_read = set(frame_indices)
+        last_frame_index = max(frame_indices_to_read)
+        frames = dict()
+        reader = iio.get_reader(video_filepath)
+        try:
+            for frame_index, frame in enumerate(reader):
+                if frame_index in frame_indices_to_read:
+                    frames[frame_index] = np.asarray(frame)
+                if frame_index >= last_frame_index:
+                    break
+        finally:
+            reader.close()
+        self.decode_count += 1
+        missing_frame_indices = frame_indices_to_read - set(frames.keys())
+        if len(missing_frame_indices) > 0:
+            raise IndexError(f'Frame(s) {sorted(missing_frame_indices)} exceed the length of {video_filepath}.')
+        return frames
+
+
+    def add_to_cache(self, cache_key: Tuple[str, str], signature: Tuple[int, int], frames: Dict[int, np.ndarray]):
+        self.cached_frames[cache_key] = (signature, frames)
+        self.cached_frames.move_to_end(cache_key)
+        while len(self.cached_frames) > self.max_cached_videos:
+            self.cached_frames.popitem(last = False)
+
+
+    def clear_cache(self):
+        self.cached_frames = OrderedDict()
+        self.cached_backgrounds = OrderedDict()
+
+
+
+class FrameCache:
+
+    # Vial regions (VIAL_REGION_ROWS and the vial columns +/- FRAME_CACHE_COLUMN_MARGIN) of the decoded timepoints,
+    # stored as one .npy file per recording and color mode and read back as memory-mapped array, so that repeated
+    # detections, parameter sweeps and inspections don't decode the video again. The .json next to it holds the
+    # timepoints, the position of the region in the frame and the signature of the video it was taken from.
+    # Regions of a video that changed since are removed when they are requested, the total size of the cache is
+    # bounded by max_size_bytes (least recently used recordings are removed first).
+
+    def __init__(self, cache_dir: str, max_size_bytes: int=FRAME_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+
+
+    def get(self, file_id: str, color_mode: str, video_signature: Tuple[int, int]) -> Optional[Tuple[Dict[int, np.ndarray], Tuple[int, int]]]:
+        # Returns the cached regions by time_passed and the (row, col) offset of the regions in the frame
+        frames_filepath, index_filepath = self.get_filepaths(file_id, color_mode)
+        if (os.path.isfile(index_filepath) == False) or (os.path.isfile(frames_filepath) == False):
+            return None
+        with open(index_filepath, 'r') as io:
+            index = json.load(io)
+        if index['video_signature'] != list(video_signature):
+            self.remove(file_id, color_mode)
+            return None
+        frames = np.load(frames_filepath, mmap_mode = 'r')
+        # guards against a .npy that was replaced without its .json (e.g. an interrupted write)
+        if frames.shape[0] != len(index['times_passed']):
+            return None
+        # the modification time of the .npy marks when it was used last
+        os.utime(frames_filepath)
+        return {time_passed: frames[i] for i, time_passed in enumerate(index['times_passed'])}, tuple(index['offset'])
+
+
+    def put(self, file_id: str, color_mode: str, video_signature: Tuple[int, int], frames: Dict[int, np.ndarray], vial_col_range: Tuple[int, int]):
+        # frames: full frames by time_passed, vial_col_range: (min_col_idx, max_col_idx) of the localized vial
+        offset = (VIAL_REGION_ROWS[0], max(vial_col_range[0] - FRAME_CACHE_COLUMN_MARGIN, 0))
+        regions = {time_passed: frame[VIAL_REGION_ROWS[0] : VIAL_REGION_ROWS[1], offset[1] : vial_col_range[1] + FRAME_CACHE_COLUMN_MARGIN]
+                   for time_passed, frame in frames.items()}
+        # timepoints that were cached before for the same video and region are kept
+        cached_frames = self.get(file_id, color_mode, video_signature)
+        if cached_frames != None and cached_frames[1] == offset:
+            first_region = next(iter(regions.values()))
+            for time_passed, region in cached_frames[0].items():
+                if (time_passed not in regions) and (region.shape == first_region.shape) and (region.dtype == first_region.dtype):
+                    regions[time_passed] = np.array(region)
+        times_passed = sorted(regions.keys())
+        if os.path.isdir(self.cache_dir) == False:
+            os.mkdir(self.cache_dir)
+        frames_filepath, index_filepath = self.get_filepaths(file_id, color_mode)
+        # written to temporary files first, so that a memory map of the previous version stays valid and an
+        # interrupted write never leaves a truncated cache behind
+        with open(frames_filepath + '.part', 'wb') as io:
+            np.save(io, np.stack([regions[time_passed] for time_passed in times_passed]))
+        with open(index_filepath + '.part', 'w') as io:
+            json.dump({'times_passed': times_passed, 'offset': list(offset), 'video_signature': list(video_signature)}, io)
+        os.replace(frames_filepath + '.part', frames_filepath)
+        os.replace(index_filepath + '.part', index_filepath)
+        self.remove_least_recently_used(keep_filepath = frames_filepath)
+
+
+    def remove_least_recently_used(self, keep_filepath: str):
+        frames_filepaths = [entry.path for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npy')]
+        frames_filepaths.sort(key = lambda filepath: os.stat(filepath).st_mtime_ns)
+        cache_size = sum(os.stat(filepath).st_size for filepath in frames_filepaths)
+        for filepath in frames_filepaths:
+            if cache_size <= self.max_size_bytes:
+                return
+            if filepath != keep_filepath:
+                cache_size -= os.stat(filepath).st_size
+                os.remove(filepath)
+                if os.path.isfile(filepath[:-len('.npy')] + '.json'):
+                    os.remove(filepath[:-len('.npy')] + '.json')
+
+
+    def remove(self, file_id: str, color_mode: str):
+        for filepath in self.get_filepaths(file_id, color_mode):
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.npy') or entry.name.endswith('.json'):
+                    os.remove(entry.path)
+
+
+    def get_filepaths(self, file_id: str, color_mode: str) -> Tuple[str, str]:
+        return f'{self.cache_dir}{file_id}_{color_mode}.npy', f'{self.cache_dir}{file_id}_{color_mode}.json'
@@ -114,6 +114,10 @@ class RecordingsTab:
                                         layout={'width': '30%'},
                                         style={'description_width': 'initial'})
         
+        self.check_live_count = w.Checkbox(description='Live count of climbing flies (preliminary)', 
+                                           value=False, 
+                                           style={'description_width': 'initial'})
+        
         self.confirm_selection_button = w.Button(description='confirm selection')
         
         self.trigger_recording_button = w.Button(description='trigger recording',
@@ -123,6 +127,7 @@ class RecordingsTab:
                               w.HBox([self.select_group_id,
                                       self.select_vial_id,
                                       self.select_stimulus_indicator]),
+                              self.check_live_count,
                               w.HBox([self.confirm_selection_button,
                                       self.trigger_recording_button])])
         
@@ -141,7 +146,8 @@ class RecordingsTab:
         vial_id = self.select_vial_id.value
         stimulus_indicator = self.select_stimulus_indicator.value
         
-        self.api.record_experiment(group_id = group_id, vial_id = vial_id, stimulus_indicator = stimulus_indicator)
+        self.api.record_experiment(group_id = group_id, vial_id = vial_id, stimulus_indicator = stimulus_indicator, 
+                                   live_count = self.check_live_count.value)
 
 
 
@@ -195,6 +201,21 @@ class AnalysisTab:
                                           value=False,
                                           style={'description_width': 'initial'},
                                           layout={'width': '45%'})
+        self.check_frame_cache = w.Checkbox(description='Cache decoded frames for repeated detections?', 
+                                            value=False,
+                                            style={'description_width': 'initial'},
+                                            layout={'width': '45%'})
+        self.select_workers = w.IntSlider(description='Parallel workers (CPU cores):', 
+                                          value=1, 
+                                          min=1, 
+                                          max=os.cpu_count(),
+                                          style={'description_width': 'initial'},
+                                          layout={'width': '45%'})
+        self.select_color_mode = w.Dropdown(description='Color mode:',
+                                            options=['rgb', 'luminance', 'red', 'green', 'blue'],
+                                            value='rgb',
+                                            style={'description_width': 'initial'},
+                                            layout={'width': '45%'})
         self.confirm_selection_button = w.Button(description='confirm selection')
         self.trigger_analysis_button = w.Button(description='run fly detection', 
                                                 layout={'visibility': 'hidden'})
@@ -204,6 +225,8 @@ class AnalysisTab:
                                       self.please_specify_additional_settings,
                                       w.HBox([self.select_cropping_buffer_zone, self.select_min_climbing_height]),
                                       w.HBox([self.select_threshold, self.select_min_distance]),
+                                      w.HBox([self.select_workers, self.select_color_mode]),
+                                      self.check_frame_cache,
                                       w.HBox([self.check_overwrite, 
                                               self.check_quick_view,
                                               self.confirm_selection_button,
@@ -299,7 +322,10 @@ class AnalysisTab:
                                   threshold = self.select_threshold.value,
                                   min_distance = self.select_min_distance.value,
                                   overwrite = self.check_overwrite.value,
-                                  quick_view = self.check_quick_view.value)
+                                  quick_view = self.check_quick_view.value,
+                                  workers = self.select_workers.value,
+                                  color_mode = self.select_color_mode.value,
+                                  use_frame_cache = self.check_frame_cache.value)
             print('######################')
             print('#########DONE#########')
             print('######################')
@@ -0,0 +1,191 @@
+import time
+import queue
+import shutil
+import threading
+import numpy as np
+
+from .database import Database
+from .analysis import FLY_COORDS_OFFSET, CROPPING_BUFFER_ZONE, MIN_DISTANCE, MIN_CLIMBING_HEIGHT, find_foam_peaks, get_boundaries, get_corrected_flies_mask
+from .matching import MatchingEngine
+from .frames import FRAMES_PER_SECOND, convert_color_mode, downscale_image
+from .templates import FOAM_TEMPLATE_FILENAME
+
+from typing import Dict, Tuple
+
+
+LIVE_DOWNSCALE_FACTOR = 2
+# (width, height) of the frames captured from the video port - picamera requires multiples of 32 and 16
+LIVE_RESOLUTION = (960, 544)
+LIVE_COLOR_MODE = 'luminance'
+# With fewer pixels per template, background noise reaches higher correlations than in the full resolution frames
+LIVE_THRESHOLD = 0.5
+
+
+class LiveFlyCounter:
+
+    # Lightweight version of the FlyDetector for preliminary counts on the Pi while a video is recorded: works on
+    # downscaled single-channel frames with downscaled templates (cached until the template files change) and
+    # runs in a background thread, so that capturing frames never waits for the detection. All coordinates are
+    # reported in full resolution, the counts are stored in Database.live_counts.
+
+    def __init__(self,
+                 database: Database,
+                 downscale_factor: int=LIVE_DOWNSCALE_FACTOR,
+                 cropping_buffer_zone: int=CROPPING_BUFFER_ZONE,
+                 min_climbing_height: int=MIN_CLIMBING_HEIGHT,
+                 threshold: float=LIVE_THRESHOLD,
+                 min_distance: int=MIN_DISTANCE):
+        self.database = database
+        self.downscale_factor = downscale_factor
+        self.cropping_buffer_zone = cropping_buffer_zone
+        self.min_climbing_height = min_climbing_height
+        self.threshold = threshold
+        self.min_distance = min_distance
+        self.cached_templates = dict()
+        self.vial_boundaries = dict()
+        self.frames_queue = queue.Queue()
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target = self.count_queued_frames, daemon = True)
+        self.thread.start()
+
+
+    def submit(self, file_id: str, time_passed: int, frame: np.ndarray, vial_position: int=1, vials_in_recording: int=1):
+        self.frames_queue.put((file_id, time_passed, frame, vial_position, vials_in_recording))
+
+
+    def stop(self):
+        # waits until all submitted frames are counted
+        self.frames_queue.put(None)
+        self.thread.join()
+
+
+    def count_queued_frames(self):
+        while True:
+            item = self.frames_queue.get()
+            if item == None:
+                return
+            file_id, time_passed, frame, vial_position, vials_in_recording = item
+            try:
+                self.count_flies(file_id = file_id, time_passed = time_passed, frame = frame, 
+                                 vial_position = vial_position, vials_in_recording = vials_in_recording)
+            except Exception as error:
+                print(f'Live count failed for file_id: {file_id} at {time_passed} s ({repr(error)}).')
+
+
+    def count_flies(self, file_id: str, time_passed: int, frame: np.ndarray, vial_position: int=1, vials_in_recording: int=1) -> Tuple[np.ndarray, Tuple, np.ndarray]:
+        # frame: already downscaled by downscale_factor (e.g. by the camera's resizer)
+        image = convert_color_mode(frame, LIVE_COLOR_MODE)
+        if file_id not in self.vial_boundaries:
+            self.vial_boundaries[file_id] = self.localize_vial(image, vial_position, vials_in_recording)
+        min_col_idx, max_col_idx = self.vial_boundaries[file_id]
+        vial_cropping_coords = (min_col_idx - self.cropping_buffer_zone, max_col_idx + self.cropping_buffer_zone)
+        # same cropping as FlyDetector.crop_vial, in downscaled coordinates
+        factor = self.downscale_factor
+        vial = image[200 // factor : 1000 // factor, (vial_cropping_coords[0] - 100) // factor : (vial_cropping_coords[1] + 100) // factor]
+
+        template_flies = list(self.get_templates('flies').values())
+        template_bkgrs = list(self.get_templates('backgrounds').values())
+        bkgr_corrected_results = MatchingEngine(vial).match_fly_and_background_banks(template_flies, template_bkgrs)
+
+        from skimage.feature import peak_local_max
+        flies_xy = peak_local_max(bkgr_corrected_results, min_distance=max(self.min_distance // factor, 1), threshold_abs=self.threshold)
+        all_fly_coords = (flies_xy * factor + FLY_COORDS_OFFSET).astype(np.int32)
+        corrected_fly_coords = all_fly_coords[get_corrected_flies_mask(all_fly_coords, vial.shape[1] * factor, self.min_climbing_height)]
+        self.database.add_live_count(file_id = file_id,
+                                     time_passed = time_passed,
+                                     all_fly_coords = all_fly_coords,
+                                     vial_cropping_coords = vial_cropping_coords,
+                                     corrected_fly_coords = corrected_fly_coords)
+        return all_fly_coords, vial_cropping_coords, corrected_fly_coords
+
+
+    def localize_vial(self, image: np.ndarray, vial_position: int=1, vials_in_recording: int=1) -> Tuple[int, int]:
+        factor = self.downscale_factor
+        foam_template = self.get_templates('foam')[FOAM_TEMPLATE_FILENAME]
+        foam_results = MatchingEngine(image[0 : 500 // factor]).match_template_bank([foam_template])
+        row_idx, col_idx = find_foam_peaks(foam_results, n_peaks = vials_in_recording, min_col_distance = foam_template.shape[1])[vial_position - 1]
+        min_col_idx, max_col_idx = get_boundaries(foam_results[row_idx], col_idx, half_window_size = max(5 // factor, 1))
+        # Transform back to the coordinates of the full resolution image
+        return (int((min_col_idx + foam_template.shape[1] / 2) * factor),
+                int((max_col_idx + foam_template.shape[1] / 2) * factor))
+
+
+    def get_templates(self, category: str) -> Dict[str, np.ndarray]:
+        signature = self.database.template_bank.get_signature(category)
+        if (category not in self.cached_templates) or (self.cached_templates[category][0] != signature):
+            templates = self.database.template_bank.get_templates_by_filename(category, color_mode = LIVE_COLOR_MODE)
+            self.cached_templates[category] = (signature, {filename: downscale_image(template, self.downscale_factor)
+                                                           for filename, template in templates.items()})
+        return self.cached_templates[category][1]
+
+
+class ReplayCamera:
+
+    # Stand-in for picamera.PiCamera to test the live mode without a Pi: "recording" copies a local video file to the
+    # output and captures from the video port return the frame of this video at the time passed since start_recording.
+    # The video is decoded front to back while the recording "runs", just like a camera only delivers new frames.
+    # Only the parts of the PiCamera interface that are used by the Recorder are implemented.
+
+    def __init__(self, video_filepath: str):
+        self.video_filepath = video_filepath
+        self.recording_start_time = None
+        self.reader = None
+        self.captured_frame_indices = list()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def start_preview(self):
+        pass
+
+
+    def stop_preview(self):
+        pass
+
+
+    def start_recording(self, output: str, splitter_port: int=1):
+        import imageio as iio
+        shutil.copyfile(self.video_filepath, output)
+        self.reader = iio.get_reader(self.video_filepath)
+        self.frames = enumerate(self.reader)
+        self.recording_start_time = time.monotonic()
+
+
+    def wait_recording(self, timeout: float=0, splitter_port: int=1):
+        time.sleep(timeout)
+
+
+    def stop_recording(self, splitter_port: int=1):
+        self.close()
+
+
+    def capture(self, output: np.ndarray, format: str='rgb', use_video_port: bool=False, resize: Tuple[int, int]=None, splitter_port: int=0):
+        if (self.recording_start_time == None) or (use_video_port == False):
+            raise RuntimeError('ReplayCamera only supports captures from the video port while recording.')
+        requested_frame_index = int(round((time.monotonic() - self.recording_start_time) * FRAMES_PER_SECOND))
+        for frame_index, frame in self.frames:
+            if frame_index >= requested_frame_index:
+                break
+        else:
+            raise IndexError(f'{self.video_filepath} is shorter than the time passed since start_recording.')
+        frame = np.asarray(frame)
+        self.captured_frame_indices.append(frame_index)
+        if resize != None:
+            frame = downscale_image(frame, frame.shape[1] // resize[0]).astype(np.uint8)[:resize[1], :resize[0]]
+        output[:frame.shape[0], :frame.shape[1]] = frame
+
+
+    def close(self):
+        if self.reader != None:
+            self.reader.close()
+        self.reader = None
+        self.recording_start_time = None
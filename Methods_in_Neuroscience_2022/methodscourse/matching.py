@@ -0,0 +1,224 @@
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+
+from .frames import downscale_image
+
+from typing import List, Tuple, Optional
+
+
+# the coarse response map is thresholded lower than the final response map, as fly responses are blurred by the downscaling
+PYRAMID_THRESHOLD_MARGIN = 0.05
+
+
+class MatchingEngine:
+
+    # Normalized cross-correlation (as in skimage.feature.match_template, pad_input=False) of one image
+    # against whole stacks of equally shaped templates. The image-side FFT and the local window statistics
+    # are computed once per image and reused for every template stack that is matched against it.
+    # Templates must have as many channels as the image, the response map is always 2D.
+
+    def __init__(self, image: np.ndarray):
+        if image.ndim not in [2, 3]:
+            raise ValueError('Only 2D (single-channel) or 3D (multi-channel) images are supported.')
+        self.image = image.astype(np.float64, copy=False)
+        self.image_ffts = dict()
+        self.local_statistics = dict()
+
+
+    def match_template_bank(self, templates: List[np.ndarray]) -> np.ndarray:
+        weights = np.full(len(templates), 1/len(templates))
+        return self.correlate_template_stack(templates = templates, weights = weights)
+
+
+    def match_fly_and_background_banks(self, template_flies: List[np.ndarray], template_bkgrs: List[np.ndarray], 
+                                       positions: Optional[np.ndarray]=None) -> np.ndarray:
+        # Mean of all fly responses minus mean of all background responses. As both means are linear in the
+        # normalized templates, the whole computation collapses into a single correlation with a combined kernel.
+        # With (n, 2) positions, only these n values of the response map are computed.
+        weights = np.concatenate([np.full(len(template_flies), 1/len(template_flies)),
+                                  np.full(len(template_bkgrs), -1/len(template_bkgrs))])
+        if positions is not None:
+            return self.correlate_template_stack_at_positions(templates = template_flies + template_bkgrs, weights = weights, positions = positions)
+        return self.correlate_template_stack(templates = template_flies + template_bkgrs, weights = weights)
+
+
+    def correlate_template_stack(self, templates: List[np.ndarray], weights: np.ndarray) -> np.ndarray:
+        from scipy import fft
+        template_shape = self.get_template_shape(templates = templates)
+        kernel = self.build_kernel(templates = templates, weights = weights)
+        window_sum, window_norm = self.get_local_statistics(template_shape = template_shape)
+
+        fft_shape = tuple(fft.next_fast_len(self.image.shape[axis] + template_shape[axis] - 1, real = True) for axis in range(2))
+        # Correlation equals convolution with the flipped kernel; the channels are summed up in frequency space.
+        kernel_fft = fft.rfft2(kernel[::-1, ::-1], s = fft_shape, axes = (0, 1))
+        product = self.get_image_fft(fft_shape = fft_shape) * kernel_fft
+        if product.ndim == 3:
+            product = product.sum(axis = 2)
+        xcorr = fft.irfft2(product, s = fft_shape)
+        xcorr = xcorr[template_shape[0] - 1 : self.image.shape[0], template_shape[1] - 1 : self.image.shape[1]]
+
+        response = np.zeros_like(xcorr)
+        mask = window_norm > np.finfo(np.float64).eps
+        response[mask] = xcorr[mask] / window_norm[mask]
+        return response
+
+
+    def correlate_template_stack_at_positions(self, templates: List[np.ndarray], weights: np.ndarray, positions: np.ndarray,
+                                              chunk_size: int=512) -> np.ndarray:
+        # Direct evaluation of the correlation at a few (row, col) positions of the response map - cheaper than the
+        # FFT as long as these are only a small fraction of the response map. The window statistics are computed
+        # for these positions only, too.
+        template_shape = self.get_template_shape(templates = templates)
+        kernel = self.build_kernel(templates = templates, weights = weights)
+        windows = np.lib.stride_tricks.sliding_window_view(self.image, template_shape[:2], axis = (0, 1))
+        # windows: (rows, cols, [channels,] template rows, template cols) - the kernel is brought into the same order
+        kernel = np.moveaxis(kernel, [0, 1], [-2, -1]) if kernel.ndim == 3 else kernel
+        window_volume = kernel.size
+        xcorr, norms = np.empty(len(positions), dtype=np.float64), np.empty(len(positions), dtype=np.float64)
+        for start in range(0, len(positions), chunk_size):
+            rows, cols = positions[start : start + chunk_size].T
+            position_windows = windows[rows, cols].reshape(len(rows), window_volume)
+            xcorr[start : start + chunk_size] = position_windows @ kernel.reshape(window_volume)
+            window_variance = np.einsum('ij,ij->i', position_windows, position_windows) - position_windows.sum(axis = 1)**2 / window_volume
+            norms[start : start + chunk_size] = np.sqrt(np.maximum(window_variance, 0))
+        response = np.zeros_like(xcorr)
+        mask = norms > np.finfo(np.float64).eps
+        response[mask] = xcorr[mask] / norms[mask]
+        return response
+
+
+    def get_template_shape(self, templates: List[np.ndarray]) -> Tuple:
+        template_shapes = set(template.shape for template in templates)
+        if len(template_shapes) != 1:
+            raise ValueError(f'All templates of a stack must have the same shape, found: {sorted(template_shapes)}.')
+        template_shape = template_shapes.pop()
+        if (len(template_shape) != self.image.ndim) or (template_shape[2:] != self.image.shape[2:]):
+            raise ValueError('Templates must have the same number of channels as the image.')
+        if np.any(np.less(self.image.shape[:2], template_shape[:2])):
+            raise ValueError('Image must be larger than template.')
+        return template_shape
+
+
+    def build_kernel(self, templates: List[np.ndarray], weights: np.ndarray) -> np.ndarray:
+        # Every template is mean-centered and scaled to unit norm, which makes the numerator of the normalized
+        # cross-correlation a plain correlation. Weighted sum of the whole stack = one kernel.
+        stack = np.stack(templates).astype(np.float64)
+        axes = tuple(range(1, stack.ndim))
+        stack -= stack.mean(axis = axes, keepdims = True)
+        template_norms = np.sqrt(np.sum(stack**2, axis = axes))
+        template_norms[template_norms == 0] = np.inf
+        return np.tensordot(weights / template_norms, stack, axes = 1)
+
+
+    def get_image_fft(self, fft_shape: Tuple[int, int]) -> np.ndarray:
+        if fft_shape not in self.image_ffts:
+            from scipy import fft
+            self.image_ffts[fft_shape] = fft.rfft2(self.image, s = fft_shape, axes = (0, 1))
+        return self.image_ffts[fft_shape]
+
+
+    def get_local_statistics(self, template_shape: Tuple) -> Tuple[np.ndarray, np.ndarray]:
+        window_shape = template_shape[:2]
+        if window_shape not in self.local_statistics:
+            window_sum = self.compute_window_sum(image = self.image, window_shape = window_shape)
+            window_sum2 = self.compute_window_sum(image = self.image**2, window_shape = window_shape)
+            window_volume = window_shape[0] * window_shape[1] * (self.image.shape[2] if self.image.ndim == 3 else 1)
+            window_variance = window_sum2 - window_sum**2 / window_volume
+            np.maximum(window_variance, 0, out = window_variance)
+            self.local_statistics[window_shape] = (window_sum, np.sqrt(window_variance))
+        return self.local_statistics[window_shape]
+
+
+    def compute_window_sum(self, image: np.ndarray, window_shape: Tuple[int, int]) -> np.ndarray:
+        if image.ndim == 3:
+            image = image.sum(axis = 2)
+        window_sum = np.cumsum(np.pad(image, ((1, 0), (1, 0))), axis = 0)
+        window_sum = window_sum[window_shape[0]:] - window_sum[:-window_shape[0]]
+        window_sum = np.cumsum(window_sum, axis = 1)
+        window_sum = window_sum[:, window_shape[1]:] - window_sum[:, :-window_shape[1]]
+        return window_sum
+
+
+def match_coarse_to_fine(image: np.ndarray, template_flies: List[np.ndarray], template_bkgrs: List[np.ndarray], 
+                         factor: int, coarse_threshold: float, min_distance: int) -> np.ndarray:
+    # Image pyramid version of MatchingEngine.match_fly_and_background_banks: the banks are matched against the
+    # image downscaled by "factor" first. The full resolution response is then only computed in small windows around
+    # the local maxima (at least min_distance apart) of the coarse response above coarse_threshold - it is identical 
+    # to the exhaustive response within these windows. All other values of the returned map are 0.
+    from scipy import ndimage
+    template_shape = template_flies[0].shape
+    response_shape = (image.shape[0] - template_shape[0] + 1, image.shape[1] - template_shape[1] + 1)
+    coarse_results = MatchingEngine(downscale_image(image, factor)).match_fly_and_background_banks(
+        [downscale_image(template, factor) for template in template_flies],
+        [downscale_image(template, factor) for template in template_bkgrs])
+    coarse_min_distance = max(min_distance // factor, 1)
+    local_maxima = coarse_results == ndimage.maximum_filter(coarse_results, size = 2*coarse_min_distance + 1, mode = 'constant', cval = -np.inf)
+    candidates = np.argwhere(local_maxima & (coarse_results >= coarse_threshold))
+    # Every coarse response covers factor x factor positions of the full resolution response, the windows add
+    # another factor pixels on each side for the shift introduced by downscaling image and templates
+    refine_radius = factor
+    windows = np.zeros(response_shape, dtype=bool)
+    for row, col in candidates * factor:
+        windows[max(row - refine_radius, 0) : row + factor + refine_radius, max(col - refine_radius, 0) : col + factor + refine_radius] = True
+    positions = np.argwhere(windows)
+    bkgr_corrected_results = np.zeros(response_shape, dtype=np.float64)
+    bkgr_corrected_results[windows] = MatchingEngine(image).match_fly_and_background_banks(template_flies, template_bkgrs, positions = positions)
+    return bkgr_corrected_results
+
+
+class ResponseMapCache:
+
+    # Keeps the background corrected response maps of each (file_id, time_passed) in memory (least recently used
+    # maps are dropped first) and optionally as compressed .npz files on disk. A map is only returned if it was
+    # computed with the same signature (video, vial cropping, color mode & templates).
+
+    def __init__(self, cache_dir: str, max_cached_maps: int=100):
+        self.cache_dir = cache_dir
+        self.max_cached_maps = max_cached_maps
+        self.cached_maps = OrderedDict()
+
+
+    def get(self, file_id: str, time_passed: int, signature: Tuple) -> Optional[Tuple[np.ndarray, int]]:
+        signature = json.dumps(signature)
+        cache_key = (file_id, time_passed)
+        if cache_key in self.cached_maps:
+            if self.cached_maps[cache_key][0] == signature:
+                self.cached_maps.move_to_end(cache_key)
+                return self.cached_maps[cache_key][1:]
+            self.cached_maps.pop(cache_key)
+        filepath = self.get_filepath(file_id, time_passed)
+        if os.path.isfile(filepath):
+            with np.load(filepath) as cached_file:
+                if str(cached_file['signature']) == signature:
+                    response_map, vial_width = cached_file['response_map'], int(cached_file['vial_width'])
+                    self.add_to_memory(cache_key, signature, response_map, vial_width)
+                    return response_map, vial_width
+        return None
+
+
+    def put(self, file_id: str, time_passed: int, signature: Tuple, response_map: np.ndarray, vial_width: int, persist: bool=False):
+        signature = json.dumps(signature)
+        self.add_to_memory((file_id, time_passed), signature, response_map, vial_width)
+        if persist:
+            if os.path.isdir(self.cache_dir) == False:
+                os.mkdir(self.cache_dir)
+            np.savez_compressed(self.get_filepath(file_id, time_passed), response_map = response_map, vial_width = vial_width, signature = signature)
+
+
+    def get_filepath(self, file_id: str, time_passed: int) -> str:
+        return f'{self.cache_dir}{file_id}_{str(time_passed).zfill(2)}.npz'
+
+
+    def set_max_cached_maps(self, max_cached_maps: int):
+        self.max_cached_maps = max_cached_maps
+        while len(self.cached_maps) > self.max_cached_maps:
+            self.cached_maps.popitem(last = False)
+
+
+    def add_to_memory(self, cache_key: Tuple[str, int], signature: str, response_map: np.ndarray, vial_width: int):
+        self.cached_maps[cache_key] = (signature, response_map, vial_width)
+        self.cached_maps.move_to_end(cache_key)
+        while len(self.cached_maps) > self.max_cached_maps:
+            self.cached_maps.popitem(last = False)
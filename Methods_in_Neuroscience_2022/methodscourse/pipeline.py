@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import queue
+import threading
+
+from .database import Database
+from .analysis import FlyDetector
+from .frames import get_video_signature
+from .templates import TEMPLATE_CATEGORIES
+
+from typing import Callable, Dict, List, Optional
+
+
+FLUSH_EVERY = 10
+QUEUE_DEPTH = 4
+
+
+class DetectionPipeline:
+
+    # Streams the videos through the stages frame-load -> vial-crop -> match -> peak-pick. Every stage runs in its
+    # own thread and hands its output to the next stage via a bounded queue, so at most QUEUE_DEPTH frames / vials /
+    # response maps per stage are held in memory, no matter how many recordings are analyzed. During a run, the 
+    # ResponseMapCache of the database keeps at most QUEUE_DEPTH response maps in memory as well. Items flow per timepoint
+    # as (fly_detector, time_passed, payload); a payload of None marks the end of a file. If a stage fails, the payload
+    # is replaced by the exception and passed on, so that the file is reported as failed at the end of the pipeline.
+    # The results are flushed to the results store every "flush_every" completed files, followed by a checkpoint that
+    # lists all completed file IDs. A restarted pipeline with the same detection settings and templates skips these 
+    # files, unless their video changed since. The checkpoint is removed once a run is completed.
+
+    def __init__(self, database: Database, detector_kwargs: Dict, flush_every: int=FLUSH_EVERY, queue_depth: int=QUEUE_DEPTH, prefix: str='',
+                 progress_callback: Optional[Callable]=None):
+        self.database = database
+        self.detector_kwargs = detector_kwargs
+        self.flush_every = flush_every
+        self.queue_depth = queue_depth
+        self.prefix = prefix
+        self.checkpoint_filepath = f'{self.database.results_dir}{prefix}pipeline_checkpoint.json'
+        # vial localizations are written by the frame-loading and vial-crop stages and pickled during a flush
+        self.database_lock = threading.Lock()
+        self.failed_file_ids = dict()
+        # called as progress_callback(file_id, duration, error) for every file that leaves the pipeline
+        self.progress_callback = progress_callback
+
+
+    def run(self, file_ids: List, resume: bool=True) -> Database:
+        completed_file_ids = self.load_checkpoint() if resume else list()
+        if len(completed_file_ids) > 0:
+            self.database.load_file_infos()
+            print(f'Resuming from checkpoint: {len(completed_file_ids)} file IDs were already completed.')
+        skipped_file_ids = set(completed_file_ids)
+        file_ids_to_analyze = [file_id for file_id in file_ids if file_id not in skipped_file_ids]
+
+        max_cached_maps = self.database.response_map_cache.max_cached_maps
+        self.database.response_map_cache.set_max_cached_maps(min(max_cached_maps, self.queue_depth))
+        try:
+            self.run_stages(file_ids_to_analyze = file_ids_to_analyze, completed_file_ids = completed_file_ids)
+        finally:
+            self.database.response_map_cache.set_max_cached_maps(max_cached_maps)
+        return self.database
+
+
+    def run_stages(self, file_ids_to_analyze: List, completed_file_ids: List):
+        frames_queue = queue.Queue(maxsize = self.queue_depth)
+        vials_queue = queue.Queue(maxsize = self.queue_depth)
+        response_maps_queue = queue.Queue(maxsize = self.queue_depth)
+        stages = [threading.Thread(target = self.load_frames, args = (file_ids_to_analyze, frames_queue), daemon = True),
+                  threading.Thread(target = self.crop_vials, args = (frames_queue, vials_queue), daemon = True),
+                  threading.Thread(target = self.match_vials, args = (vials_queue, response_maps_queue), daemon = True)]
+        for stage in stages:
+            stage.start()
+
+        start_time = time.time()
+        unflushed_file_ids = list()
+        for file_id in self.pick_peaks(response_maps_queue):
+            unflushed_file_ids.append(file_id)
+            if len(unflushed_file_ids) >= self.flush_every:
+                completed_file_ids += unflushed_file_ids
+                self.flush(completed_file_ids)
+                unflushed_file_ids = list()
+        with self.database_lock:
+            self.database.save_file_infos(prefix = self.prefix)
+        for stage in stages:
+            stage.join()
+        # the run is complete, the checkpoint is only needed to resume an interrupted run
+        if os.path.isfile(self.checkpoint_filepath):
+            os.remove(self.checkpoint_filepath)
+        print(f'Analyzed {len(file_ids_to_analyze) - len(self.failed_file_ids)} of {len(file_ids_to_analyze)} file IDs '
+              f'in {round(time.time() - start_time, 2)} seconds.')
+
+
+    def load_frames(self, file_ids: List, frames_queue: queue.Queue):
+        try:
+            for file_id in file_ids:
+                fly_detector = None
+                try:
+                    fly_detector = FlyDetector(file_id = file_id, database = self.database, **self.detector_kwargs)
+                    times_to_load = fly_detector.get_times_to_load()
+                    # reading and writing the frame cache accesses the vial localizations, decoding runs without the lock
+                    with self.database_lock:
+                        images = fly_detector.get_cached_images(times_to_load) if len(times_to_load) > 0 else dict()
+                    if images == None:
+                        images = fly_detector.decode_images(times_to_load)
+                        with self.database_lock:
+                            fly_detector.add_to_frame_cache(images)
+                    if (fly_detector.background_model == 'median') and (len(images) > 0):
+                        # the FrameLoader is only used by this stage - the match stage takes the background from the detector
+                        fly_detector.get_median_background()
+                    for time_passed, image in images.items():
+                        frames_queue.put((fly_detector, time_passed, image))
+                except Exception as error:
+                    frames_queue.put((fly_detector or file_id, None, error))
+                    continue
+                frames_queue.put((fly_detector, None, None))
+        finally:
+            frames_queue.put(None)
+
+
+    def crop_vials(self, frames_queue: queue.Queue, vials_queue: queue.Queue):
+        def crop_vial(fly_detector: FlyDetector, time_passed: int, image):
+            with self.database_lock:
+                return fly_detector.crop_vial(image = image)
+        self.run_stage(frames_queue, vials_queue, crop_vial)
+
+
+    def match_vials(self, vials_queue: queue.Queue, response_maps_queue: queue.Queue):
+        def match_vial(fly_detector: FlyDetector, time_passed: int, cropped_vial):
+            vial_cropping_coords, vial = cropped_vial
+            response_map = fly_detector.match_vial(time_passed = time_passed, vial = vial, vial_cropping_coords = vial_cropping_coords)
+            return vial_cropping_coords, response_map, vial.shape[1]
+        self.run_stage(vials_queue, response_maps_queue, match_vial)
+
+
+    def run_stage(self, input_queue: queue.Queue, output_queue: queue.Queue, process):
+        while True:
+            item = input_queue.get()
+            if item == None:
+                output_queue.put(None)
+                return
+            fly_detector, time_passed, payload = item
+            if (time_passed != None) and (isinstance(payload, Exception) == False):
+                try:
+                    payload = process(fly_detector, time_passed, payload)
+                except Exception as error:
+                    payload = error
+            output_queue.put((fly_detector, time_passed, payload))
+
+
+    def pick_peaks(self, response_maps_queue: queue.Queue):
+        # Yields the file_id of every completed file, after all its results were added to the database
+        detection_results_per_file = dict()
+        last_completion_time = time.time()
+        while True:
+            item = response_maps_queue.get()
+            if item == None:
+                return
+            fly_detector, time_passed, payload = item
+            file_id = fly_detector.file_id if isinstance(fly_detector, FlyDetector) else fly_detector
+            detection_results = detection_results_per_file.setdefault(file_id, list())
+            if isinstance(payload, Exception):
+                detection_results.append(payload)
+            elif time_passed != None:
+                vial_cropping_coords, bkgr_corrected_results, vial_width = payload
+                try:
+                    all_fly_coords, corrected_fly_coords = fly_detector.find_flies(bkgr_corrected_results, vial_width)
+                    detection_results.append({'time_passed': time_passed,
+                                              'all_fly_coords': all_fly_coords,
+                                              'vial_cropping_coords': vial_cropping_coords,
+                                              'corrected_fly_coords': corrected_fly_coords,
+                                              'detection_configs': fly_detector.detection_configs})
+                except Exception as error:
+                    detection_results.append(error)
+
+            if time_passed == None:
+                # with overlapping stages, the time since the previous file left the pipeline is the effective time per file
+                duration, last_completion_time = time.time() - last_completion_time, time.time()
+                errors = [results for results in detection_results_per_file.pop(file_id) if isinstance(results, Exception)]
+                if len(errors) > 0:
+                    self.failed_file_ids[file_id] = repr(errors[0])
+                    print(f'Fly detection failed for file_id: {file_id} ({repr(errors[0])}) - continue with next file.')
+                    if self.progress_callback != None:
+                        self.progress_callback(file_id, duration, repr(errors[0]))
+                    continue
+                for results in detection_results:
+                    self.database.add_detected_flies(file_id = file_id, **results)
+                if self.progress_callback != None:
+                    self.progress_callback(file_id, duration, None)
+                yield file_id
+
+
+    def flush(self, completed_file_ids: List):
+        with self.database_lock:
+            self.database.save_file_infos(prefix = self.prefix)
+        self.save_checkpoint(completed_file_ids)
+
+
+    def load_checkpoint(self) -> List:
+        if os.path.isfile(self.checkpoint_filepath) == False:
+            return list()
+        with open(self.checkpoint_filepath, 'r') as io:
+            checkpoint = json.load(io)
+        # compared after a JSON round trip, as tuples (e.g. ROI polygon vertices) are stored as lists
+        if checkpoint['detector_kwargs'] != json.loads(json.dumps(self.detector_kwargs)):
+            print('The checkpoint was created with different detection settings - starting from scratch.')
+            return list()
+        if checkpoint.get('template_signatures') != json.loads(json.dumps(self.get_template_signatures())):
+            print('The templates changed since the checkpoint was created - starting from scratch.')
+            return list()
+        video_signatures = self.get_video_signatures(checkpoint['completed_file_ids'])
+        completed_file_ids = [file_id for file_id in checkpoint['completed_file_ids'] 
+                              if checkpoint['video_signatures'].get(file_id) == video_signatures[file_id]]
+        if len(completed_file_ids) < len(checkpoint['completed_file_ids']):
+            print(f'The videos of {len(checkpoint["completed_file_ids"]) - len(completed_file_ids)} completed file IDs changed since the checkpoint was created.')
+        return completed_file_ids
+
+
+    def get_template_signatures(self) -> Dict:
+        return {category: self.database.template_bank.get_signature(category) for category in TEMPLATE_CATEGORIES}
+
+
+    def get_video_signatures(self, file_ids: List) -> Dict:
+        # [mtime_ns, size] of the video of every file_id (None if it is not available)
+        video_signatures = dict()
+        for file_id in file_ids:
+            row_positions = self.database.row_positions_by_file_id.get(file_id, list())
+            video_filepaths = [self.database.file_infos['video_filepath'][row_position] for row_position in row_positions[:1]]
+            if (len(video_filepaths) > 0) and os.path.isfile(video_filepaths[0]):
+                video_signatures[file_id] = list(get_video_signature(video_filepaths[0]))
+            else:
+                video_signatures[file_id] = None
+        return video_signatures
+
+
+    def save_checkpoint(self, completed_file_ids: List):
+        # written to a temporary file first, so that a crash during the write never leaves a corrupt checkpoint behind
+        checkpoint = {'completed_file_ids': completed_file_ids,
+                      'failed_file_ids': self.failed_file_ids,
+                      'detector_kwargs': self.detector_kwargs,
+                      'template_signatures': self.get_template_signatures(),
+                      'video_signatures': self.get_video_signatures(completed_file_ids),
+                      'saved_at': time.time()}
+        with open(f'{self.checkpoint_filepath}.tmp', 'w') as io:
+            json.dump(checkpoint, io)
+        os.replace(f'{self.checkpoint_filepath}.tmp', self.checkpoint_filepath)
@@ -1,29 +1,85 @@
-from picamera import PiCamera
-from time import sleep
+from time import sleep, monotonic
 import os
+import numpy as np
 
-from .database import Database
+from .database import Database, TIMEPOINTS_TO_ANALYZE
+from .conversion import RemuxWorker
+
+from typing import Callable, List, Optional, Union
+
+
+RECORDING_DURATION = 8
+# splitter port for the frames of the live mode, the recording itself runs on port 1
+LIVE_SPLITTER_PORT = 2
+
+
+def create_pi_camera():
+    # picamera is only available on the Raspberry Pi and therefore imported once a camera is actually needed
+    from picamera import PiCamera
+    return PiCamera()
 
 
 class Recorder:
-    
-    def __init__(self, database: Database):
+
+    def __init__(self, database: Database, camera_factory: Callable=create_pi_camera, remux_worker: Optional[RemuxWorker]=None):
         self.database = database
-    
-    
-    def start_recording(self, group_id: str, vial_id: int, stimulus_indicator: str):
+        self.camera_factory = camera_factory
+        # if provided, every recording is handed over to the remux worker for the conversion to mp4
+        self.remux_worker = remux_worker
+
+
+    def start_recording(self, group_id: str, vial_id: Union[int, List[int]], stimulus_indicator: str, live_count: bool=False):
+        # vial_id: a list of vial_ids (from left to right) for a recording of several vials next to each other
         file_id = self.database.file_id_tracker_for_recordings
-        filepath = f'{self.database.recordings_dir}{str(file_id).zfill(4)}_{group_id}_{stimulus_indicator}_light_{str(vial_id).zfill(3)}.h264'
+        vial_ids = vial_id if isinstance(vial_id, list) else [vial_id]
+        vial_ids_in_filename = '-'.join(str(vial_id).zfill(3) for vial_id in vial_ids)
+        filepath = f'{self.database.recordings_dir}{str(file_id).zfill(4)}_{group_id}_{stimulus_indicator}_light_{vial_ids_in_filename}.h264'
         if os.path.isfile(filepath):
-            raise InputError('The specified recording already exists! Please check your inputs again.')
+            raise FileExistsError('The specified recording already exists! Please check your inputs again.')
 
-        with PiCamera() as camera:
+        with self.camera_factory() as camera:
             #camera.vflip = True
             camera.start_preview()
             sleep(2)
             camera.start_recording(filepath)
-            sleep(8)
+            if live_count:
+                if len(vial_ids) == 1:
+                    file_ids = [str(file_id).zfill(4)]
+                else:
+                    file_ids = [f'{str(file_id).zfill(4)}-{vial_position}' for vial_position in range(1, len(vial_ids) + 1)]
+                self.count_flies_while_recording(camera = camera, file_ids = file_ids)
+            else:
+                sleep(RECORDING_DURATION)
             camera.stop_preview()
         self.database.file_id_tracker_for_recordings += 1
-        
-        return self.database
\ No newline at end of file
+        if self.remux_worker != None:
+            self.remux_worker.submit(filepath)
+
+        return self.database
+
+
+    def count_flies_while_recording(self, camera, file_ids: List[str]):
+        # Low resolution frames of the analyzed timepoints are taken from the video port via a second splitter port
+        # and resized by the GPU, so the encoder of the running recording doesn't drop any frames. The counting
+        # itself runs in the background thread of the LiveFlyCounter.
+        from .live import LiveFlyCounter, LIVE_RESOLUTION
+        live_fly_counter = LiveFlyCounter(database = self.database)
+        live_fly_counter.start()
+        frame_buffer = np.empty((LIVE_RESOLUTION[1], LIVE_RESOLUTION[0], 3), dtype=np.uint8)
+        recording_start_time = monotonic()
+        try:
+            for time_passed in TIMEPOINTS_TO_ANALYZE:
+                camera.wait_recording(max(time_passed - (monotonic() - recording_start_time), 0))
+                camera.capture(frame_buffer, format='rgb', use_video_port=True, resize=LIVE_RESOLUTION, splitter_port=LIVE_SPLITTER_PORT)
+                frame = frame_buffer.copy()
+                for vial_position, file_id in enumerate(file_ids, start = 1):
+                    live_fly_counter.submit(file_id = file_id, time_passed = time_passed, frame = frame, 
+                                            vial_position = vial_position, vials_in_recording = len(file_ids))
+            camera.wait_recording(max(RECORDING_DURATION - (monotonic() - recording_start_time), 0))
+            camera.stop_recording()
+        finally:
+            live_fly_counter.stop()
+        for file_id in file_ids:
+            counts = [self.database.live_counts.get(file_id, dict()).get(time_passed, dict()).get('corrected_detected_flies')
+                      for time_passed in TIMEPOINTS_TO_ANALYZE]
+            print(f'Preliminary counts of climbing flies for file_id {file_id}: {counts}')
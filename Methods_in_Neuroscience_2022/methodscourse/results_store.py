@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import numpy as np
+
+from typing import Dict, List, Optional, Tuple
+
+
+METADATA_COLUMNS = ['index', 'file_id', 'group_id', 'stimulus_indicator', 'vial_id', 'time_passed', 'video_filepath']
+SCALAR_RESULT_COLUMNS = ['all_detected_flies', 'corrected_detected_flies', 'vial_cropping_coords', 'detection_configs']
+RAGGED_COLUMNS = ['all_fly_coords', 'corrected_fly_coords']
+# signature of the video the results were detected in (size and mtime_ns are -1, the fingerprint is empty if unknown)
+VIDEO_SIGNATURE_COLUMNS = ['video_size', 'video_mtime_ns', 'video_fingerprint']
+
+
+def parquet_engine_available() -> bool:
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+class ResultsStore:
+
+    # Append-only columnar store for the detection results of a Database:
+    #   part_000001.parquet                    scalar columns of all rows written by one save
+    #   part_000001_<ragged column>.npy        all fly coordinates of these rows concatenated into one (n, 2) array,
+    #                                          rows reference their slice via <ragged column>_offset/_length
+    # Every save only appends a new part with the rows that changed. When a row (file_id, time_passed)
+    # is present in several parts, the most recent part wins.
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+
+
+    def get_part_names(self) -> List[str]:
+        if os.path.isdir(self.store_dir) == False:
+            return list()
+        part_names = [filename[:-len('.parquet')] for filename in os.listdir(self.store_dir) if filename.startswith('part_') and filename.endswith('.parquet')]
+        part_names.sort()
+        return part_names
+
+
+    def append(self, rows: Dict[str, List]) -> Optional[str]:
+        if len(rows['index']) == 0:
+            return None
+        if os.path.isdir(self.store_dir) == False:
+            os.mkdir(self.store_dir)
+        existing_part_names = self.get_part_names()
+        if len(existing_part_names) > 0:
+            part_name = f'part_{str(int(existing_part_names[-1][5:]) + 1).zfill(6)}'
+        else:
+            part_name = 'part_000001'
+
+        import pandas as pd
+        scalar_columns = {column: rows[column] for column in METADATA_COLUMNS}
+        scalar_columns['all_detected_flies'] = rows['all_detected_flies']
+        scalar_columns['corrected_detected_flies'] = rows['corrected_detected_flies']
+        scalar_columns['vial_cropping_min'] = [int(coords[0]) for coords in rows['vial_cropping_coords']]
+        scalar_columns['vial_cropping_max'] = [int(coords[1]) for coords in rows['vial_cropping_coords']]
+        scalar_columns['detection_configs'] = [json.dumps(configs) for configs in rows['detection_configs']]
+        scalar_columns['saved_at'] = [time.time()] * len(rows['index'])
+        if 'video_size' in rows:
+            scalar_columns['video_size'] = [int(size) if (size != None) and (size == size) else -1 for size in rows['video_size']]
+            scalar_columns['video_mtime_ns'] = [int(mtime_ns) if (mtime_ns != None) and (mtime_ns == mtime_ns) else -1 for mtime_ns in rows['video_mtime_ns']]
+            scalar_columns['video_fingerprint'] = [fingerprint if isinstance(fingerprint, str) else '' for fingerprint in rows['video_fingerprint']]
+        for column in RAGGED_COLUMNS:
+            coords_per_row = [np.asarray(coords, dtype=np.int32).reshape(-1, 2) for coords in rows[column]]
+            lengths = np.array([coords.shape[0] for coords in coords_per_row], dtype=np.int64)
+            scalar_columns[f'{column}_offset'] = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            scalar_columns[f'{column}_length'] = lengths
+            np.save(f'{self.store_dir}{part_name}_{column}.npy', np.concatenate(coords_per_row + [np.zeros((0, 2), dtype=np.int32)]))
+        # the parquet file is written last, so that a part only becomes visible once it is complete
+        pd.DataFrame(data=scalar_columns).to_parquet(f'{self.store_dir}{part_name}.parquet.tmp', index=False)
+        os.replace(f'{self.store_dir}{part_name}.parquet.tmp', f'{self.store_dir}{part_name}.parquet')
+        return part_name
+
+
+    def load(self, columns: Optional[List[str]]=None, memory_map: bool=True, keys: Optional[List[Tuple[str, int]]]=None) -> Dict[str, List]:
+        # keys: only the rows with these (file_id, time_passed) are converted and returned
+        if columns == None:
+            columns = METADATA_COLUMNS + SCALAR_RESULT_COLUMNS + VIDEO_SIGNATURE_COLUMNS + RAGGED_COLUMNS
+        stored_columns = ['file_id', 'time_passed']
+        for column in columns:
+            if column == 'vial_cropping_coords':
+                stored_columns += ['vial_cropping_min', 'vial_cropping_max']
+            elif column in RAGGED_COLUMNS:
+                stored_columns += [f'{column}_offset', f'{column}_length']
+            elif column not in stored_columns:
+                stored_columns.append(column)
+
+        import pandas as pd
+        part_names = self.get_part_names()
+        part_dfs = list()
+        import pyarrow.parquet as pq
+        for part_number, part_name in enumerate(part_names):
+            # parts written by older versions lack the video signature columns
+            part_columns = pq.read_schema(f'{self.store_dir}{part_name}.parquet').names
+            part_df = pd.read_parquet(f'{self.store_dir}{part_name}.parquet', columns=[column for column in stored_columns if column in part_columns])
+            part_df['part_number'] = part_number
+            part_dfs.append(part_df)
+        if len(part_dfs) == 0:
+            return {column: list() for column in columns}
+        store_df = pd.concat(part_dfs, ignore_index=True).reindex(columns=stored_columns + ['part_number'])
+        store_df = store_df.drop_duplicates(subset=['file_id', 'time_passed'], keep='last')
+        if keys != None:
+            store_df = store_df[pd.MultiIndex.from_frame(store_df[['file_id', 'time_passed']]).isin(keys)]
+
+        results = dict()
+        for column in columns:
+            if column == 'vial_cropping_coords':
+                results[column] = list(zip(store_df['vial_cropping_min'].tolist(), store_df['vial_cropping_max'].tolist()))
+            elif column == 'detection_configs':
+                results[column] = [json.loads(configs) for configs in store_df['detection_configs'].tolist()]
+            elif column in RAGGED_COLUMNS:
+                # plain ndarray views of the memory maps: still zero-copy, but much cheaper to slice than np.memmap
+                ragged_arrays = [np.load(f'{self.store_dir}{part_name}_{column}.npy', mmap_mode='r' if memory_map else None).view(np.ndarray) 
+                                 for part_name in part_names]
+                results[column] = [ragged_arrays[part_number][offset : offset + length]
+                                   for part_number, offset, length in zip(store_df['part_number'].tolist(), store_df[f'{column}_offset'].tolist(), 
+                                                                          store_df[f'{column}_length'].tolist())]
+            else:
+                results[column] = store_df[column].tolist()
+        return results
+
+
+    def compact(self):
+        part_names = self.get_part_names()
+        if len(part_names) > 1:
+            # the compacted part is written before the old parts are removed, so that no results get lost on a crash
+            self.append(rows = self.load(memory_map=False))
+            for part_name in part_names:
+                os.remove(f'{self.store_dir}{part_name}.parquet')
+                for column in RAGGED_COLUMNS:
+                    os.remove(f'{self.store_dir}{part_name}_{column}.npy')
@@ -1,12 +1,28 @@
 import pandas as pd
-import pingouin as pg
-import seaborn as sns
 import numpy as np
-import matplotlib.pyplot as plt
 from typing import Dict
 
 from .database import Database
 
+
+STATS_COLUMNS = ['group_id', 'stimulus_indicator', 'vial_id', 'time_passed', 'corrected_detected_flies']
+
+
+def preprocess_file_infos(file_infos: Dict) -> pd.DataFrame:
+    # Only the columns needed for the stats are turned into a DataFrame (no fly coordinates)
+    df = pd.DataFrame(data={column: file_infos[column] for column in STATS_COLUMNS})
+    # Fly counts normalized to the mean count before the stimulation of the same vial (group_id + vial_id)
+    counts = df['corrected_detected_flies'].astype(float)
+    mean_count_pre = counts.where(df['stimulus_indicator'] == 'pre').groupby([df['group_id'], df['vial_id']]).transform('mean')
+    df['normalized_count'] = counts / mean_count_pre * 100
+    df['continued_time'] = df['time_passed'] + np.where(df['stimulus_indicator'] == 'post', 5, 0)
+    # vial_ids like "_001" are parsed to integers; transgenic vials are numbered after the wildtype ones
+    df['vial_id'] = df['vial_id'].str[1:].astype(int)
+    max_vial_count_wt = df.loc[df['group_id'] == 'wt', 'vial_id'].max()
+    df['vial_id'] = df['vial_id'].where(df['group_id'] != 'tg', df['vial_id'] + max_vial_count_wt)
+    return df
+
+
 class StatsPlotter:
     
     def __init__(self, database: Database):
@@ -20,25 +36,10 @@ class StatsPlotter:
         
         
     def preprocess_dataframe(self) -> pd.DataFrame:
-        df_all = pd.DataFrame(data=self.database.file_infos)
-        df = df_all[['group_id', 'stimulus_indicator', 'vial_id', 'time_passed', 'corrected_detected_flies']].copy()
-        df['normalized_count'] = np.NaN
-        for group_id in df['group_id'].unique():
-            for vial_id in df['vial_id'].unique():
-                mean_count_pre = df.loc[(df['group_id'] == group_id) & (df['vial_id'] == vial_id) & (df['stimulus_indicator'] == 'pre'), 'corrected_detected_flies'].mean()
-                df.loc[(df['group_id'] == group_id) & (df['vial_id'] == vial_id), 'normalized_count'] = df['corrected_detected_flies'] / mean_count_pre * 100
-        df['continued_time'] = df['time_passed']
-        df.loc[df['stimulus_indicator'] == 'post', 'continued_time'] = df['continued_time'] + 5
-        for row in range(df.shape[0]):
-            vial_id = df['vial_id'][row]
-            vial_id = int(vial_id[1:])
-            df.loc[row, 'vial_id'] = vial_id
-
-        max_vial_count_wt = df.loc[df['group_id'] == 'wt', 'vial_id'].max()
-        df.loc[df['group_id'] == 'tg', 'vial_id'] = df['vial_id'] + max_vial_count_wt
-        return df
+        return preprocess_file_infos(file_infos = self.database.file_infos)
     
     def compute_stats(self, df: pd.DataFrame) -> Dict:
+        import pingouin as pg
         rma_wt_pre_vs_post = pg.rm_anova(data=df[df['group_id'] == 'wt'], dv='normalized_count', within=['stimulus_indicator'], subject='vial_id')
         rma_tg_pre_vs_post = pg.rm_anova(data=df[df['group_id'] == 'tg'], dv='normalized_count', within=['stimulus_indicator'], subject='vial_id')
         mma_wt_vs_tg_all_times = pg.mixed_anova(data=df, dv='normalized_count', within='continued_time', subject='vial_id', between='group_id')
@@ -60,6 +61,8 @@ class StatsPlotter:
     
     
     def plot_results(self, df: pd.DataFrame, stats: Dict, save: bool, show: bool):
+        import seaborn as sns
+        import matplotlib.pyplot as plt
         fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(20,5), facecolor='white')
 
         sns.pointplot(data=df[df['group_id'] == 'wt'], x='time_passed', y='normalized_count', hue='stimulus_indicator', 
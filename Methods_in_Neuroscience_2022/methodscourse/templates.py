@@ -0,0 +1,91 @@
+import os
+import numpy as np
+
+from .frames import convert_color_mode
+
+from typing import Dict, List, Tuple
+
+
+TEMPLATE_CATEGORIES = ['flies', 'backgrounds', 'foam']
+FOAM_TEMPLATE_FILENAME = '001_foam.png'
+
+
+class TemplateBank:
+
+    def __init__(self, templates_dir: str):
+        self.templates_dir = templates_dir
+        self.cached_templates = dict()
+        self.cached_signatures = dict()
+        self.cached_converted_templates = dict()
+        self.load_count = 0
+
+
+    def get_templates(self, category: str, color_mode: str='rgb') -> List[np.ndarray]:
+        return list(self.get_templates_by_filename(category = category, color_mode = color_mode).values())
+
+
+    def get_template(self, category: str, filename: str, color_mode: str='rgb') -> np.ndarray:
+        return self.get_templates_by_filename(category = category, color_mode = color_mode)[filename]
+
+
+    def get_templates_by_filename(self, category: str, color_mode: str='rgb') -> Dict[str, np.ndarray]:
+        directory = f'{self.templates_dir}{category}/'
+        signature = self.get_directory_signature(directory = directory)
+        if self.cached_signatures.get(category) != signature:
+            self.cached_templates[category] = self.load_templates(directory = directory, filenames = [elem[0] for elem in signature[1]])
+            self.cached_signatures[category] = signature
+            for cache_key in [key for key in self.cached_converted_templates.keys() if key[0] == category]:
+                self.cached_converted_templates.pop(cache_key)
+        if color_mode == 'rgb':
+            return self.cached_templates[category]
+        if (category, color_mode) not in self.cached_converted_templates:
+            self.cached_converted_templates[(category, color_mode)] = {filename: convert_color_mode(template, color_mode) 
+                                                                       for filename, template in self.cached_templates[category].items()}
+        return self.cached_converted_templates[(category, color_mode)]
+
+
+    def get_signature(self, category: str) -> Tuple:
+        return self.get_directory_signature(directory = f'{self.templates_dir}{category}/')
+
+
+    def get_directory_signature(self, directory: str) -> Tuple:
+        # The mtime of the directory itself only changes when files are added, removed or renamed,
+        # so the individual files are stat'ed as well to also catch templates that were overwritten.
+        file_signatures = list()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') == False and entry.is_file():
+                    stat = entry.stat()
+                    file_signatures.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        file_signatures.sort()
+        return (os.stat(directory).st_mtime_ns, tuple(file_signatures))
+
+
+    def load_templates(self, directory: str, filenames: List[str]) -> Dict[str, np.ndarray]:
+        from skimage.io import imread
+        templates = dict()
+        for filename in filenames:
+            templates[filename] = imread(f'{directory}{filename}')
+        self.load_count += 1
+        return templates
+
+
+    def invalidate(self):
+        self.cached_templates = dict()
+        self.cached_signatures = dict()
+        self.cached_converted_templates = dict()
+
+
+    @property
+    def flies(self) -> List[np.ndarray]:
+        return self.get_templates(category = 'flies')
+
+
+    @property
+    def backgrounds(self) -> List[np.ndarray]:
+        return self.get_templates(category = 'backgrounds')
+
+
+    @property
+    def foam(self) -> np.ndarray:
+        return self.get_template(category = 'foam', filename = FOAM_TEMPLATE_FILENAME)
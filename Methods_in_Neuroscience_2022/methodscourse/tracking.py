@@ -0,0 +1,175 @@
+import os
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import Database
+from .analysis import FlyDetector
+from .frames import FRAMES_PER_SECOND, VIAL_REGION_ROWS, convert_color_mode
+
+from typing import List, Optional, Tuple
+
+
+# detections in consecutive tracked frames are only linked if they are at most this many pixels apart
+MAX_LINKING_DISTANCE = 30
+# number of tracked frames without a detection after which a trajectory is closed
+MAX_GAP_FRAMES = 3
+# shorter trajectories are discarded, they are most likely false positives
+MIN_TRAJECTORY_LENGTH = 10
+
+
+def link_detections(track_coords: np.ndarray, detected_coords: np.ndarray, max_distance: float) -> List[Tuple[int, int]]:
+    # Hungarian assignment of the detections to the last positions of the open tracks, minimizing the summed distance.
+    # A KD tree gates the candidate pairs to those within max_distance - all other pairs can never be assigned.
+    # Returns (track_idx, detection_idx) pairs.
+    if (len(track_coords) == 0) or (len(detected_coords) == 0):
+        return list()
+    from scipy.spatial import cKDTree
+    from scipy.optimize import linear_sum_assignment
+    candidates = cKDTree(detected_coords).query_ball_point(track_coords, r = max_distance)
+    track_indices = np.repeat(np.arange(len(track_coords)), [len(detection_indices) for detection_indices in candidates])
+    if len(track_indices) == 0:
+        return list()
+    detection_indices = np.concatenate([np.asarray(detection_indices, dtype=np.int64) for detection_indices in candidates])
+    costs = np.full((len(track_coords), len(detected_coords)), max_distance * len(track_coords) + 1, dtype=np.float64)
+    costs[track_indices, detection_indices] = np.hypot(*(track_coords[track_indices] - detected_coords[detection_indices]).T)
+    assigned_tracks, assigned_detections = linear_sum_assignment(costs)
+    linked = costs[assigned_tracks, assigned_detections] <= max_distance
+    return list(zip(assigned_tracks[linked].tolist(), assigned_detections[linked].tolist()))
+
+
+def get_climbing_speed(trajectory: np.ndarray) -> float:
+    # upward speed in pixels per second: negative slope of a linear fit of the row over time (rows count downwards)
+    return float(-np.polyfit(trajectory[:, 0] / FRAMES_PER_SECOND, trajectory[:, 1], 1)[0])
+
+
+def get_time_to_threshold(trajectory: np.ndarray, min_climbing_height: int) -> float:
+    # seconds since the start of the recording until the fly is above min_climbing_height for the first time (NaN if never)
+    frames_above_threshold = np.flatnonzero(trajectory[:, 1] < min_climbing_height)
+    if len(frames_above_threshold) == 0:
+        return np.nan
+    return float(trajectory[frames_above_threshold[0], 0] / FRAMES_PER_SECOND)
+
+
+class FlyTracker:
+
+    # Tracking mode of the detection: streams all frames of a recording (or every frame_step-th), detects the flies
+    # in the vial crop of each frame with the response map of the FlyDetector and links the detections across
+    # frames into trajectories. The vial is localized once (or taken from the cached localization) and only the
+    # vial region of every frame is matched. Frames are matched in a thread pool while the video is decoded -
+    # scipy.fft releases the GIL - and are linked in frame order, so at most 2 x workers frames are held in memory.
+    # Trajectories are (n, 3) arrays of [frame_index, row, col] in the coordinates of the cropped vial, like the
+    # fly coords of the detection.
+
+    def __init__(self,
+                 file_id: str, database: Database,
+                 frame_step: int=1,
+                 max_linking_distance: float=MAX_LINKING_DISTANCE,
+                 max_gap_frames: int=MAX_GAP_FRAMES,
+                 min_trajectory_length: int=MIN_TRAJECTORY_LENGTH,
+                 workers: Optional[int]=None,
+                 **detector_kwargs):
+        if frame_step < 1:
+            raise ValueError(f'"frame_step" has to be an integer >= 1, not: {frame_step}')
+        if min_trajectory_length < 2:
+            raise ValueError(f'"min_trajectory_length" has to be at least 2 to compute a climbing speed, not: {min_trajectory_length}')
+        self.file_id = file_id
+        self.database = database
+        self.frame_step = frame_step
+        self.max_linking_distance = max_linking_distance
+        self.max_gap_frames = max_gap_frames
+        self.min_trajectory_length = min_trajectory_length
+        self.workers = workers if workers != None else os.cpu_count()
+        self.fly_detector = FlyDetector(file_id = file_id, database = database, overwrite = True, quick_view = False,
+                                        use_frame_cache = False, **detector_kwargs)
+        self.tracking_configs = {**self.fly_detector.detection_configs,
+                                 'frame_step': frame_step,
+                                 'max_linking_distance': max_linking_distance,
+                                 'max_gap_frames': max_gap_frames,
+                                 'min_trajectory_length': min_trajectory_length}
+        self.vial_cropping_coords = None
+        self.open_tracks = list()
+        self.closed_tracks = list()
+
+
+    def run(self) -> Database:
+        trajectories = self.track()
+        if trajectories != None:
+            min_climbing_height = self.fly_detector.min_climbing_height
+            self.database.add_trajectories(file_id = self.file_id,
+                                           trajectories = trajectories,
+                                           climbing_speeds = [get_climbing_speed(trajectory) for trajectory in trajectories],
+                                           times_to_threshold = [get_time_to_threshold(trajectory, min_climbing_height) for trajectory in trajectories],
+                                           tracking_configs = self.tracking_configs)
+        return self.database
+
+
+    def track(self) -> Optional[List[np.ndarray]]:
+        file_info = self.fly_detector.file_info
+        if file_info['video_available'][0] == False:
+            print(f'The video of file_id: {self.file_id} is no longer available - continue with next file.')
+            return None
+        start_time = time.time()
+        self.open_tracks, self.closed_tracks = list(), list()
+        tracked_frames = 0
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            pending_detections = deque()
+            for frame_index, frame in self.database.frame_loader.iter_frames(file_info['video_filepath'][0], frame_step = self.frame_step):
+                if self.vial_cropping_coords == None:
+                    self.localize_vial(frame)
+                pending_detections.append((frame_index, executor.submit(self.detect_flies_in_frame, frame)))
+                if len(pending_detections) >= 2 * self.workers:
+                    frame_index, detection = pending_detections.popleft()
+                    self.link_frame(frame_index, detection.result())
+                    tracked_frames += 1
+            while len(pending_detections) > 0:
+                frame_index, detection = pending_detections.popleft()
+                self.link_frame(frame_index, detection.result())
+                tracked_frames += 1
+        trajectories = [np.array(track, dtype=np.int32) for track in self.closed_tracks + self.open_tracks
+                        if len(track) >= self.min_trajectory_length]
+        trajectories.sort(key = lambda trajectory: (trajectory[0, 0], trajectory[0, 2]))
+        duration = time.time() - start_time
+        print(f'Tracked {len(trajectories)} flies in {tracked_frames} frames of file_id: {self.file_id} in {duration:.1f} s '
+              f'({1000 * duration / max(tracked_frames, 1):.0f} ms per frame).')
+        return trajectories
+
+
+    def localize_vial(self, frame: np.ndarray):
+        # the same cropping as for the detection, using the cached vial localization if there is one
+        image = convert_color_mode(frame, self.fly_detector.color_mode)
+        self.vial_cropping_coords, vial = self.fly_detector.crop_vial(image = image)
+        if self.fly_detector.background_model == 'median':
+            # computed once up front instead of by several threads at the same time
+            self.fly_detector.get_background_response(self.vial_cropping_coords)
+
+
+    def detect_flies_in_frame(self, frame: np.ndarray) -> np.ndarray:
+        # only the vial region is converted to the color mode and matched
+        vial = convert_color_mode(frame[VIAL_REGION_ROWS[0] : VIAL_REGION_ROWS[1],
+                                        self.vial_cropping_coords[0] - 100 : self.vial_cropping_coords[1] + 100],
+                                  self.fly_detector.color_mode)
+        response_map = self.fly_detector.compute_response_map(vial, self.vial_cropping_coords)
+        all_fly_coords, corrected_fly_coords = self.fly_detector.find_flies(response_map, vial.shape[1])
+        return all_fly_coords
+
+
+    def link_frame(self, frame_index: int, fly_coords: np.ndarray):
+        # tracks without a detection in the last max_gap_frames tracked frames are closed
+        max_frames_since_last_detection = (self.max_gap_frames + 1) * self.frame_step
+        still_open_tracks = list()
+        for track in self.open_tracks:
+            if frame_index - track[-1][0] <= max_frames_since_last_detection:
+                still_open_tracks.append(track)
+            else:
+                self.closed_tracks.append(track)
+        self.open_tracks = still_open_tracks
+        track_coords = np.array([track[-1][1:] for track in self.open_tracks], dtype=np.float64).reshape(-1, 2)
+        linked_detections = set()
+        for track_idx, detection_idx in link_detections(track_coords, fly_coords.astype(np.float64), self.max_linking_distance):
+            self.open_tracks[track_idx].append([frame_index, int(fly_coords[detection_idx, 0]), int(fly_coords[detection_idx, 1])])
+            linked_detections.add(detection_idx)
+        for detection_idx in range(len(fly_coords)):
+            if detection_idx not in linked_detections:
+                self.open_tracks.append([[frame_index, int(fly_coords[detection_idx, 0]), int(fly_coords[detection_idx, 1])]])
@@ -0,0 +1,65 @@
+import os
+import json
+import platform
+import pytest
+
+
+# Run from Methods_in_Neuroscience_2022/ with: python -m pytest -q tests/
+# Wall-clock timings depend on the machine and are only compared with BENCHMARK_BASELINE_FILEPATH on request 
+# (tests marked with "benchmark_timings"):
+#   python -m pytest -q tests/ --benchmark-timings          compare with the baseline (skipped on other machines)
+#   python -m pytest -q tests/ --save-benchmark-baseline    write a new baseline on this machine
+BENCHMARK_BASELINE_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+SYNTHETIC_RECORDINGS = 2
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark-timings', action = 'store_true', default = False,
+                     help = 'Compare the benchmark timings with the saved baseline.')
+    parser.addoption('--save-benchmark-baseline', action = 'store_true', default = False,
+                     help = 'Write the benchmark results of this run as new baseline instead of comparing them with it.')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark_timings: compares wall-clock timings with the benchmark baseline (opt-in)')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark-timings') or config.getoption('--save-benchmark-baseline'):
+        return
+    skip_timings = pytest.mark.skip(reason = 'timings are only compared with --benchmark-timings')
+    for item in items:
+        if 'benchmark_timings' in item.keywords:
+            item.add_marker(skip_timings)
+
+
+@pytest.fixture(scope = 'session')
+def synthetic_recordings(tmp_path_factory):
+    # (root_dir, planted fly centers by (file_id, time_passed)) of synthetic recordings with templates in root_dir
+    from methodscourse.benchmarks import create_synthetic_recordings
+    root_dir = str(tmp_path_factory.mktemp('synthetic_recordings')) + '/'
+    planted_flies = create_synthetic_recordings(root_dir = root_dir, n_recordings = SYNTHETIC_RECORDINGS)
+    return root_dir, planted_flies
+
+
+@pytest.fixture(scope = 'session')
+def benchmark_baseline(request):
+    # Yields the benchmark results collected by the tests, which are saved as new baseline at the end of the session
+    # if --save-benchmark-baseline was passed. Otherwise, the tests compare their results with the saved baseline.
+    from methodscourse.benchmarks import save_benchmark_results
+    save_baseline = request.config.getoption('--save-benchmark-baseline')
+    if (save_baseline == False) and (os.path.isfile(BENCHMARK_BASELINE_FILEPATH) == False):
+        pytest.skip(f'No benchmark baseline at {BENCHMARK_BASELINE_FILEPATH} - run with --save-benchmark-baseline first.')
+    if save_baseline == False:
+        with open(BENCHMARK_BASELINE_FILEPATH, 'r') as io:
+            baseline_machine = json.load(io)['machine']
+        if baseline_machine != platform.platform():
+            pytest.skip(f'The benchmark baseline was recorded on {baseline_machine} - run with --save-benchmark-baseline on this machine first.')
+    benchmark_results = dict()
+    yield {'filepath': BENCHMARK_BASELINE_FILEPATH, 'save': save_baseline, 'results': benchmark_results}
+    if save_baseline:
+        if os.path.isfile(BENCHMARK_BASELINE_FILEPATH):
+            # results of benchmarks that were not run this time are kept
+            with open(BENCHMARK_BASELINE_FILEPATH, 'r') as io:
+                benchmark_results = {**json.load(io)['results'], **benchmark_results}
+        save_benchmark_results(benchmark_results, BENCHMARK_BASELINE_FILEPATH)
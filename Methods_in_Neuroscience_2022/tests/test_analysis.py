@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from methodscourse.analysis import get_corrected_flies_mask, get_points_in_polygon_mask, VIAL_MARGIN
+
+
+VIAL_WIDTH = 400
+MIN_CLIMBING_HEIGHT = 600
+# corners as (row, col), get_fly_coords() has points on and next to each of its edges
+RECTANGLE = [[100, 150], [100, 250], [500, 250], [500, 150]]
+
+
+def get_corrected_flies_per_fly(fly_coords: np.ndarray, vial_width: int, min_climbing_height: int, max_climbing_height=None, roi_polygon=None) -> list:
+    # Reference: the per-fly loop that filtered the detected flies before
+    corrected_fly_coords = list()
+    for fly_coord in fly_coords:
+        if VIAL_MARGIN < fly_coord[1] < vial_width - VIAL_MARGIN:
+            if min_climbing_height > fly_coord[0]:
+                if (max_climbing_height == None) or (fly_coord[0] > max_climbing_height):
+                    if (roi_polygon == None) or is_point_in_polygon(fly_coord, roi_polygon):
+                        corrected_fly_coords.append(fly_coord)
+    return corrected_fly_coords
+
+
+def is_point_in_polygon(point: np.ndarray, polygon: list) -> bool:
+    # Reference: even-odd rule, one edge after the other
+    is_inside = False
+    for (start_row, start_col), (end_row, end_col) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (start_row > point[0]) != (end_row > point[0]):
+            edge_col_at_point_row = start_col + (point[0] - start_row) * (end_col - start_col) / (end_row - start_row)
+            if point[1] < edge_col_at_point_row:
+                is_inside = not is_inside
+    return is_inside
+
+
+def get_fly_coords() -> np.ndarray:
+    # on and next to the polygon edges, the vial margins and the climbing heights
+    rows = [0, 99, 100, 101, 300, 499, 500, 501, MIN_CLIMBING_HEIGHT - 1, MIN_CLIMBING_HEIGHT, MIN_CLIMBING_HEIGHT + 1]
+    cols = [0, VIAL_MARGIN - 1, VIAL_MARGIN, VIAL_MARGIN + 1, 149, 150, 151, 200, 249, 250, 251,
+            VIAL_WIDTH - VIAL_MARGIN - 1, VIAL_WIDTH - VIAL_MARGIN, VIAL_WIDTH - VIAL_MARGIN + 1, VIAL_WIDTH - 1]
+    return np.array([[row, col] for row in rows for col in cols], dtype=np.int32)
+
+
+@pytest.mark.parametrize('max_climbing_height', [None, 100])
+@pytest.mark.parametrize('roi_polygon', [None, RECTANGLE, [[50, 200], [450, 120], [450, 280]]])
+def test_corrected_flies_mask_matches_per_fly_loop(max_climbing_height, roi_polygon):
+    fly_coords = get_fly_coords()
+    corrected_flies_mask = get_corrected_flies_mask(fly_coords, VIAL_WIDTH, MIN_CLIMBING_HEIGHT,
+                                                    max_climbing_height = max_climbing_height, roi_polygon = roi_polygon)
+    expected_fly_coords = get_corrected_flies_per_fly(fly_coords, VIAL_WIDTH, MIN_CLIMBING_HEIGHT, max_climbing_height, roi_polygon)
+    assert fly_coords[corrected_flies_mask].tolist() == np.array(expected_fly_coords).reshape(-1, 2).tolist()
+
+
+def test_flies_on_the_vial_margins_and_climbing_height_are_removed():
+    fly_coords = np.array([[300, VIAL_MARGIN], [300, VIAL_WIDTH - VIAL_MARGIN], [MIN_CLIMBING_HEIGHT, 200],
+                           [300, VIAL_MARGIN + 1], [300, VIAL_WIDTH - VIAL_MARGIN - 1], [MIN_CLIMBING_HEIGHT - 1, 200]])
+    corrected_flies_mask = get_corrected_flies_mask(fly_coords, VIAL_WIDTH, MIN_CLIMBING_HEIGHT)
+    assert corrected_flies_mask.tolist() == [False, False, False, True, True, True]
+
+
+def test_points_on_the_polygon_edges():
+    # top and left edges belong to the polygon, bottom and right edges don't (each point is in exactly one of two adjacent polygons)
+    points = np.array([[100, 200], [300, 150], [500, 200], [300, 250], [100, 150], [500, 250], [300, 200]])
+    assert get_points_in_polygon_mask(points, np.asarray(RECTANGLE)).tolist() == [True, True, False, False, True, False, True]
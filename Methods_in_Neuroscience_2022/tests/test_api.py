@@ -0,0 +1,31 @@
+import shutil
+
+from methodscourse.api import API
+
+
+# (threshold, min_distance, min_climbing_height), the low threshold also detects peaks of the background noise,
+# so that each of the other settings changes the fly counts
+SWEPT_SETTINGS = [(0.1, 25, 600), (0.25, 25, 600), (0.1, 60, 600), (0.1, 25, 400)]
+
+
+def test_sweep_matches_full_detection(synthetic_recordings, tmp_path):
+    synthetic_root_dir, planted_flies = synthetic_recordings
+    root_dir = str(tmp_path) + '/'
+    shutil.copytree(synthetic_root_dir, root_dir, dirs_exist_ok = True)
+    api = API(root_dir)
+    file_id = sorted(planted_flies.keys())[0][0]
+    param_grid = {'threshold': sorted(set(setting[0] for setting in SWEPT_SETTINGS)),
+                  'min_distance': sorted(set(setting[1] for setting in SWEPT_SETTINGS)),
+                  'min_climbing_height': sorted(set(setting[2] for setting in SWEPT_SETTINGS))}
+    sweep_results = api.sweep_detection(param_grid = param_grid, file_ids = [file_id])
+    swept_counts = dict()
+    for row in range(len(sweep_results['file_id'])):
+        setting = tuple(sweep_results[key][row] for key in ['time_passed', 'threshold', 'min_distance', 'min_climbing_height'])
+        swept_counts[setting] = (sweep_results['all_detected_flies'][row], sweep_results['corrected_detected_flies'][row])
+    for threshold, min_distance, min_climbing_height in SWEPT_SETTINGS:
+        api.detect_flies(file_ids = [file_id], threshold = threshold, min_distance = min_distance,
+                         min_climbing_height = min_climbing_height, overwrite = True)
+        file_info = api.database.get_file_info_df(file_id = file_id)
+        for time_passed, all_detected_flies, corrected_detected_flies in zip(file_info['time_passed'], file_info['all_detected_flies'],
+                                                                             file_info['corrected_detected_flies']):
+            assert swept_counts[(time_passed, threshold, min_distance, min_climbing_height)] == (all_detected_flies, corrected_detected_flies)
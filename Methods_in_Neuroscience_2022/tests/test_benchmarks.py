@@ -0,0 +1,44 @@
+import pytest
+
+from methodscourse.benchmarks import benchmark_detection, benchmark_import_time, compare_benchmark_results, get_imported_lazy_modules
+
+
+# the synthetic flies are well separated and have a clear contrast, hardly any of them should be missed
+MIN_RECALL = 0.95
+MIN_PRECISION = 0.95
+
+
+@pytest.fixture(scope = 'module')
+def detection_results(synthetic_recordings):
+    root_dir, planted_flies = synthetic_recordings
+    return benchmark_detection(root_dir = root_dir, planted_flies = planted_flies)
+
+
+def compare_with_baseline(benchmark_baseline, benchmark_name: str, benchmark_results: dict):
+    benchmark_baseline['results'][benchmark_name] = benchmark_results
+    if benchmark_baseline['save']:
+        return
+    regressions = compare_benchmark_results(reference_filepath = benchmark_baseline['filepath'],
+                                            benchmark_results = {benchmark_name: benchmark_results})
+    assert regressions == []
+
+
+def test_detection_recall(detection_results):
+    assert detection_results['recall'] >= MIN_RECALL
+    assert detection_results['precision'] >= MIN_PRECISION
+
+
+@pytest.mark.benchmark_timings
+def test_detection_stage_durations(detection_results, benchmark_baseline):
+    compare_with_baseline(benchmark_baseline, 'detection', detection_results)
+
+
+@pytest.mark.parametrize('module', ['methodscourse', 'methodscourse.api'])
+def test_heavy_modules_are_imported_lazily(module):
+    assert get_imported_lazy_modules(module) == []
+
+
+@pytest.mark.benchmark_timings
+def test_import_time(benchmark_baseline):
+    import_time_results = benchmark_import_time()
+    compare_with_baseline(benchmark_baseline, 'import_time', import_time_results)
@@ -0,0 +1,103 @@
+import os
+import time
+import numpy as np
+
+from methodscourse.database import Database, TIMEPOINTS_TO_ANALYZE
+
+
+# the videos are only listed, never decoded - any content will do
+VIDEO_FILENAMES = ['0000_wt_pre_light_001.mp4', '0001_wt_pre_light_002.mp4']
+
+
+def write_video(root_dir: str, filename: str, content: bytes):
+    with open(f'{root_dir}recorded_videos/{filename}', 'wb') as io:
+        io.write(content)
+
+
+def create_database(root_dir: str) -> Database:
+    database = Database(root_dir)
+    for i, filename in enumerate(VIDEO_FILENAMES):
+        write_video(root_dir, filename, bytes([i]) * 1000)
+    database.prepare_database_for_analysis()
+    return database
+
+
+def add_detections(database: Database, file_id: str, n_flies: int):
+    fly_coords = np.full((n_flies, 2), 700, dtype=np.int32)
+    for time_passed in TIMEPOINTS_TO_ANALYZE:
+        database.add_detected_flies(file_id = file_id, time_passed = time_passed, all_fly_coords = fly_coords, vial_cropping_coords = (800, 1100),
+                                    corrected_fly_coords = fly_coords[:1], detection_configs = {'threshold': 0.25})
+
+
+def load_database(root_dir: str) -> Database:
+    database = Database(root_dir)
+    database.prepare_database_for_analysis()
+    database.load_file_infos()
+    return database
+
+
+def get_detected_flies(database: Database, file_id: str) -> list:
+    return database.get_file_info_df(file_id = file_id)['all_detected_flies']
+
+
+def test_touched_videos_keep_their_results(tmp_path):
+    root_dir = str(tmp_path) + '/'
+    database = create_database(root_dir)
+    add_detections(database, '0000', n_flies = 10)
+    database.save_file_infos(prefix = '')
+    for filename in VIDEO_FILENAMES:
+        os.utime(f'{root_dir}recorded_videos/{filename}', ns = (time.time_ns() + 10**9, time.time_ns() + 10**9))
+    database.prepare_database_for_analysis()
+    assert get_detected_flies(database, '0000') == [10] * 5
+    assert get_detected_flies(load_database(root_dir), '0000') == [10] * 5
+
+
+def test_replaced_videos_lose_their_results(tmp_path):
+    root_dir = str(tmp_path) + '/'
+    database = create_database(root_dir)
+    add_detections(database, '0000', n_flies = 10)
+    add_detections(database, '0001', n_flies = 5)
+    database.save_file_infos(prefix = '')
+    # re-recorded under the same name, with the same size and mtime as before
+    signature = os.stat(f'{root_dir}recorded_videos/{VIDEO_FILENAMES[0]}')
+    write_video(root_dir, VIDEO_FILENAMES[0], bytes([7]) * 1000)
+    os.utime(f'{root_dir}recorded_videos/{VIDEO_FILENAMES[0]}', ns = (signature.st_atime_ns, signature.st_mtime_ns + 1))
+    database.prepare_database_for_analysis()
+    assert get_detected_flies(database, '0000') == [None] * 5
+    reloaded_database = load_database(root_dir)
+    assert get_detected_flies(reloaded_database, '0000') == [None] * 5
+    assert get_detected_flies(reloaded_database, '0001') == [5] * 5
+
+
+def test_most_recent_save_wins(tmp_path):
+    root_dir = str(tmp_path) + '/'
+    database = create_database(root_dir)
+    add_detections(database, '0000', n_flies = 10)
+    add_detections(database, '0001', n_flies = 10)
+    database.save_file_infos(prefix = 'b_')
+    # saved later, but listed first
+    add_detections(database, '0000', n_flies = 5)
+    database.save_file_infos(prefix = 'a_')
+    reloaded_database = load_database(root_dir)
+    assert get_detected_flies(reloaded_database, '0000') == [5] * 5
+    assert get_detected_flies(reloaded_database, '0001') == [10] * 5
+
+
+def test_most_recent_save_wins_over_pickled_results(tmp_path, monkeypatch):
+    root_dir = str(tmp_path) + '/'
+    database = create_database(root_dir)
+    add_detections(database, '0000', n_flies = 10)
+    add_detections(database, '0001', n_flies = 10)
+    database.save_file_infos(prefix = 'store_')
+    add_detections(database, '0000', n_flies = 5)
+    add_detections(database, '0001', n_flies = 5)
+    monkeypatch.setattr('methodscourse.database.parquet_engine_available', lambda: False)
+    database.save_file_infos(prefix = 'pickle_')
+    monkeypatch.undo()
+    # the modification time of the pickled results is their save time
+    saved_at_ns = time.time_ns() + 10**9
+    os.utime(f'{root_dir}results/pickle_file_info_results.p', ns = (saved_at_ns, saved_at_ns))
+    assert get_detected_flies(load_database(root_dir), '0000') == [5] * 5
+    saved_at_ns = time.time_ns() - 3600 * 10**9
+    os.utime(f'{root_dir}results/pickle_file_info_results.p', ns = (saved_at_ns, saved_at_ns))
+    assert get_detected_flies(load_database(root_dir), '0000') == [10] * 5
@@ -0,0 +1,40 @@
+import os
+import numpy as np
+
+from methodscourse.frames import FrameCache, VIAL_REGION_ROWS, FRAME_CACHE_COLUMN_MARGIN
+
+
+VIAL_COL_RANGE = (600, 700)
+
+
+def get_region_bytes(n_timepoints: int) -> int:
+    region_cols = VIAL_COL_RANGE[1] - VIAL_COL_RANGE[0] + 2 * FRAME_CACHE_COLUMN_MARGIN
+    return n_timepoints * (VIAL_REGION_ROWS[1] - VIAL_REGION_ROWS[0]) * region_cols * 3
+
+
+def put_recording(frame_cache: FrameCache, file_id: str, video_signature: tuple=(1, 2)):
+    frame = np.zeros((1088, 1920, 3), dtype=np.uint8)
+    frame_cache.put(file_id, 'rgb', video_signature, {0: frame, 5: frame}, VIAL_COL_RANGE)
+
+
+def test_regions_of_a_changed_video_are_removed(tmp_path):
+    frame_cache = FrameCache(str(tmp_path) + '/')
+    put_recording(frame_cache, '0000', video_signature = (1, 2))
+    assert frame_cache.get('0000', 'rgb', (1, 2)) != None
+    assert frame_cache.get('0000', 'rgb', (3, 4)) == None
+    assert os.listdir(tmp_path) == []
+
+
+def test_least_recently_used_recordings_are_removed(tmp_path):
+    # room for 3 recordings with 2 timepoints each (plus the .npy headers)
+    frame_cache = FrameCache(str(tmp_path) + '/', max_size_bytes = 3 * get_region_bytes(2) + 1000)
+    for file_id in ['0000', '0001', '0002']:
+        put_recording(frame_cache, file_id)
+    # 0000 is used again and becomes the most recently used recording
+    os.utime(frame_cache.get_filepaths('0000', 'rgb')[0], ns = (0, 0))
+    os.utime(frame_cache.get_filepaths('0001', 'rgb')[0], ns = (1, 1))
+    frame_cache.get('0000', 'rgb', (1, 2))
+    put_recording(frame_cache, '0003')
+    assert sorted(os.listdir(tmp_path)) == ['0000_rgb.json', '0000_rgb.npy', '0002_rgb.json', '0002_rgb.npy', '0003_rgb.json', '0003_rgb.npy']
+    frame_cache.clear()
+    assert os.listdir(tmp_path) == []
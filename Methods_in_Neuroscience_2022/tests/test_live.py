@@ -0,0 +1,33 @@
+import os
+import shutil
+import numpy as np
+
+from methodscourse.benchmarks import match_detected_flies
+from methodscourse.database import Database, TIMEPOINTS_TO_ANALYZE
+from methodscourse.frames import VIAL_REGION_ROWS
+from methodscourse.live import ReplayCamera
+from methodscourse.recording import Recorder
+
+
+# the counts are preliminary, but the synthetic flies are still found in the downscaled frames
+MIN_RECALL = 0.9
+
+
+def test_live_counts_of_a_replayed_recording(synthetic_recordings, tmp_path, monkeypatch):
+    synthetic_root_dir, planted_flies = synthetic_recordings
+    root_dir = str(tmp_path) + '/'
+    shutil.copytree(f'{synthetic_root_dir}templates/', f'{root_dir}templates/')
+    video_filepath = synthetic_root_dir + 'recorded_videos/' + sorted(os.listdir(f'{synthetic_root_dir}recorded_videos/'))[0]
+    # no preview and the recording stops right after the last analyzed timepoint
+    monkeypatch.setattr('methodscourse.recording.sleep', lambda seconds: None)
+    monkeypatch.setattr('methodscourse.recording.RECORDING_DURATION', max(TIMEPOINTS_TO_ANALYZE))
+    database = Database(root_dir)
+    recorder = Recorder(database = database, camera_factory = lambda: ReplayCamera(video_filepath))
+    database = recorder.start_recording(group_id = 'wt', vial_id = 1, stimulus_indicator = 'pre', live_count = True)
+    assert os.listdir(f'{root_dir}recorded_videos/') == ['0000_wt_pre_light_001.h264']
+    assert sorted(database.live_counts['0000'].keys()) == TIMEPOINTS_TO_ANALYZE
+    for time_passed, live_count in database.live_counts['0000'].items():
+        # planted flies in the coordinates of the cropped vial
+        planted_fly_coords = planted_flies[('0000', time_passed)] - np.array([VIAL_REGION_ROWS[0], live_count['vial_cropping_coords'][0] - 100])
+        assert match_detected_flies(np.asarray(live_count['all_fly_coords']), planted_fly_coords) >= MIN_RECALL * len(planted_fly_coords)
+        assert live_count['corrected_detected_flies'] <= live_count['all_detected_flies']
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from methodscourse.matching import MatchingEngine
+
+
+def match_templates_per_template(image: np.ndarray, template_flies: list, template_bkgrs: list) -> np.ndarray:
+    # Reference: one skimage.feature.match_template call per template
+    from skimage.feature import match_template
+    fly_mean_results = sum([match_template(image, fly) for fly in template_flies]) / len(template_flies)
+    bkgr_mean_results = sum([match_template(image, bkgr) for bkgr in template_bkgrs]) / len(template_bkgrs)
+    bkgr_corrected_results = fly_mean_results - bkgr_mean_results
+    if bkgr_corrected_results.ndim == 3:
+        bkgr_corrected_results = bkgr_corrected_results[..., 0]
+    return bkgr_corrected_results
+
+
+def create_image_and_templates(channels: int, seed: int=42):
+    rng = np.random.default_rng(seed)
+    shape = (120, 160, channels) if channels > 1 else (120, 160)
+    template_shape = (30, 40, channels) if channels > 1 else (30, 40)
+    image = rng.integers(0, 255, shape).astype(np.uint8)
+    # a flat region, where the local window variance is 0 and the response has to be 0 as well
+    image[:40, :50] = 128
+    template_flies = [rng.integers(0, 255, template_shape).astype(np.uint8) for i in range(3)]
+    template_bkgrs = [rng.integers(0, 255, template_shape).astype(np.uint8) for i in range(2)]
+    return image, template_flies, template_bkgrs
+
+
+@pytest.mark.parametrize('channels', [1, 3])
+def test_fly_and_background_banks_match_skimage(channels):
+    image, template_flies, template_bkgrs = create_image_and_templates(channels = channels)
+    reference_results = match_templates_per_template(image, template_flies, template_bkgrs)
+    batched_results = MatchingEngine(image).match_fly_and_background_banks(template_flies, template_bkgrs)
+    assert batched_results.shape == reference_results.shape
+    assert np.allclose(batched_results, reference_results, atol = 1e-6)
+
+
+@pytest.mark.parametrize('channels', [1, 3])
+def test_template_bank_matches_skimage(channels):
+    from skimage.feature import match_template
+    image, template_flies, template_bkgrs = create_image_and_templates(channels = channels)
+    reference_results = sum([match_template(image, fly) for fly in template_flies]) / len(template_flies)
+    if reference_results.ndim == 3:
+        reference_results = reference_results[..., 0]
+    assert np.allclose(MatchingEngine(image).match_template_bank(template_flies), reference_results, atol = 1e-6)
+
+
+def test_matching_at_positions_matches_full_response_map():
+    image, template_flies, template_bkgrs = create_image_and_templates(channels = 3)
+    matching_engine = MatchingEngine(image)
+    full_results = matching_engine.match_fly_and_background_banks(template_flies, template_bkgrs)
+    positions = np.argwhere(np.ones(full_results.shape, dtype=bool))[::7]
+    results_at_positions = matching_engine.match_fly_and_background_banks(template_flies, template_bkgrs, positions = positions)
+    assert np.allclose(results_at_positions, full_results[positions[:, 0], positions[:, 1]], atol = 1e-6)
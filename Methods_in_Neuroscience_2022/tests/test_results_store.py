@@ -0,0 +1,51 @@
+import os
+import numpy as np
+import pytest
+
+from methodscourse.results_store import ResultsStore, METADATA_COLUMNS
+
+
+def create_rows(time_passed: list, n_flies: list, file_id: str='0000') -> dict:
+    rows = {column: list() for column in METADATA_COLUMNS}
+    rows.update({'all_detected_flies': list(), 'corrected_detected_flies': list(), 'vial_cropping_coords': list(),
+                 'detection_configs': list(), 'all_fly_coords': list(), 'corrected_fly_coords': list()})
+    for timepoint, n in zip(time_passed, n_flies):
+        fly_coords = np.arange(2 * n, dtype=np.int32).reshape(n, 2) + 1000 * timepoint
+        for column, value in [('index', f'{file_id}_{timepoint}'), ('file_id', file_id), ('group_id', 'wt'), ('stimulus_indicator', 'pre'),
+                              ('vial_id', 1), ('time_passed', timepoint), ('video_filepath', f'recorded_videos/{file_id}.mp4'),
+                              ('all_detected_flies', n), ('corrected_detected_flies', n // 2), ('vial_cropping_coords', (800, 1100)),
+                              ('detection_configs', {'threshold': 0.25, 'roi_polygon': None}), ('all_fly_coords', fly_coords),
+                              ('corrected_fly_coords', fly_coords[:n // 2])]:
+            rows[column].append(value)
+    return rows
+
+
+@pytest.mark.parametrize('memory_map', [True, False])
+def test_round_trip(tmp_path, memory_map):
+    results_store = ResultsStore(str(tmp_path) + '/')
+    # the second part overwrites timepoint 2 with a row without any flies
+    results_store.append(rows = create_rows(time_passed = [1, 2, 3], n_flies = [3, 4, 1]))
+    results_store.append(rows = create_rows(time_passed = [2, 4], n_flies = [0, 2]))
+    results = results_store.load(memory_map = memory_map)
+    expected_rows = create_rows(time_passed = [1, 3, 2, 4], n_flies = [3, 1, 0, 2])
+    for column in expected_rows.keys():
+        if column in ['all_fly_coords', 'corrected_fly_coords']:
+            assert [coords.tolist() for coords in results[column]] == [coords.reshape(-1, 2).tolist() for coords in expected_rows[column]]
+        else:
+            assert results[column] == expected_rows[column]
+
+
+def test_load_keys_and_compact(tmp_path):
+    results_store = ResultsStore(str(tmp_path) + '/')
+    results_store.append(rows = create_rows(time_passed = [1, 2, 3], n_flies = [3, 4, 1]))
+    results_store.append(rows = create_rows(time_passed = [2], n_flies = [6]))
+    results = results_store.load(columns = ['time_passed', 'all_fly_coords'], keys = [('0000', 2), ('0000', 3)])
+    assert results['time_passed'] == [3, 2]
+    assert [coords.shape[0] for coords in results['all_fly_coords']] == [1, 6]
+    all_results = results_store.load(memory_map = False)
+    results_store.compact()
+    assert results_store.get_part_names() == ['part_000003']
+    assert sorted(os.listdir(tmp_path)) == ['part_000003.parquet', 'part_000003_all_fly_coords.npy', 'part_000003_corrected_fly_coords.npy']
+    compacted_results = results_store.load(memory_map = False)
+    assert compacted_results['all_detected_flies'] == all_results['all_detected_flies']
+    assert [coords.tolist() for coords in compacted_results['all_fly_coords']] == [coords.tolist() for coords in all_results['all_fly_coords']]
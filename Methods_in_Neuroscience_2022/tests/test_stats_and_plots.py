@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from methodscourse.benchmarks import create_synthetic_stats_file_infos
+from methodscourse.stats_and_plots import preprocess_file_infos
+
+
+def preprocess_file_infos_per_vial(file_infos: dict) -> pd.DataFrame:
+    # Reference: the former StatsPlotter.preprocess_dataframe with one pass per group_id x vial_id
+    df = pd.DataFrame(data=file_infos)[['group_id', 'stimulus_indicator', 'vial_id', 'time_passed', 'corrected_detected_flies']].copy()
+    df['normalized_count'] = np.nan
+    for group_id in df['group_id'].unique():
+        for vial_id in df['vial_id'].unique():
+            mean_count_pre = df.loc[(df['group_id'] == group_id) & (df['vial_id'] == vial_id) & (df['stimulus_indicator'] == 'pre'), 'corrected_detected_flies'].mean()
+            df.loc[(df['group_id'] == group_id) & (df['vial_id'] == vial_id), 'normalized_count'] = df['corrected_detected_flies'] / mean_count_pre * 100
+    df['continued_time'] = df['time_passed']
+    df.loc[df['stimulus_indicator'] == 'post', 'continued_time'] = df['continued_time'] + 5
+    # object dtype, so that recent pandas versions (string dtype) accept the integers that are written row by row
+    df['vial_id'] = df['vial_id'].astype(object)
+    for row in range(df.shape[0]):
+        vial_id = df['vial_id'][row]
+        vial_id = int(vial_id[1:])
+        df.loc[row, 'vial_id'] = vial_id
+    max_vial_count_wt = df.loc[df['group_id'] == 'wt', 'vial_id'].max()
+    df.loc[df['group_id'] == 'tg', 'vial_id'] = df['vial_id'] + max_vial_count_wt
+    return df
+
+
+@pytest.mark.parametrize('n_rows', [100, 1000])
+def test_preprocess_file_infos_matches_per_vial_reference(n_rows):
+    # the synthetic file_infos contain missing counts (None) as well
+    file_infos = create_synthetic_stats_file_infos(n_rows = n_rows)
+    pd.testing.assert_frame_equal(preprocess_file_infos(file_infos = file_infos), preprocess_file_infos_per_vial(file_infos = file_infos),
+                                  check_dtype = False)